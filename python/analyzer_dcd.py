@@ -2,19 +2,121 @@
 
 Protocol should be set to GCR (protocol select pin should be pulled low), GPi should be connected to CA0.
 
-Requires PySerial.
+Requires PySerial (except when replaying a capture with capture.FileSource).
 '''
 
 from collections import deque
-import sys
 import time
 
-import serial
+from capture import open_source
+import checkpoint
+from checkpoint import CHECKPOINT_INTERVAL
+from events import DcdPayload, Desync, MarkError, TransactionEnd
+from eventtable import EventTable
+from logwriter import LogWriter
+from markindex import IndexWriter, capture_of
+from pack import DATA, NO_DIRECTION, TRANSACTION, FileWriter, PackWriter
+from stats import Stats, reporting
 
 
-class _MacToDcdDecoder:
+SYNC = 0xAA
+DONE = 1  # feed() found a valid payload
+DEAD = 2  # feed() found that the decoder no longer accepts data, so cannot find a payload until it is reset
+BAD = 3  # feed() found a complete payload that is not valid, after which the decoder no longer accepts data
+
+SHIFT_TABLE = bytes((byte & 0x7F) << 1 for byte in range(256))
+BIT_TABLES = tuple(bytes((byte >> bit) & 1 for byte in range(256)) for bit in range(7))  # to transpose LSB bytes
+# an LSB byte spread out to 7 bytes of one bit each, as a little-endian integer
+LSB_SPREADS = tuple(sum(((byte >> bit) & 1) << (bit * 8) for bit in range(7)) for byte in range(256))
+HOLDOFF_TABLE = bytes(byte >> 7 for byte in range(256))  # zero for a byte that ends a group with a holdoff
+COLUMN_GROUPS = 8  # groups from which reassembling a column at a time is faster than a group at a time
+
+
+def reassemble(groups, lsb_offset):
+  '''Reassemble 8-byte groups, each of 7 bytes of high bits and a byte of their LSBs at lsb_offset, into 7 bytes each.
+
+  Rather than shifting in the bits of each LSB byte one at a time, the bits of an LSB byte are spread out to the 7 bytes
+  of its group by a table, and ORed as an integer with the bytes shifted by a translation table.  Many groups are
+  handled a column at a time instead: the nth bytes of all the groups are shifted, the nth bits of all the LSB bytes are
+  picked out by another translation table, and the two are ORed together as big integers.
+  '''
+  count = len(groups) // 8
+  first = 1 if lsb_offset == 0 else 0
+  if count < COLUMN_GROUPS:
+    return b''.join((int.from_bytes(groups[i + first:i + first + 7].translate(SHIFT_TABLE), 'little') |
+                     LSB_SPREADS[groups[i + lsb_offset]]).to_bytes(7, 'little') for i in range(0, count * 8, 8))
+  lsbs = groups[lsb_offset::8]
+  data = bytearray(count * 7)
+  for bit in range(7):
+    high = int.from_bytes(groups[first + bit::8].translate(SHIFT_TABLE), 'little')
+    data[bit::7] = (high | int.from_bytes(lsbs.translate(BIT_TABLES[bit]), 'little')).to_bytes(count, 'little')
+  return data
+
+
+class _GroupDecoder:
+  '''Chunk-at-a-time decoding for the two decoders below.
+
+  feed_byte is the state machine of a decoder, a byte at a time.  feed searches for sync bytes with bytes.find and
+  reassembles runs of whole groups in bulk, falling back on feed_byte for everything else, with the same results.
+  '''
+  
+  LSB_OFFSET = None  # position of the LSB byte in a group
+  
+  def feed(self, data, start, end, tell):
+    '''Feed data[start:end] to the decoder, where tell is the offset of data[0] within the transaction.
+    
+    Stops at the first byte that completes a valid payload or leaves the decoder not accepting data, returning DONE,
+    BAD if it completes a payload that is not valid, or DEAD, and the index of that byte, or returns None and end if
+    there is no such byte.  The offset of the first byte fed after a reset is left in sync_tell.
+    '''
+    pos = start
+    while pos < end:
+      if not self._accept_data: return DEAD, pos
+      if not self._sync:
+        if self._first_sync:
+          self._first_sync = False
+          self.sync_tell = tell + pos
+        pos = data.find(SYNC, pos, end)
+        if pos == -1: return None, end
+        self._sync = True
+        pos += 1
+        continue
+      groups = min((end - pos) >> 3, (len(self._data) - self._data_idx) // 7) if self._at_group_boundary() else 0
+      if groups:
+        run = data[pos:pos + groups * 8]
+        holdoff = run[7::8].translate(HOLDOFF_TABLE).find(0)
+        if holdoff != -1:
+          groups = holdoff + 1
+          run = run[:groups * 8]
+          self._sync = False  # wait for another sync byte
+        data_idx = self._data_idx
+        self._data[data_idx:data_idx + groups * 7] = reassemble(run, self.LSB_OFFSET)
+        self._data_idx = data_idx + groups * 7
+        pos += groups * 8
+        if self._data_idx == len(self._data):
+          self._accept_data = False
+          return DONE if self._valid() else BAD, pos - 1
+      else:
+        _, done, _ = self.feed_byte(data[pos])
+        pos += 1
+        if done: return DONE, pos - 1
+        if not self._accept_data: return BAD, pos - 1  # only completing a payload stops a decoder accepting data
+    return None, end
+  
+  def state(self):
+    '''Return the state of the decoder, for a checkpoint.'''
+    return dict(vars(self))
+  
+  def restore(self, state):
+    vars(self).update(state)
+
+
+class _MacToDcdDecoder(_GroupDecoder):
+  
+  LSB_OFFSET = 0
   
   def __init__(self):
+    self.sync_tell = None
     self.reset()
   
   def reset(self):
@@ -57,13 +159,22 @@ class _MacToDcdDecoder:
         if sum(self._data) & 0xFF == 0x00 and self._data[0] & 0x80 == 0x00: return False, True, False
     return False, False, self._accept_data
   
+  def _at_group_boundary(self):
+    return self._out_groups and self._in_groups and self._lsb_byte is None
+  
+  def _valid(self):
+    return sum(self._data) & 0xFF == 0x00 and self._data[0] & 0x80 == 0x00
+  
   def result(self):
     return self._in_groups, self._data
 
 
-class _DcdToMacDecoder:
+class _DcdToMacDecoder(_GroupDecoder):
+  
+  LSB_OFFSET = 7
   
   def __init__(self):
+    self.sync_tell = None
     self.reset()
   
   def reset(self, in_groups=0):
@@ -103,89 +214,199 @@ class _DcdToMacDecoder:
       if self._data_idx % 7 == 0: self._expect_lsb_byte = True
     return False, False, self._accept_data
   
+  def _at_group_boundary(self):
+    return not self._expect_lsb_byte and self._data_idx % 7 == 0
+  
+  def _valid(self):
+    return sum(self._data) & 0xFF == 0x00 and self._data[0] & 0x80
+  
   def result(self):
     return self._in_groups, self._data
 
 
 class Analyzer:
   
-  def __init__(self, serial_port, file_prefix):
-    self._s = serial.Serial(port=serial_port, baudrate=1000000, timeout=0.25)
+  def __init__(self, serial_port, file_prefix, pack=True, console='all', subsecond=False, stats_interval=None,
+               stats_address=None, index=True, compress=None, checkpoints=True, resume=False, table=False):
+    self.stats = Stats()
+    self._options = dict(pack=pack, index=index)  # which a checkpoint must have been saved with
+    state = checkpoint.load(file_prefix, 'dcd', **self._options) if resume and file_prefix is not None else None
+    if state:
+      checkpoint.resume_source(serial_port, state)
+    elif file_prefix is not None:
+      checkpoint.remove(file_prefix)
+    self._stats_interval = stats_interval
+    self._stats_address = stats_address
+    source = open_source(serial_port, None if file_prefix is None else '%s_serial.bin' % file_prefix, compress)
+    self._source = self.stats.watch(source)
     self._file_prefix = file_prefix
-    self._log_fp = open('%s.log' % self._file_prefix, 'w')
-    self._serial_fp = open('%s_serial.bin' % self._file_prefix, 'wb')
-    self._trans_fp = None
+    if file_prefix is None:
+      self._log_writer = self._output = self._index = None
+    else:
+      self._log_writer = LogWriter('%s.log' % self._file_prefix, console, subsecond, resume=state and state['log'])
+      if pack:
+        self._output = PackWriter(file_prefix, ('mac', 'dcd'), resume=state and state['output'])
+      else:
+        self._output = FileWriter(file_prefix, ('mac', 'dcd'), resume=state and state['output'])
+      self._index = IndexWriter(file_prefix, *capture_of(source, file_prefix),
+                                resume=state and state['index']) if index else None
+    self._base = state['base'] if state else capture_of(source, file_prefix)[1]  # offset of stream_tell 0
+    self.table = EventTable(self._base) if table else None  # columns of every payload, for statistics
+    self._recorders = tuple(recorder for recorder in (self._index, self.table) if recorder is not None)
+    self._trans_tell = 0
     self._cur_trans_num = -1
     self._cur_data = -1
+    self._checkpoints = checkpoints and file_prefix is not None
+    self._checkpoint_tell = None  # stream_tell of the last checkpoint
+    self._checkpoint_time = time.monotonic()
+    self._state = state  # to carry on from, once events() starts
+    if state:
+      self._trans_tell, self._cur_trans_num, self._cur_data = state['trans_tell'], state['trans'], state['data']
+      self._checkpoint_tell = state['stream_tell']
+  
+  def _save_checkpoint(self, stream_tell, mid_transaction, reply_expected, mac_to_dcd, dcd_to_mac):
+    '''Save a checkpoint of the decoding up to stream_tell, between chunks of input.'''
+    state = dict(kind='dcd', options=self._options, base=self._base, offset=self._base + stream_tell,
+                 stream_tell=stream_tell, trans=self._cur_trans_num, trans_tell=self._trans_tell, data=self._cur_data,
+                 mid_transaction=mid_transaction, reply_expected=reply_expected, mac_to_dcd=mac_to_dcd.state(),
+                 dcd_to_mac=dcd_to_mac.state(), log=self._log_writer.checkpoint(), output=self._output.checkpoint(),
+                 index=self._index and self._index.checkpoint())
+    checkpoint.save(self._file_prefix, state)
+    self._checkpoint_tell = stream_tell
+    self._checkpoint_time = time.monotonic()
+  
+  def _checkpoint_due(self, stream_tell, timeout=False):
+    '''Return True if a checkpoint is due, as one is before a timeout at the end of the input, which may yet grow.'''
+    if not self._checkpoints or stream_tell == self._checkpoint_tell: return False
+    if timeout: return getattr(self._source.source, 'at_end', False)
+    return time.monotonic() - self._checkpoint_time >= CHECKPOINT_INTERVAL or self.stats.idle()
   
   def _step_trans_file(self):
-    if self._trans_fp: self._trans_fp.close()
     self._cur_trans_num += 1
-    self._trans_fp = open('%s_trans_%08d.bin' % (self._file_prefix, self._cur_trans_num), 'wb')
+    self._trans_tell = 0
   
   def _log_ts(self, msg):
-    msg = '%s %s\n' % (time.strftime('(%H:%M:%S)'), msg)
-    self._log_fp.write(msg)
-    sys.stdout.write(msg)
-    sys.stdout.flush()
+    if self._log_writer: self._log_writer.log(msg)
   
   def _log(self, log_num, log_dir, log_tell, msg):
     self._log_ts('%08d %s %08d: %s' % (log_num, 'DCD' if log_dir else 'Mac', log_tell, msg))
   
-  def _log_data(self, log_num, log_dir, log_tell, data):
-    self._cur_data += 1
-    preview = ' '.join(('%02X' % i) for i, _ in zip(data, range(7)))
-    self._log(log_num, log_dir, log_tell, 'Data  %08d: %s' % (self._cur_data, preview))
-    with open('%s_data_%08d_%s.bin' % (self._file_prefix, self._cur_data, 'dcd' if log_dir else 'mac'), 'wb') as fp:
-      fp.write(data)
+  def _handle(self, event):
+    '''Log an event, write out the data of a payload, and record the payload in the index and table.'''
+    if type(event) is DcdPayload:
+      preview = ' '.join(('%02X' % i) for i, _ in zip(event.payload, range(7)))
+      self._log(event.trans, event.direction, event.offset, 'Data  %08d: %s' % (event.number, preview))
+      if self._output: self._output.add(DATA, event.number, int(event.direction), event.payload)
+      for recorder in self._recorders:
+        recorder.mark('Data', 'OK', event.trans, int(event.direction), event.offset, self._trans_tell - event.offset,
+                      number=event.number)
+    elif type(event) is MarkError:
+      # not logged, as either decoder may come across one while the other is decoding the real payload
+      for recorder in self._recorders:
+        recorder.error(event.trans, int(event.direction), event.offset, event.message, self._trans_tell - event.offset)
+    elif type(event) is TransactionEnd:
+      self._log_ts('%08d end of transaction' % event.trans)
+    else:
+      self._log_ts('%08d DESYNCHRONIZED TRANSACTION' % event.trans)
   
   def _close(self):
-    self._s.close()
-    self._log_fp.close()
-    self._serial_fp.close()
-    if self._trans_fp: self._trans_fp.close()
+    self._source.close()
+    if self._log_writer: self._log_writer.close()
+    if self._output: self._output.close()
+    if self._index: self._index.close()
   
   def analyze(self):
+    '''Decode the input, logging each payload found and writing it out, until the input ends or Ctrl-C.'''
+    events = self.events()
+    try:
+      with reporting(str(self._file_prefix), self.stats, self._stats_interval, self._stats_address):
+        self.stats.consume(events, self._handle)
+    except KeyboardInterrupt:
+      events.close()
+  
+  def events(self):
+    '''Decode the input, yielding an event for each payload and the end of each transaction, until the input ends.'''
+    output = self._output
+    recorders = self._recorders
+    stream_tell = 0  # offset of the current chunk in the serial data
     mid_transaction = False
+    reply_expected = False  # whether the last payload was a command from the Macintosh
     mac_to_dcd = _MacToDcdDecoder()
     dcd_to_mac = _DcdToMacDecoder()
-    mac_to_dcd_tell = 0
-    dcd_to_mac_tell = 0
+    state, self._state = self._state, None
+    if state:
+      stream_tell, mid_transaction, reply_expected = state['stream_tell'], state['mid_transaction'], state['reply_expected']
+      mac_to_dcd.restore(state['mac_to_dcd'])
+      dcd_to_mac.restore(state['dcd_to_mac'])
     try:
       while True:
-        byte = self._s.read(1)
-        if byte:
+        if self._checkpoint_due(stream_tell):
+          self._save_checkpoint(stream_tell, mid_transaction, reply_expected, mac_to_dcd, dcd_to_mac)
+        chunk = self._source.read()
+        if not chunk:
+          if mid_transaction:
+            if self._checkpoint_due(stream_tell, timeout=True):
+              self._save_checkpoint(stream_tell, mid_transaction, reply_expected, mac_to_dcd, dcd_to_mac)
+            mid_transaction = False
+            reply_expected = False
+            mac_to_dcd.reset()
+            dcd_to_mac.reset()
+            yield TransactionEnd(self._cur_trans_num)
+          continue
+        pos = 0
+        length = len(chunk)
+        while pos < length:
           if not mid_transaction:
             mid_transaction = True
             self._step_trans_file()
-          self._serial_fp.write(byte)
-          byte_val = byte[0]
-        else:
-          if mid_transaction:
+            for recorder in recorders: recorder.transaction(self._cur_trans_num, None, stream_tell + pos)
+          tell = self._trans_tell - pos  # offset of chunk[0] within the transaction
+          # each decoder is fed up to the first byte that matters to the other: either one finding a payload resets
+          # both, and the transaction is desynchronized at the first byte at which neither one accepts data
+          mac_to_dcd_state, mac_to_dcd_end = mac_to_dcd.feed(chunk, pos, length, tell)
+          dcd_to_mac_limit = length if mac_to_dcd_state is None else mac_to_dcd_end + 1
+          dcd_to_mac_state, dcd_to_mac_end = dcd_to_mac.feed(chunk, pos, dcd_to_mac_limit, tell)
+          if mac_to_dcd_state in (DEAD, BAD) and dcd_to_mac_state is None and dcd_to_mac_limit < length:
+            dcd_to_mac_state, dcd_to_mac_end = dcd_to_mac.feed(chunk, dcd_to_mac_limit, length, tell)
+          desync = False
+          if dcd_to_mac_state == DONE and (mac_to_dcd_state != DONE or dcd_to_mac_end < mac_to_dcd_end):
+            decoder, end = dcd_to_mac, dcd_to_mac_end
+          elif mac_to_dcd_state == DONE:
+            decoder, end = mac_to_dcd, mac_to_dcd_end
+          else:
+            decoder = None
+            desync = mac_to_dcd_state in (DEAD, BAD) and dcd_to_mac_state in (DEAD, BAD)
+            end = max(mac_to_dcd_end, dcd_to_mac_end) if desync else length - 1
+          # a payload that was completed but is not valid is only worth reporting if it was the one expected next
+          if reply_expected:
+            bad_decoder, bad_state, bad_end = dcd_to_mac, dcd_to_mac_state, dcd_to_mac_end
+          else:
+            bad_decoder, bad_state, bad_end = mac_to_dcd, mac_to_dcd_state, mac_to_dcd_end
+          if bad_state == BAD:  # at or before the end of a payload that the other decoder found
+            if output: output.append(TRANSACTION, self._cur_trans_num, NO_DIRECTION, chunk[pos:bad_end + 1])
+            self._trans_tell += bad_end + 1 - pos
+            pos = bad_end + 1
+            yield MarkError(self._cur_trans_num, reply_expected, bad_decoder.sync_tell, 'Data  BAD CHECKSUM')
+          if output and pos <= end: output.append(TRANSACTION, self._cur_trans_num, NO_DIRECTION, chunk[pos:end + 1])
+          self._trans_tell += end + 1 - pos
+          pos = end + 1
+          if desync:
             mid_transaction = False
+            reply_expected = False
             mac_to_dcd.reset()
             dcd_to_mac.reset()
-            self._log_ts('%08d end of transaction' % self._cur_trans_num)
-          continue
-        mac_to_dcd_sync, mac_to_dcd_done, mac_to_dcd_hopeful = mac_to_dcd.feed_byte(byte_val)
-        dcd_to_mac_sync, dcd_to_mac_done, dcd_to_mac_hopeful = dcd_to_mac.feed_byte(byte_val)
-        if mac_to_dcd_sync: mac_to_dcd_tell = self._trans_fp.tell()
-        if dcd_to_mac_sync: dcd_to_mac_tell = self._trans_fp.tell()
-        self._trans_fp.write(byte)
-        if mac_to_dcd_done:
-          in_groups, data = mac_to_dcd.result()
-          mac_to_dcd.reset()
-          dcd_to_mac.reset(in_groups)
-          self._log_data(self._cur_trans_num, False, mac_to_dcd_tell, data)
-        elif dcd_to_mac_done:
-          in_groups, data = dcd_to_mac.result()
-          mac_to_dcd.reset()
-          dcd_to_mac.reset(in_groups)
-          self._log_data(self._cur_trans_num, True, dcd_to_mac_tell, data)
-        elif not mac_to_dcd_hopeful and not dcd_to_mac_hopeful:
-          mid_transaction = False
-          mac_to_dcd.reset()
-          dcd_to_mac.reset()
-          self._log_ts('%08d DESYNCHRONIZED TRANSACTION' % self._cur_trans_num)
-    except KeyboardInterrupt:
+            yield Desync(self._cur_trans_num)
+          elif decoder:
+            in_groups, data = decoder.result()
+            mac_to_dcd.reset()
+            dcd_to_mac.reset(in_groups)
+            reply_expected = bool(in_groups)
+            self._cur_data += 1
+            yield DcdPayload(self._cur_trans_num, decoder is dcd_to_mac, decoder.sync_tell, self._cur_data,
+                             memoryview(data))
+        stream_tell += length
+    except EOFError:
+      if self._checkpoints and stream_tell != self._checkpoint_tell:
+        self._save_checkpoint(stream_tell, mid_transaction, reply_expected, mac_to_dcd, dcd_to_mac)
+    finally:
       self._close()
@@ -2,15 +2,24 @@
 
 Protocol should be set to GCR (protocol select pin should be pulled low), GPi should be connected to !WRREQ.
 
-Requires PySerial.
+Requires PySerial (except when replaying a capture with capture.FileSource).
 '''
 
-from collections import deque
+import os
 import struct
-import sys
 import time
 
-import serial
+from capture import open_source
+import checkpoint
+from checkpoint import CHECKPOINT_INTERVAL
+from events import AddressMark, DataMark, MarkError
+from eventtable import EventTable
+from image import GCR_400K, GCR_800K, GEOMETRIES, DiskCopyImage
+from logwriter import LogWriter
+from markindex import IndexWriter, capture_of
+from pack import DATA, TRANSACTION, FileWriter, PackWriter
+from pipeline import DRAIN, FLUSH, verified
+from stats import Stats, reporting
 
 
 IWM_TO_NIBBLE = [None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
@@ -22,227 +31,429 @@ IWM_TO_NIBBLE = [None, None, None, None, None, None, None, None, None, None, Non
                  None, None, None, None, None, 0x29, 0x2A, 0x2B, None, 0x2C, 0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x32,
                  None, None, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, None, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x3E, 0x3F]
 
+INVALID_NIBBLE = 0xFF
+NIBBLE_TABLE = bytes(INVALID_NIBBLE if IWM_TO_NIBBLE[i & 0x7F] is None else IWM_TO_NIBBLE[i & 0x7F] for i in range(256))
+HI_BITS_TABLES = tuple(bytes((i << shift) & 0xC0 for i in range(256)) for shift in (2, 4, 6))
+
 
 class DenibblizeError(Exception): pass
 
 
-def denibblize(data):
-  '''Generator to denibblize data.'''
-  data = iter(data)
-  while True:
-    try:
-      hi_bits = next(data)
-    except StopIteration:
-      return
-    try:
-      yield next(data) | ((hi_bits << 2) & 0xC0)
-    except StopIteration:
-      raise DenibblizeError('denibblization ended on unused hi-bits nibble (0x%02X)' % hi_bits)
-    try:
-      yield next(data) | ((hi_bits << 4) & 0xC0)
-    except StopIteration:
-      if hi_bits & 0x0F: raise DenibblizeError('denibblization ended on partially-unused hi-bits nibble (0x%02X)' % hi_bits)
-    try:
-      yield next(data) | ((hi_bits << 6) & 0xC0)
-    except StopIteration:
-      if hi_bits & 0x03: raise DenibblizeError('denibblization ended on partially-unused hi-bits nibble (0x%02X)' % hi_bits)
-      return
+def fast_denibblize(nibbles):
+  '''Denibblize a bytes-like object of nibbles all at once.  Returns a bytearray identical to reference.denibblize's.'''
+  groups, remainder = divmod(len(nibbles), 4)
+  if remainder == 1:
+    raise DenibblizeError('denibblization ended on unused hi-bits nibble (0x%02X)' % nibbles[-1])
+  if remainder == 2 and nibbles[-2] & 0x0F:
+    raise DenibblizeError('denibblization ended on partially-unused hi-bits nibble (0x%02X)' % nibbles[-2])
+  if remainder == 3 and nibbles[-3] & 0x03:
+    raise DenibblizeError('denibblization ended on partially-unused hi-bits nibble (0x%02X)' % nibbles[-3])
+  if remainder:
+    nibbles = bytes(nibbles) + bytes(4 - remainder)
+    groups += 1
+  hi_bits = nibbles[0::4]
+  data = bytearray(groups * 3)
+  for i, table in enumerate(HI_BITS_TABLES):
+    # each nibble only has its low six bits set, so one big-integer OR combines a whole column of bytes
+    column = int.from_bytes(nibbles[i + 1::4], 'big') | int.from_bytes(hi_bits.translate(table), 'big')
+    data[i::3] = column.to_bytes(groups, 'big')
+  if remainder: del data[remainder - 4:]
+  return data
 
 
-def demangle(data):
-  '''Decoder for mangled GCR data.  Returns a 3-tuple of (demangled data, target checksum, actual checksum).'''
-  target_checksum = tuple(denibblize(data[-4:]))
-  data = bytearray(denibblize(data[:-4]))
-  view = memoryview(data)
+def fast_demangle(nibbles):
+  '''Equivalent to reference.demangle for a bytes-like object of nibbles (as from translating with NIBBLE_TABLE).'''
+  target_checksum = tuple(fast_denibblize(nibbles[-4:]))
+  data = fast_denibblize(nibbles[:-4])
+  length = len(data)
+  full = length - length % 3
   checksum_a = checksum_b = checksum_c = 0
-  carry_a = carry_b = carry_c = 0
-  for i in range((len(data) + 2) // 3):
-    trio = view[i * 3:(i + 1) * 3]
-    carry = 1 if (checksum_c & 0x80) else 0
-    checksum_c = ((checksum_c << 1) & 0xFF) | carry
-    trio[0] ^= checksum_c
-    carry, checksum_a = divmod(checksum_a + trio[0] + carry, 256)
-    if len(trio) < 2: break
-    trio[1] ^= checksum_a
-    carry, checksum_b = divmod(checksum_b + trio[1] + carry, 256)
-    if len(trio) < 3: break
-    trio[2] ^= checksum_b
-    carry, checksum_c = divmod(checksum_c + trio[2] + carry, 256)
-  actual_checksum = (checksum_a, checksum_b, checksum_c)
-  return data, target_checksum, actual_checksum
+  result = []
+  append = result.append
+  for byte_a, byte_b, byte_c in zip(data[0:full:3], data[1:full:3], data[2:full:3]):
+    checksum_c = (checksum_c << 1 | checksum_c >> 7) & 0xFF  # bit 0 of checksum_c is now the carry
+    byte_a ^= checksum_c
+    checksum_a += byte_a + (checksum_c & 1)
+    byte_b ^= checksum_a & 0xFF
+    checksum_b += byte_b + (checksum_a >> 8)
+    checksum_a &= 0xFF
+    byte_c ^= checksum_b & 0xFF
+    checksum_c = (checksum_c + byte_c + (checksum_b >> 8)) & 0xFF
+    checksum_b &= 0xFF
+    append(byte_a)
+    append(byte_b)
+    append(byte_c)
+  data[:full] = result
+  if full < length:
+    checksum_c = (checksum_c << 1 | checksum_c >> 7) & 0xFF
+    data[full] ^= checksum_c
+    checksum_a += data[full] + (checksum_c & 1)
+    if full + 1 < length:
+      data[full + 1] ^= checksum_a & 0xFF
+      checksum_b = (checksum_b + data[full + 1] + (checksum_a >> 8)) & 0xFF
+    checksum_a &= 0xFF
+  return data, target_checksum, (checksum_a, checksum_b, checksum_c)
+
+
+def verify_mark(data):
+  '''Check a candidate mark framed by Analyzer.events(), as far as can be done without knowing the marks before it.
+
+  Returns (message, consumed, value).  message is the error to log if the mark is bad.  consumed is True if the mark is
+  good enough that decoding carries on after it rather than inside it.  value is the nibbles of an address mark (even
+  one with a bad checksum), or the sector nibble and demangled data of a data mark, or None.
+  '''
+  if data[2] == 0x96:
+    if len(data) != Analyzer.ADDRESS_MARK_LENGTH:
+      return 'AM  TRUNCATED (length %d, should be %d)' % (len(data), Analyzer.ADDRESS_MARK_LENGTH), False, None
+    if not data.endswith(b'\xDE\xAA'): return 'AM  MISSING BIT SLIP BYTES', False, None
+    address_mark = tuple(data[3:8].translate(NIBBLE_TABLE))
+    if INVALID_NIBBLE in address_mark:
+      invalid_nibbles = tuple(('0x%02X' % (byte | 0x80)) for byte in data[3:8] if IWM_TO_NIBBLE[byte & 0x7F] is None)
+      return 'AM  INVALID NIBBLE(S) %s' % ', '.join(invalid_nibbles), False, None
+    track, sector, side, fmt, stored_checksum = address_mark
+    calc_checksum = track ^ sector ^ side ^ fmt
+    if stored_checksum != calc_checksum:
+      return 'AM  BAD CHECKSUM, 0x%02X != 0x%02X' % (stored_checksum, calc_checksum), False, address_mark
+    return None, True, address_mark
+  if len(data) != Analyzer.DATA_MARK_LENGTH:
+    return 'DM  TRUNCATED (length %d, should be %d)' % (len(data), Analyzer.DATA_MARK_LENGTH), False, None
+  if not data.endswith(b'\xDE\xAA'): return 'DM  MISSING BIT SLIP BYTES', False, None
+  data_mark_sector = IWM_TO_NIBBLE[data[3] & 0x7F]
+  if data_mark_sector is None: return 'DM  INVALID SECTOR NIBBLE 0x%02X' % (data[3] | 0x80), False, None
+  nibbles = data[4:707].translate(NIBBLE_TABLE)
+  if INVALID_NIBBLE in nibbles:
+    invalid_nibbles = tuple(('0x%02X' % (byte | 0x80)) for byte in data[4:707] if IWM_TO_NIBBLE[byte & 0x7F] is None)
+    return 'DM  INVALID NIBBLE(S) %s' % ', '.join(invalid_nibbles), False, None
+  # at this point, decide that this is a valid-enough data mark
+  try:
+    data, target_checksum, actual_checksum = fast_demangle(nibbles)
+  except DenibblizeError as e:
+    return 'DM  DENIBBLIZE ERROR: %s' % e.args[0], True, None
+  if target_checksum != actual_checksum:
+    return 'DM  BAD CHECKSUM: %s, should be %s' % (actual_checksum, target_checksum), True, (data_mark_sector, data)
+  return None, True, (data_mark_sector, data)
 
 
 class TransactionReader:
   
-  def __init__(self, serial_port, file_prefix):
-    self._s = serial.Serial(port=serial_port, baudrate=1000000, timeout=0.25)
+  DIR_TABLE = bytes(1 if i & 0x80 else 0 for i in range(256))
+  SET_MSB_TABLE = bytes(i | 0x80 for i in range(256))
+  
+  def __init__(self, serial_port, file_prefix, stats=None, compress=None):
+    self._source = open_source(serial_port, None if file_prefix is None else '%s_serial.bin' % file_prefix, compress)
+    if stats: self._source = stats.watch(self._source)
     self._last_dir = None
-    self._unget = None
-    self._fp = open('%s_serial.bin' % file_prefix, 'wb')
+    self._buf = b''
+    self._dirs = b''
+    self._pos = 0
+    self._eof = False
+  
+  def _fill(self):
+    while self._pos >= len(self._buf):
+      try:
+        self._buf = self._source.read()
+      except EOFError:
+        if self._eof: raise
+        self._eof = True
+        return False
+      self._pos = 0
+    self._dirs = self._buf.translate(self.DIR_TABLE)
+    return True
   
   def read(self, length):
-    retval = deque()
-    for _ in range(length):
-      if self._unget:
-        byte = self._unget
-        self._unget = None
-      else:
-        byte = b''
-        while not byte:
-          byte = self._s.read(1)
-          self._fp.write(byte)
-        byte = byte[0]
-      this_dir = True if byte & 0x80 else False
-      if self._last_dir is None: self._last_dir = this_dir
-      if this_dir != self._last_dir:
-        self._last_dir = this_dir
-        self._unget = byte
-        return not self._last_dir, bytes(i | 0x80 for i in retval)
-      retval.append(byte)
-    return this_dir, bytes(i | 0x80 for i in retval)
+    if self._pos >= len(self._buf) and not self._fill():
+      return self._last_dir, b''  # end of input, treat as the end of the transaction
+    this_dir = True if self._dirs[self._pos] else False
+    if self._last_dir is None: self._last_dir = this_dir
+    if this_dir != self._last_dir:
+      self._last_dir = this_dir
+      return not self._last_dir, b''
+    end = self._dirs.find(b'\x00' if this_dir else b'\x01', self._pos, self._pos + length)
+    if end == -1: end = min(self._pos + length, len(self._buf))
+    data = self._buf[self._pos:end].translate(self.SET_MSB_TABLE)
+    self._pos = end
+    return this_dir, data
   
   def close(self):
-    self._s.close()
-    self._fp.close()
+    self._source.close()
 
 
 class Analyzer:
   
   ADDRESS_MARK_LENGTH = 10  # D5, AA, 96, track, sector, side, format, checksum, DE, AA
   DATA_MARK_LENGTH = 709  # D5, AA, AD, sector, 703 bytes, DE, AA
+  READ_LENGTH = 65536
   
-  def __init__(self, serial_port, file_prefix):
-    self._reader = TransactionReader(serial_port, file_prefix)
+  def __init__(self, serial_port, file_prefix, pack=True, image=True, console='all', subsecond=False,
+               stats_interval=None, stats_address=None, index=True, workers=None, compress=None, checkpoints=True,
+               resume=False, table=False):
+    self.stats = Stats()
+    self._options = dict(pack=pack, image=image, index=index)  # which a checkpoint must have been saved with
+    state = checkpoint.load(file_prefix, 'gcr', **self._options) if resume and file_prefix is not None else None
+    if state:
+      checkpoint.resume_source(serial_port, state)
+    elif file_prefix is not None:
+      checkpoint.remove(file_prefix)
+    self._workers = workers  # processes verifying marks, or None to verify them on this thread
+    self._stats_interval = stats_interval
+    self._stats_address = stats_address
+    self._reader = TransactionReader(serial_port, file_prefix, self.stats, compress)
     self._file_prefix = file_prefix
-    self._log_fp = open('%s.log' % self._file_prefix, 'w')
+    self._pack = pack
+    self._make_image = image and file_prefix is not None
+    self._image = None  # created when the first sector is decoded, once the format is known
+    self._console = console
+    self._subsecond = subsecond
+    self._log_writer = self._open_log(state and state['log']) if file_prefix is not None else None
+    self._output = self._open_output(state and state['output']) if file_prefix is not None else None
+    self._index = self._open_index(state and state['index']) if file_prefix is not None and index else None
+    self._base = state['base'] if state else capture_of(self._reader._source, file_prefix)[1]  # offset of stream_tell 0
+    self.table = EventTable(self._base) if table else None  # columns of every mark, for statistics
+    self._recorders = tuple(recorder for recorder in (self._index, self.table) if recorder is not None)
     self._last_dir = None
-    self._trans_fp = None
+    self._trans_tell = 0
+    self._stream_tell = 0  # offset of the next byte read in the serial data
     self._cur_trans_num = -1
-    self._window = deque()
+    self._window = bytearray()  # unscanned data of the current transaction
+    self._window_pos = 0
+    self._window_num = self._window_dir = None
+    self._window_tell = 0  # offset of the start of the window within its transaction
     self._window_end = False
     self._cur_data_mark = -1
+    self._track = self._sector = self._side = self._fmt = None  # from the last address mark
+    self._skip_num, self._skip_tell = None, 0  # the end of the last mark decoded, before which no other is looked for
+    self._checkpoints = checkpoints and file_prefix is not None
+    self._checkpoint_tell = None  # stream_tell of the last checkpoint
+    self._checkpoint_time = time.monotonic()
+    self._final = None  # (position, framing state) at the end of the input, saved once the marks before it are handled
+    if state: self._restore(state)
+  
+  def _open_log(self, resume=None):
+    return LogWriter('%s.log' % self._file_prefix, self._console, self._subsecond, resume=resume)
+  
+  def _open_output(self, resume=None):
+    '''Return the writer for transactions and data marks: a pack, or if pack is False, one file for each.'''
+    if self._pack: return PackWriter(self._file_prefix, ('wr', 'rd'), resume=resume)
+    return FileWriter(self._file_prefix, ('wr', 'rd'), resume=resume)
+  
+  def _open_index(self, resume=None):
+    return IndexWriter(self._file_prefix, *capture_of(self._reader._source, self._file_prefix), resume=resume)
+  
+  def _frame_state(self):
+    '''Return the state of the framing of marks, up to the window position, for a checkpoint.'''
+    return dict(offset=self._base + self._stream_tell, stream_tell=self._stream_tell, reader_dir=self._reader._last_dir,
+                last_dir=self._last_dir, trans=self._cur_trans_num, trans_tell=self._trans_tell,
+                window=bytes(self._window[self._window_pos:]), window_tell=self._window_tell + self._window_pos,
+                window_num=self._window_num, window_dir=self._window_dir, window_end=self._window_end)
+  
+  def _save_checkpoint(self, frame_state=None):
+    '''Save a checkpoint, with the framing as of frame_state if given; every mark framed before then must be handled.'''
+    state = dict(frame_state or self._frame_state(), kind='gcr', options=self._options, base=self._base,
+                 data_mark=self._cur_data_mark, address_mark=(self._track, self._sector, self._side, self._fmt),
+                 skip=(self._skip_num, self._skip_tell), log=self._log_writer.checkpoint(),
+                 output=self._output.checkpoint(), index=self._index and self._index.checkpoint(),
+                 image=self._image and self._image.checkpoint())
+    checkpoint.save(self._file_prefix, state)
+    self._checkpoint_tell = state['stream_tell']
+    self._checkpoint_time = time.monotonic()
+  
+  def _checkpoint_due(self):
+    return (self._checkpoints and self._stream_tell != self._checkpoint_tell and
+            (time.monotonic() - self._checkpoint_time >= CHECKPOINT_INTERVAL or self.stats.idle()))
+  
+  def _save_final(self):
+    _, frame_state = self._final
+    self._final = None
+    self._save_checkpoint(frame_state)
+  
+  def _restore(self, state):
+    '''Carry on from where a checkpoint was saved.'''
+    self._reader._last_dir = state['reader_dir']
+    self._last_dir = state['last_dir']
+    self._stream_tell, self._cur_trans_num, self._trans_tell = state['stream_tell'], state['trans'], state['trans_tell']
+    self._window = state['window']
+    self._window_tell, self._window_num, self._window_dir = state['window_tell'], state['window_num'], state['window_dir']
+    self._window_end = state['window_end']
+    self._cur_data_mark = state['data_mark']
+    self._track, self._sector, self._side, self._fmt = state['address_mark']
+    self._skip_num, self._skip_tell = state['skip']
+    if state['image']:
+      self._image = DiskCopyImage('%s.dc42' % self._file_prefix, GEOMETRIES[state['image']['geometry']],
+                                  os.path.basename(self._file_prefix), state['image']['coverage'])
+    self._checkpoint_tell = self._stream_tell
   
   def _step_trans_file(self, this_dir):
-    if self._trans_fp: self._trans_fp.close()
     self._cur_trans_num += 1
-    self._trans_fp = open('%s_trans_%08d_%s.bin' % (self._file_prefix, self._cur_trans_num, 'rd' if this_dir else 'wr'), 'wb')
+    self._trans_tell = 0
   
   def _read_trans(self, length):
     this_dir, data = self._reader.read(length)
+    if not data: return None, None, None, b''
     if self._last_dir != this_dir:
       self._last_dir = this_dir
       self._step_trans_file(this_dir)
-    tell = self._trans_fp.tell()
-    self._trans_fp.write(data)
+      for recorder in self._recorders: recorder.transaction(self._cur_trans_num, int(this_dir), self._stream_tell)
+    tell = self._trans_tell
+    if self._output: self._output.append(TRANSACTION, self._cur_trans_num, int(this_dir), data)
+    self._trans_tell += len(data)
+    self._stream_tell += len(data)
     return self._cur_trans_num, this_dir, tell, data
   
+  def _fill_window(self):
+    '''Read more of the current transaction into the window, discarding data before the window position.
+
+    Returns False if the transaction has ended.  Marks never span transactions, so the transaction number, direction,
+    and offset of any position in the window follow from those of the start of the window.
+    '''
+    if self._window_end: return False
+    if not self.stats.queued and self._checkpoint_due(): self._save_checkpoint()
+    next_num, next_dir, next_tell, next_data = self._read_trans(self.READ_LENGTH)
+    if not next_data:
+      if self._reader._eof and self._checkpoints and self._stream_tell != self._checkpoint_tell:
+        # marks framed from here on are cut short by the end of the input, which a resumed analysis may go beyond
+        self._final = (self._window_num, self._window_tell + self._window_pos), self._frame_state()
+      self._window_end = True
+      return False
+    del self._window[:self._window_pos]
+    self._window_pos = 0
+    self._window_tell = next_tell - len(self._window)
+    self._window_num, self._window_dir = next_num, next_dir
+    self._window += next_data
+    return True
+  
+  def _end_window(self):
+    self._window.clear()
+    self._window_pos = 0
+    self._window_end = False
+  
   def _pop_window(self, length):
-    for _ in range(length):
-      if self._window: self._window.popleft()
-    if not self._window: self._window_end = False
-  
-  def _peek_window(self, length):
-    if not self._window_end:
-      while len(self._window) < length:
-        next_num, next_dir, next_tell, next_data = self._read_trans(1)
-        if not next_data:
-          self._window_end = True
-          break
-        self._window.append((next_num, next_dir, next_tell, next_data))
-    if self._window:
-      read_num, read_dir, read_tell, _ = self._window[0]
-      return read_num, read_dir, read_tell, b''.join(i[3] for _, i in zip(range(length), self._window))
-    else:
-      return None, None, None, b''
+    self._window_pos += length
   
   def _log_ts(self, msg):
-    msg = '%s %s\n' % (time.strftime('(%H:%M:%S)'), msg)
-    self._log_fp.write(msg)
-    sys.stdout.write(msg)
-    sys.stdout.flush()
+    if self._log_writer: self._log_writer.log(msg)
   
   def _log(self, log_num, log_dir, log_tell, msg):
     self._log_ts('%08d %s %08d: %s' % (log_num, 'rd' if log_dir else 'wr', log_tell, msg))
   
-  def _log_data_mark(self, log_num, log_dir, log_tell, track, sector, side, fmt, data):
-    self._cur_data_mark += 1
-    self._log(log_num, log_dir, log_tell, 'DM  %08d' % self._cur_data_mark)
-    with open('%s_data_%08d_%s.bin' % (self._file_prefix, self._cur_data_mark, 'rd' if log_dir else 'wr'), 'wb') as fp:
-      fp.write(data)
-    #TODO assemble a .dc42 image?
+  def _handle(self, event):
+    '''Log an event, write out the data of a data mark, and record the mark in the index and table.'''
+    recorders = self._recorders
+    if type(event) is MarkError:
+      self._log(event.trans, event.direction, event.offset, event.message)
+      for recorder in recorders:
+        if event.message.startswith('DM'):  # a data mark belongs to the last address mark
+          recorder.error(event.trans, int(event.direction), event.offset, event.message, self.DATA_MARK_LENGTH,
+                         self._track, self._side, self._sector)
+        else:
+          recorder.error(event.trans, int(event.direction), event.offset, event.message, self.ADDRESS_MARK_LENGTH)
+    elif type(event) is AddressMark:
+      self._log(event.trans, event.direction, event.offset,
+                'AM  tk %03d  sec %03d  side %d  fmt 0x%02X' % (event.track, event.sector, event.side, event.format))
+      for recorder in recorders:
+        recorder.mark('AM', 'OK', event.trans, int(event.direction), event.offset, self.ADDRESS_MARK_LENGTH,
+                      event.track, event.side, event.sector, event.format)
+    else:
+      self._log(event.trans, event.direction, event.offset, 'DM  %08d' % event.number)
+      if self._output:
+        self._output.add(DATA, event.number, int(event.direction), event.payload, event.track, event.side,
+                         event.sector)
+      self._write_image(event.track, event.sector, event.side, event.format, event.payload)
+      for recorder in recorders:
+        recorder.mark('DM', 'OK', event.trans, int(event.direction), event.offset, self.DATA_MARK_LENGTH, event.track,
+                      event.side, event.sector, event.format, event.number)
+  
+  def _write_image(self, track, sector, side, fmt, data):
+    if self._image is None:
+      if not self._make_image: return
+      self._image = DiskCopyImage('%s.dc42' % self._file_prefix, GCR_800K if fmt & 0x20 else GCR_400K,
+                                  os.path.basename(self._file_prefix))
+    self._image.write(track, side, sector, data[12:], data[:12])
+  
+  def _close_image(self):
+    if not self._image: return
+    covered = self._image.coverage()
+    self._log_ts('IMAGE %s  %d of %d sectors, %d missing' % (self._image.geometry.name, covered, self._image.blocks,
+                                                            self._image.blocks - covered))
+    self._image.close()
   
   def _close(self):
     self._reader.close()
-    self._log_fp.close()
+    self._close_image()
+    if self._log_writer: self._log_writer.close()
+    if self._output: self._output.close()
+    if self._index: self._index.close()
   
   def analyze(self):
+    '''Decode the input, logging each mark found and writing out the data marks, until the input ends or Ctrl-C.'''
+    events = self.events()
+    try:
+      with reporting(str(self._file_prefix), self.stats, self._stats_interval, self._stats_address):
+        self.stats.consume(events, self._handle)
+    except KeyboardInterrupt:
+      events.close()
+  
+  def _frame(self):
+    '''Generator of the candidate marks in the input, found by their signatures and lengths alone, until it ends.
+
+    Yields (transaction number, direction, offset, bytes) for each candidate, including those that a mark found before it
+    turns out to cover, and pipeline.FLUSH before reading more input (or pipeline.DRAIN, if a checkpoint is due).
+    '''
     try:
-      track = sector = side = fmt = None
       while True:
-        _, _, _, sig = self._peek_window(3)
-        if sig == b'\xD5\xAA\x96':
-          win_num, win_dir, win_tell, win_data = self._peek_window(self.ADDRESS_MARK_LENGTH)
-          if len(win_data) != self.ADDRESS_MARK_LENGTH:
-            self._log(win_num, win_dir, win_tell,
-                      'AM  TRUNCATED (length %d, should be %d)' % (len(win_data), self.ADDRESS_MARK_LENGTH))
-            self._pop_window(1)
-            continue
-          if not win_data.endswith(b'\xDE\xAA'):
-            self._log(win_num, win_dir, win_tell, 'AM  MISSING BIT SLIP BYTES')
-            self._pop_window(1)
-            continue
-          address_mark = tuple(IWM_TO_NIBBLE[byte & 0x7F] for byte in win_data[3:8])
-          if None in address_mark:
-            invalid_nibbles = tuple(('0x%02X' % (byte | 0x80)) for byte in win_data[3:8] if IWM_TO_NIBBLE[byte & 0x7F] is None)
-            self._log(win_num, win_dir, win_tell, 'AM  INVALID NIBBLE(S) %s' % ', '.join(invalid_nibbles))
-            self._pop_window(1)
-            continue
-          track, sector, side, fmt, stored_checksum = address_mark
-          calc_checksum = track ^ sector ^ side ^ fmt
-          if stored_checksum != calc_checksum:
-            self._log(win_num, win_dir, win_tell, 'AM  BAD CHECKSUM, 0x%02X != 0x%02X' % (stored_checksum, calc_checksum))
-            self._pop_window(1)
-            continue
-          track = ((side << 6) | track) & 0x7FF
-          side >>= 5
-          self._log(win_num, win_dir, win_tell, 'AM  tk %03d  sec %03d  side %d  fmt 0x%02X' % (track, sector, side, fmt))
-          self._pop_window(self.ADDRESS_MARK_LENGTH)
-        elif sig == b'\xD5\xAA\xAD':
-          win_num, win_dir, win_tell, win_data = self._peek_window(self.DATA_MARK_LENGTH)
-          if len(win_data) != self.DATA_MARK_LENGTH:
-            self._log(win_num, win_dir, win_tell,
-                      'DM  TRUNCATED (length %d, should be %d)' % (len(win_data), self.DATA_MARK_LENGTH))
-            self._pop_window(1)
-            continue
-          if not win_data.endswith(b'\xDE\xAA'):
-            self._log(win_num, win_dir, win_tell, 'DM  MISSING BIT SLIP BYTES')
-            self._pop_window(1)
-            continue
-          data_mark_sector = IWM_TO_NIBBLE[win_data[3] & 0x7F]
-          if data_mark_sector is None:
-            self._log(win_num, win_dir, win_tell, 'DM  INVALID SECTOR NIBBLE 0x%02X' % (win_data[3] | 0x80))
-            self._pop_window(1)
-            continue
-          nibbles = [IWM_TO_NIBBLE[i & 0x7F] for i in win_data[4:707]]
-          if None in nibbles:
-            invalid_nibbles = tuple(('0x%02X' % (byte | 0x80)) for byte in win_data[4:707] if IWM_TO_NIBBLE[byte & 0x7F] is None)
-            self._log(win_num, win_dir, win_tell, 'DM  INVALID NIBBLE(S) %s' % ', '.join(invalid_nibbles))
-            self._pop_window(1)
+        window = self._window
+        pos = window.find(b'\xD5\xAA', self._window_pos)
+        if pos == -1 or pos + 3 > len(window):
+          self._window_pos = max(len(window) - 1, 0) if pos == -1 else pos  # keep what may be a partial signature
+          yield DRAIN if self._checkpoint_due() else FLUSH
+          if not self._fill_window(): self._end_window()
+          continue
+        if window[pos + 2] == 0x96:
+          length = self.ADDRESS_MARK_LENGTH
+        elif window[pos + 2] == 0xAD:
+          length = self.DATA_MARK_LENGTH
+        else:
+          self._window_pos = pos + 1
+          continue
+        self._window_pos = pos
+        if pos + length > len(window):
+          yield DRAIN if self._checkpoint_due() else FLUSH
+          if self._fill_window(): continue
+        yield self._window_num, self._window_dir, self._window_tell + pos, bytes(window[pos:pos + length])
+        self._pop_window(1)
+    except EOFError:
+      pass
+  
+  def events(self):
+    '''Decode the input, yielding an event for each mark found, until the input ends.'''
+    try:
+      for (win_num, win_dir, win_tell, win_data), (message, consumed, value) in verified(self._frame(), verify_mark,
+                                                                                        self.stats, self._workers):
+        if self._final and (win_num, win_tell) >= self._final[0]: self._save_final()
+        if win_num == self._skip_num and win_tell < self._skip_tell: continue
+        if consumed: self._skip_num, self._skip_tell = win_num, win_tell + len(win_data)
+        if win_data[2] == 0x96:
+          if value: self._track, self._sector, self._side, self._fmt, _ = value
+          if message:
+            yield MarkError(win_num, win_dir, win_tell, message)
             continue
-          self._pop_window(self.DATA_MARK_LENGTH)  # at this point, decide that this is a valid-enough data mark
-          try:
-            data, target_checksum, actual_checksum = demangle(nibbles)
-          except DenibblizeError as e:
-            self._log(win_num, win_dir, win_tell, 'DM  DENIBBLIZE ERROR: %s' % e.args[0])
+          self._track = ((self._side << 6) | self._track) & 0x7FF
+          self._side >>= 5
+          yield AddressMark(win_num, win_dir, win_tell, self._track, self._sector, self._side, self._fmt)
+        else:
+          if value is None:
+            yield MarkError(win_num, win_dir, win_tell, message)
             continue
-          if data_mark_sector != sector:
-            self._log(win_num, win_dir, win_tell, 'DM  WRONG SECTOR: %d, should be %d' % (data_mark_sector, sector))
+          data_mark_sector, data = value
+          if data_mark_sector != self._sector:
+            yield MarkError(win_num, win_dir, win_tell,
+                            'DM  WRONG SECTOR: %d, should be %s' % (data_mark_sector, self._sector))
             continue
-          if target_checksum != actual_checksum:
-            self._log(win_num, win_dir, win_tell, 'DM  BAD CHECKSUM: %s, should be %s' % (actual_checksum, target_checksum))
+          if message:
+            yield MarkError(win_num, win_dir, win_tell, message)
             continue
-          self._log_data_mark(win_num, win_dir, win_tell, track, sector, side, fmt, data)
-        else:
-          self._pop_window(1)
-    except KeyboardInterrupt:
+          self._cur_data_mark += 1
+          yield DataMark(win_num, win_dir, win_tell, self._cur_data_mark, self._track, self._sector, self._side,
+                         self._fmt, memoryview(data))
+      if self._final: self._save_final()
+    finally:
       self._close()
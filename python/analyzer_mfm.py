@@ -2,54 +2,107 @@
 
 Protocol should be set to MFM (protocol select pin should be pulled high), GPi is ignored.
 
-Requires PySerial.
+Requires PySerial (except when replaying a capture with capture.FileSource).
 '''
 
-from collections import deque
+import binascii
+import os
 import struct
-import sys
 import time
 
-import serial
+from capture import open_source
+import checkpoint
+from checkpoint import CHECKPOINT_INTERVAL
+from events import AddressMark, DataMark, IndexMark, MarkError
+from eventtable import EventTable
+from image import GEOMETRIES, MFM_720K, MFM_1440K, RawImage, image_size, reshaped_coverage
+from logwriter import LogWriter
+from markindex import IndexWriter, capture_of
+from pack import DATA, NO_DIRECTION, FileWriter, PackWriter
+from pipeline import DRAIN, FLUSH, verified
+from stats import Stats, reporting
 
 class CRC16:
   
+  _tables = {}
+  
   def __init__(self, poly=0x1021, reg=0xFFFF):
     self.poly = poly
     self.reg = reg
+    if poly not in self._tables: self._tables[poly] = self._make_table(poly)
+    self._table = self._tables[poly]
+  
+  @staticmethod
+  def _make_table(poly):
+    table = []
+    for byte in range(256):
+      reg = byte << 8
+      for i in range(8): reg = reg << 1 & 0xFFFF ^ (poly if reg & 0x8000 else 0)
+      table.append(reg)
+    return table
   
   def update(self, data):
-    for byte in data:
-      self.reg = self.reg ^ byte << 8
-      for i in range(8): self.reg = self.reg << 1 & 0xFFFF ^ (self.poly if self.reg & 0x8000 else 0)
+    if self.poly == 0x1021:
+      self.reg = binascii.crc_hqx(data, self.reg)  # table-driven CRC-CCITT implemented in C
+    else:
+      reg = self.reg
+      table = self._table
+      for byte in data: reg = reg << 8 & 0xFFFF ^ table[reg >> 8 ^ byte]
+      self.reg = reg
     return self.reg
   
   def getvalue(self): return self.reg
 
 
+def check_marks(data, marks):
+  '''Verify the CRCs of many marks in one call.
+
+  marks is an iterable of (offset, length) pairs of marks in data, including their stored CRCs.  Returns a list with True
+  for each mark whose CRC checks out.
+  '''
+  view = memoryview(data)
+  crc_hqx = binascii.crc_hqx
+  return [not crc_hqx(view[offset:offset + length], 0xFFFF) for offset, length in marks]
+
+
+def verify_mark(data):
+  '''Check a candidate mark framed by Analyzer.events().  Returns the error to log if the mark is bad, or None.'''
+  if data[3] == 0xFC: return None  # an index mark has nothing to check
+  kind, length = ('AM', Analyzer.ADDRESS_MARK_LENGTH) if data[3] == 0xFE else ('DM', Analyzer.DATA_MARK_LENGTH)
+  if len(data) != length: return '%s  TRUNCATED (length %d, should be %d)' % (kind, len(data), length)
+  if binascii.crc_hqx(data, 0xFFFF): return '%s  BAD CRC' % kind
+  return None
+
+
 class TransactionReader:
   
-  def __init__(self, serial_port, file_prefix):
-    self._s = serial.Serial(port=serial_port, baudrate=1000000, timeout=0.25)
-    self._fp = open('%s_serial.bin' % file_prefix, 'wb')
+  def __init__(self, serial_port, file_prefix, stats=None, compress=None):
+    self._source = open_source(serial_port, None if file_prefix is None else '%s_serial.bin' % file_prefix, compress)
+    if stats: self._source = stats.watch(self._source)
+    self._buf = b''
+    self._pos = 0
+    self._tell = 0
+    self._eof = False
   
   def read(self, length):
-    retval = deque()
-    for _ in range(length):
-      byte = b''
-      while not byte:
-        byte = self._s.read(1)
-        self._fp.write(byte)
-      byte = byte[0]
-      retval.append(byte)
-    return bytes(retval)
+    while self._pos >= len(self._buf):
+      try:
+        self._buf = self._source.read()
+      except EOFError:
+        if self._eof: raise
+        self._eof = True
+        return b''  # end of input, so the window is drained
+      self._pos = 0
+    data = self._buf[self._pos:self._pos + length]
+    self._pos += len(data)
+    self._tell += len(data)
+    return data
   
   def tell(self):
-    return self._fp.tell()
+    return self._tell
   
   def close(self):
-    self._s.close()
-    self._fp.close()
+    self._source.close()
 
 
 class Analyzer:
@@ -57,92 +110,246 @@ class Analyzer:
   INDEX_MARK_LENGTH = 4  # C2, C2, C2, FC
   ADDRESS_MARK_LENGTH = 10  # A1, A1, A1, FE, track, sector, side, format, CRC16H, CRC16L
   DATA_MARK_LENGTH = 518  # A1, A1, A1, FB, 512 bytes, CRC16H, CRC16L
+  MARK_LENGTHS = {0xFE: ADDRESS_MARK_LENGTH, 0xFB: DATA_MARK_LENGTH}
+  READ_LENGTH = 65536
   
-  def __init__(self, serial_port, file_prefix):
-    self._reader = TransactionReader(serial_port, file_prefix)
+  def __init__(self, serial_port, file_prefix, pack=True, image=True, console='all', subsecond=False,
+               stats_interval=None, stats_address=None, index=True, workers=None, compress=None, checkpoints=True,
+               resume=False, table=False):
+    self.stats = Stats()
+    self._options = dict(pack=pack, image=image, index=index)  # which a checkpoint must have been saved with
+    state = checkpoint.load(file_prefix, 'mfm', **self._options) if resume and file_prefix is not None else None
+    if state:
+      checkpoint.resume_source(serial_port, state)
+    elif file_prefix is not None:
+      checkpoint.remove(file_prefix)
+    self._workers = workers  # processes verifying marks, or None to verify them on this thread
+    self._stats_interval = stats_interval
+    self._stats_address = stats_address
+    self._reader = TransactionReader(serial_port, file_prefix, self.stats, compress)
     self._file_prefix = file_prefix
-    self._log_fp = open('%s.log' % self._file_prefix, 'w')
-    self._window = deque()
+    self._pack = pack
+    self._make_image = image and file_prefix is not None
+    self._image = None  # created when the first sector is decoded
+    self._console = console
+    self._subsecond = subsecond
+    self._log_writer = self._open_log(state and state['log']) if file_prefix is not None else None
+    self._output = self._open_output(state and state['output']) if file_prefix is not None else None
+    self._index = self._open_index(state and state['index']) if file_prefix is not None and index else None
+    self._base = state['base'] if state else capture_of(self._reader._source, file_prefix)[1]  # offset of tell 0
+    self.table = EventTable(self._base) if table else None  # columns of every mark, for statistics
+    self._recorders = tuple(recorder for recorder in (self._index, self.table) if recorder is not None)
+    self._window = bytearray()  # unscanned data
+    self._window_pos = 0
+    self._window_tell = 0  # offset of the start of the window in the serial data
     self._window_end = False
     self._cur_data_mark = -1
+    self._track = self._sector = self._side = self._size = None  # from the last address mark
+    self._skip_tell = 0  # the end of the last mark decoded, before which no other mark is looked for
+    self._checkpoints = checkpoints and file_prefix is not None
+    self._checkpoint_tell = None  # reader tell of the last checkpoint
+    self._checkpoint_time = time.monotonic()
+    self._final = None  # (position, framing state) at the end of the input, saved once the marks before it are handled
+    if state: self._restore(state)
+  
+  def _open_log(self, resume=None):
+    return LogWriter('%s.log' % self._file_prefix, self._console, self._subsecond, resume=resume)
+  
+  def _open_output(self, resume=None):
+    '''Return the writer for data marks: a pack, or if pack is False, one file for each.'''
+    return (PackWriter if self._pack else FileWriter)(self._file_prefix, resume=resume)
+  
+  def _open_index(self, resume=None):
+    return IndexWriter(self._file_prefix, *capture_of(self._reader._source, self._file_prefix), resume=resume)
+  
+  def _frame_state(self):
+    '''Return the state of the framing of marks, up to the window position, for a checkpoint.'''
+    tell = self._reader.tell()
+    return dict(offset=self._base + tell, tell=tell, window=bytes(self._window[self._window_pos:]),
+                window_tell=self._window_tell + self._window_pos, window_end=self._window_end)
+  
+  def _save_checkpoint(self, frame_state=None):
+    '''Save a checkpoint, with the framing as of frame_state if given; every mark framed before then must be handled.'''
+    state = dict(frame_state or self._frame_state(), kind='mfm', options=self._options, base=self._base,
+                 data_mark=self._cur_data_mark, address_mark=(self._track, self._sector, self._side, self._size),
+                 skip=self._skip_tell, log=self._log_writer.checkpoint(), output=self._output.checkpoint(),
+                 index=self._index and self._index.checkpoint(), image=self._image and self._image.checkpoint())
+    checkpoint.save(self._file_prefix, state)
+    self._checkpoint_tell = state['tell']
+    self._checkpoint_time = time.monotonic()
+  
+  def _checkpoint_due(self):
+    return (self._checkpoints and self._reader.tell() != self._checkpoint_tell and
+            (time.monotonic() - self._checkpoint_time >= CHECKPOINT_INTERVAL or self.stats.idle()))
+  
+  def _save_final(self):
+    _, frame_state = self._final
+    self._final = None
+    self._save_checkpoint(frame_state)
+  
+  def _restore(self, state):
+    '''Carry on from where a checkpoint was saved.'''
+    self._reader._tell = state['tell']
+    self._window = state['window']
+    self._window_tell, self._window_end = state['window_tell'], state['window_end']
+    self._cur_data_mark = state['data_mark']
+    self._track, self._sector, self._side, self._size = state['address_mark']
+    self._skip_tell = state['skip']
+    if state['image']:
+      path = '%s.img' % self._file_prefix
+      geometry, coverage = GEOMETRIES[state['image']['geometry']], state['image']['coverage']
+      if geometry is MFM_720K and os.path.getsize(path) == image_size(RawImage, MFM_1440K):
+        coverage = reshaped_coverage(coverage, MFM_720K, MFM_1440K)  # turned out to be high density after the checkpoint
+        geometry = MFM_1440K
+      self._image = RawImage(path, geometry, coverage)
+    self._checkpoint_tell = self._reader.tell()
   
   def _read_trans(self, length):
     tell = self._reader.tell()
     data = self._reader.read(length)
     return tell, data
   
+  def _fill_window(self):
+    '''Read more data into the window, discarding data before the window position.  Returns False at end of input.'''
+    if self._window_end: return False
+    if not self.stats.queued and self._checkpoint_due(): self._save_checkpoint()
+    next_tell, next_data = self._read_trans(self.READ_LENGTH)
+    if not next_data:
+      if self._reader._eof and self._checkpoints and next_tell != self._checkpoint_tell:
+        # marks framed from here on are cut short by the end of the input, which a resumed analysis may go beyond
+        self._final = self._window_tell + self._window_pos, self._frame_state()
+      self._window_end = True
+      return False
+    del self._window[:self._window_pos]
+    self._window_pos = 0
+    self._window_tell = next_tell - len(self._window)
+    self._window += next_data
+    return True
+  
+  def _end_window(self):
+    self._window.clear()
+    self._window_pos = 0
+    self._window_end = False
+  
   def _pop_window(self, length):
-    for _ in range(length):
-      if self._window: self._window.popleft()
-    if not self._window: self._window_end = False
-  
-  def _peek_window(self, length):
-    if not self._window_end:
-      while len(self._window) < length:
-        next_tell, next_data = self._read_trans(1)
-        if not next_data:
-          self._window_end = True
-          break
-        self._window.append((next_tell, next_data))
-    if self._window:
-      read_tell, _ = self._window[0]
-      return read_tell, b''.join(i[1] for _, i in zip(range(length), self._window))
-    else:
-      return None, b''
+    self._window_pos += length
   
   def _log_ts(self, msg):
-    msg = '%s %s\n' % (time.strftime('(%H:%M:%S)'), msg)
-    self._log_fp.write(msg)
-    sys.stdout.write(msg)
-    sys.stdout.flush()
+    if self._log_writer: self._log_writer.log(msg)
   
   def _log(self, log_tell, msg):
     self._log_ts('%08d: %s' % (log_tell, msg))
   
-  def _log_data_mark(self, log_tell, track, sector, side, size, data):
-    self._cur_data_mark += 1
-    self._log(log_tell, 'DM  %08d' % self._cur_data_mark)
-    with open('%s_data_%08d.bin' % (self._file_prefix, self._cur_data_mark), 'wb') as fp: fp.write(data)
+  def _handle(self, event):
+    '''Log an event, write out the data of a data mark, and record the mark in the index and table.'''
+    recorders = self._recorders
+    if type(event) is MarkError:
+      self._log(event.offset, event.message)
+      for recorder in recorders:
+        if event.message.startswith('DM'):  # a data mark belongs to the last address mark
+          recorder.error(None, None, event.offset, event.message, self.DATA_MARK_LENGTH, self._track, self._side,
+                         self._sector)
+        else:
+          recorder.error(None, None, event.offset, event.message, self.ADDRESS_MARK_LENGTH)
+    elif type(event) is IndexMark:
+      self._log(event.offset, 'IM')
+      for recorder in recorders: recorder.mark('IM', 'OK', None, None, event.offset, self.INDEX_MARK_LENGTH)
+    elif type(event) is AddressMark:
+      self._log(event.offset,
+                'AM  tk %03d  side %d  sec %03d  size %03d' % (event.track, event.side, event.sector, event.format * 256))
+      for recorder in recorders:
+        recorder.mark('AM', 'OK', None, None, event.offset, self.ADDRESS_MARK_LENGTH, event.track, event.side,
+                      event.sector, event.format)
+    else:
+      self._log(event.offset, 'DM  %08d' % event.number)
+      if self._output:
+        self._output.add(DATA, event.number, NO_DIRECTION, event.payload, event.track, event.side, event.sector)
+      self._write_image(event.track, event.sector, event.side, event.format, event.payload)
+      for recorder in recorders:
+        recorder.mark('DM', 'OK', None, None, event.offset, self.DATA_MARK_LENGTH, event.track, event.side,
+                      event.sector, event.format, event.number)
+  
+  def _write_image(self, track, sector, side, size, data):
+    if size != 2 or track is None: return  # only 512-byte sectors make up a 720K or 1.44M image
+    if self._image is None:
+      if not self._make_image: return
+      self._image = RawImage('%s.img' % self._file_prefix, MFM_1440K if sector > 9 else MFM_720K)
+    elif sector > 9 and self._image.geometry is MFM_720K:
+      self._image.reshape(MFM_1440K)  # turned out to be a high density disk
+    self._image.write(track, side, sector, data[:512])
+  
+  def _close_image(self):
+    if not self._image: return
+    covered = self._image.coverage()
+    self._log_ts('IMAGE %s  %d of %d sectors, %d missing' % (self._image.geometry.name, covered, self._image.blocks,
+                                                            self._image.blocks - covered))
+    self._image.close()
   
   def _close(self):
     self._reader.close()
-    self._log_fp.close()
+    self._close_image()
+    if self._log_writer: self._log_writer.close()
+    if self._output: self._output.close()
+    if self._index: self._index.close()
   
   def analyze(self):
+    '''Decode the input, logging each mark found and writing out the data marks, until the input ends or Ctrl-C.'''
+    events = self.events()
+    try:
+      with reporting(str(self._file_prefix), self.stats, self._stats_interval, self._stats_address):
+        self.stats.consume(events, self._handle)
+    except KeyboardInterrupt:
+      events.close()
+  
+  def _frame(self):
+    '''Generator of the candidate marks in the input, found by their signatures and lengths alone, until it ends.
+
+    Yields (offset, bytes) for each candidate, including those that a mark found before it turns out to cover, and
+    pipeline.FLUSH before reading more input (or pipeline.DRAIN, if a checkpoint is due).
+    '''
     try:
-      track = sector = side = size = None
       while True:
-        _, sig = self._peek_window(4)
-        if sig == b'\xC2\xC2\xC2\xFC':
-          win_tell, win_data = self._peek_window(self.INDEX_MARK_LENGTH)
-          self._pop_window(self.INDEX_MARK_LENGTH)
-          self._log(win_tell, 'IM')
-        elif sig == b'\xA1\xA1\xA1\xFE':
-          win_tell, win_data = self._peek_window(self.ADDRESS_MARK_LENGTH)
-          if len(win_data) != self.ADDRESS_MARK_LENGTH:
-            self._log(win_tell, 'AM  TRUNCATED (length %d, should be %d)' % (len(win_data), self.ADDRESS_MARK_LENGTH))
-            self._pop_window(1)
-            continue
-          if CRC16().update(win_data):
-            self._log(win_tell, 'AM  BAD CRC')
-            self._pop_window(1)
-            continue
-          track, side, sector, size = tuple(win_data[4:8])
-          self._log(win_tell, 'AM  tk %03d  side %d  sec %03d  size %03d' % (track, side, sector, size * 256))
-          self._pop_window(self.ADDRESS_MARK_LENGTH)
-        elif sig == b'\xA1\xA1\xA1\xFB':
-          win_tell, win_data = self._peek_window(self.DATA_MARK_LENGTH)
-          if len(win_data) != self.DATA_MARK_LENGTH:
-            self._log(win_tell, 'DM  TRUNCATED (length %d, should be %d)' % (len(win_data), self.DATA_MARK_LENGTH))
-            self._pop_window(1)
-            continue
-          if CRC16().update(win_data):
-            self._log(win_tell, 'DM  BAD CRC')
-            self._pop_window(1)
-            continue
-          self._pop_window(self.DATA_MARK_LENGTH)
-          self._log_data_mark(win_tell, track, sector, side, size, win_data[4:])
-        else:
+        window = self._window
+        pos = window.find(b'\xA1\xA1\xA1', self._window_pos)
+        index_pos = window.find(b'\xC2\xC2\xC2\xFC', self._window_pos)
+        if index_pos != -1 and (pos == -1 or index_pos < pos): pos = index_pos
+        if pos == -1 or pos + 4 > len(window):
+          self._window_pos = max(len(window) - 3, self._window_pos) if pos == -1 else pos  # keep a partial signature
+          yield DRAIN if self._checkpoint_due() else FLUSH
+          if not self._fill_window(): self._end_window()
+          continue
+        self._window_pos = pos
+        length = self.INDEX_MARK_LENGTH if pos == index_pos else self.MARK_LENGTHS.get(window[pos + 3])
+        if not length:
           self._pop_window(1)
-    except KeyboardInterrupt:
+          continue
+        if pos + length > len(window):
+          yield DRAIN if self._checkpoint_due() else FLUSH
+          if self._fill_window(): continue
+        yield self._window_tell + pos, bytes(window[pos:pos + length])
+        self._pop_window(1)
+    except EOFError:
+      pass
+  
+  def events(self):
+    '''Decode the input, yielding an event for each mark found, until the input ends.'''
+    try:
+      for (win_tell, win_data), message in verified(self._frame(), verify_mark, self.stats, self._workers):
+        if self._final and win_tell >= self._final[0]: self._save_final()
+        if win_tell < self._skip_tell: continue
+        if message:
+          yield MarkError(None, None, win_tell, message)
+          continue
+        self._skip_tell = win_tell + len(win_data)
+        if win_data[3] == 0xFC:
+          yield IndexMark(win_tell)
+        elif win_data[3] == 0xFE:
+          self._track, self._side, self._sector, self._size = tuple(win_data[4:8])
+          yield AddressMark(None, None, win_tell, self._track, self._sector, self._side, self._size)
+        else:
+          self._cur_data_mark += 1
+          yield DataMark(None, None, win_tell, self._cur_data_mark, self._track, self._sector, self._side, self._size,
+                         memoryview(win_data)[4:])
+      if self._final: self._save_final()
+    finally:
       self._close()
@@ -0,0 +1,197 @@
+'''Decode a whole archive of captures at once.
+
+Finds every _serial.bin (or compressed _serial.binz) capture under the given files and directories, works out whether
+each one is GCR, MFM, or DCD by sampling it for the sync patterns of each, and decodes them all on worker processes, one
+capture to each, writing each one's usual output next to it with _batch added to its prefix (or under --output), so
+that the log and other output of the session that recorded it are left alone.  It prints a line for each capture as it
+is done, and when they are all done, a report of all of them together: the sectors and DCD payloads decoded, the bad
+marks, the throughput, and the error rate of each GCR and MFM track.
+
+  python3 batch.py archive/ --workers 8 --json report.json
+'''
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import os
+import sys
+import time
+
+from capture import FileSource, open_capture
+from compressed import SUFFIX
+from markindex import OK, MarkIndex
+
+
+KINDS = ('gcr', 'mfm', 'dcd')
+SAMPLES = 16  # places in a capture from which to sample it
+SAMPLE_SIZE = 1 << 16
+MIN_MATCHES = 4  # signatures to find before a capture is taken to be of a kind at all
+SET_MSB_TABLE = bytes(byte | 0x80 for byte in range(256))
+CAPTURE_SUFFIXES = ('_serial.bin', '_serial' + SUFFIX)
+BATCH_SUFFIX = '_batch'  # added to the prefix of a capture for the output written next to it
+
+
+def find_captures(paths):
+  '''Return a sorted list of the captures among paths and in the directories among them, however deeply.'''
+  captures = []
+  for path in paths:
+    if not os.path.isdir(path):
+      captures.append(path)
+      continue
+    for directory, _, names in os.walk(path):
+      captures.extend(os.path.join(directory, name) for name in names if name.endswith(CAPTURE_SUFFIXES))
+  return sorted(captures)
+
+
+def detect(path):
+  '''Return 'gcr', 'mfm', or 'dcd' for the kind of the capture at path, or None if it has too few of the sync patterns of any.
+
+  Counts the address and data mark signatures of GCR (D5 AA 96 and D5 AA AD, in either direction) and MFM (A1 A1 A1 FE
+  and A1 A1 A1 FB, and C2 C2 C2 FC index marks) and the starts of DCD commands (00 01 AA) and replies (80 AA) in a few
+  samples spread through the capture, and picks whichever kind has the most.
+  '''
+  data = open_capture(path)
+  try:
+    counts = dict.fromkeys(KINDS, 0)
+    step = max(len(data) // SAMPLES, SAMPLE_SIZE)
+    for start in range(0, len(data), step):
+      sample = data[start:start + SAMPLE_SIZE]
+      gcr = sample.translate(SET_MSB_TABLE)  # the MSB of a GCR byte is its direction
+      counts['gcr'] += gcr.count(b'\xD5\xAA\x96') + gcr.count(b'\xD5\xAA\xAD')
+      counts['mfm'] += (sample.count(b'\xA1\xA1\xA1\xFE') + sample.count(b'\xA1\xA1\xA1\xFB') +
+                        sample.count(b'\xC2\xC2\xC2\xFC'))
+      counts['dcd'] += sample.count(b'\x00\x01\xAA') + sample.count(b'\x80\xAA')
+  finally:
+    if not isinstance(data, bytes): data.close()
+  kind = max(KINDS, key=counts.get)
+  return kind if counts[kind] >= MIN_MATCHES else None
+
+
+def output_prefix(path, output=None):
+  '''Return the file prefix for the output of decoding the capture at path, in the directory output if given.'''
+  prefix = next(path[:-len(suffix)] for suffix in CAPTURE_SUFFIXES + ('',) if path.endswith(suffix))
+  return os.path.join(output, os.path.basename(prefix)) if output else prefix + BATCH_SUFFIX
+
+
+def is_session(prefix):
+  '''Return whether prefix is that of a recorded session, whose log and other output cannot be made again.'''
+  return any(os.path.exists(prefix + suffix) for suffix in CAPTURE_SUFFIXES)
+
+
+def analyze_capture(path, kind=None, output=None):
+  '''Decode one capture with the analyzer for its kind, returning a dict summarizing the results.  Runs in a worker.'''
+  result = dict(path=path, kind=kind or detect(path), size=0, seconds=0.0, sectors=0, payloads=0, marks=0, errors=0,
+                desyncs=0, tracks={}, error=None)
+  if result['kind'] is None:
+    result['error'] = 'no sync patterns found'
+    return result
+  prefix = output_prefix(path, output)
+  if is_session(prefix):
+    result['error'] = 'not overwriting the output of the recorded session %s' % prefix
+    return result
+  try:
+    module = importlib.import_module('analyzer_%s' % result['kind'])
+    analyzer = module.Analyzer(FileSource(path), prefix, console=None)
+    start = time.perf_counter()
+    analyzer.analyze()
+    result['seconds'] = time.perf_counter() - start
+    snapshot = analyzer.stats.snapshot()
+    result.update(size=snapshot['decoded'], sectors=snapshot['data_marks'], payloads=snapshot['payloads'],
+                  marks=snapshot['marks'], errors=snapshot['errors'], desyncs=snapshot['desyncs'])
+    if result['kind'] != 'dcd':
+      index = MarkIndex(prefix, path)
+      try:
+        for (track, status), count in index.count(by=('track', 'status')).items():
+          good, bad = result['tracks'].setdefault(-1 if track is None else track, [0, 0])
+          result['tracks'][-1 if track is None else track] = [good + count, bad] if status == OK else [good, bad + count]
+      finally:
+        index.close()
+  except Exception as e:
+    result['error'] = '%s: %s' % (type(e).__name__, e)
+  return result
+
+
+def analyze_batch(paths, workers=None, kind=None, output=None, progress=None):
+  '''Decode every capture found among paths on worker processes, returning a list of their results in order of path.
+
+  progress, if given, is called with each result as it comes in.
+  '''
+  if output: os.makedirs(output, exist_ok=True)
+  captures = find_captures(paths)
+  results = {}
+  with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+    futures = {executor.submit(analyze_capture, path, kind, output): path for path in captures}
+    for future in concurrent.futures.as_completed(futures):
+      results[futures[future]] = result = future.result()
+      if progress: progress(result)
+  return [results[path] for path in captures]
+
+
+def summarize(results, seconds):
+  '''Return a dict of the totals of a list of results, over the given wall-clock time.
+
+  Its tracks are keyed by kind and then by track, since track 3 of a GCR disk has nothing to do with that of an MFM one.
+  '''
+  tracks = {}
+  for result in results:
+    for track, (good, bad) in result['tracks'].items():
+      total = tracks.setdefault((result['kind'], int(track)), [0, 0])
+      total[0] += good
+      total[1] += bad
+  by_kind = {}
+  for (kind, track), (good, bad) in sorted(tracks.items()):
+    by_kind.setdefault(kind, {})[track] = dict(marks=good + bad, errors=bad, error_rate=bad / (good + bad))
+  size = sum(result['size'] for result in results)
+  return dict(captures=len(results), failed=sum(1 for result in results if result['error']), size=size,
+              seconds=seconds, mb_per_s=size / 1e6 / max(seconds, 1e-9),
+              **{name: sum(result[name] for result in results)
+                 for name in ('sectors', 'payloads', 'marks', 'errors', 'desyncs')},
+              tracks=by_kind)
+
+
+def _line(result):
+  if result['error']: return '%s: %s' % (result['path'], result['error'])
+  return ('%s: %s, %.1f MB in %.1f s (%.2f MB/s), %d sectors, %d payloads, %d marks, %d bad, %d desyncs' %
+          (result['path'], result['kind'].upper(), result['size'] / 1e6, result['seconds'],
+           result['size'] / 1e6 / max(result['seconds'], 1e-9), result['sectors'], result['payloads'], result['marks'],
+           result['errors'], result['desyncs']))
+
+
+def report(summary, stream=None):
+  '''Print a report of the summary of a batch: its totals and the error rate of each track of each kind.'''
+  stream = stream or sys.stdout
+  stream.write('\n%d captures (%d failed), %.1f MB in %.1f s (%.2f MB/s), %d sectors, %d payloads, %d marks, %d bad, '
+               '%d desyncs\n' % (summary['captures'], summary['failed'], summary['size'] / 1e6, summary['seconds'],
+                                 summary['mb_per_s'], summary['sectors'], summary['payloads'], summary['marks'],
+                                 summary['errors'], summary['desyncs']))
+  if summary['tracks']:
+    stream.write('\nkind  track     marks   bad  error rate\n')
+    for kind, tracks in summary['tracks'].items():
+      for track, counts in tracks.items():
+        stream.write('%-4s  %5s  %8d  %4d  %9.2f%%\n' % (kind.upper(), '?' if track < 0 else track, counts['marks'],
+                                                           counts['errors'], counts['error_rate'] * 100))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Decode every IWM/SWIM capture in a directory tree on worker processes.')
+  parser.add_argument('paths', nargs='+', metavar='path', help='capture, or directory to search for captures')
+  parser.add_argument('--workers', type=int, help='worker processes (default: one for each CPU)')
+  parser.add_argument('--kind', help='gcr, mfm, or dcd for every capture, rather than detecting each one')
+  parser.add_argument('--output', help='directory in which to write the output (default: next to each capture, with %s '
+                                       'added to its prefix)' % BATCH_SUFFIX)
+  parser.add_argument('--json', help='also write the results and their summary to this file as JSON')
+  args = parser.parse_args()
+  if args.kind and args.kind not in KINDS: parser.error('unknown kind %r' % args.kind)
+  start = time.perf_counter()
+  results = analyze_batch(args.paths, args.workers, args.kind, args.output,
+                          lambda result: print(_line(result), flush=True))
+  summary = summarize(results, time.perf_counter() - start)
+  report(summary)
+  if args.json:
+    with open(args.json, 'w') as fp: json.dump(dict(captures=results, summary=summary), fp, indent=2)
+  return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,164 @@
+'''Benchmarks for the IWM/SWIM analyzer decoders.
+
+Each analyzer decodes a synthetic capture (see synth.py) offline, in a process of its own, and its throughput in MB/s
+and marks/s and its peak memory use are reported.  Results can be saved as a baseline, and later runs compared against
+it; a decoder that has become slower or bigger than the baseline by more than the tolerance is reported as a
+regression, and the exit status is 1:
+
+  python3 bench.py --save            # record a baseline before a change
+  python3 bench.py                   # compare with it after the change
+  python3 bench.py --size 300 gcr    # only the GCR analyzer, on a 300 MB capture
+'''
+
+import argparse
+import importlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import analyzer_gcr
+from capture import FileSource, timestamp_path
+from events import AddressMark, DataMark, DcdPayload, IndexMark, MarkError
+from reference import demangle
+import synth
+
+
+DECODERS = ('gcr', 'mfm', 'dcd')
+SIZE = 16  # MB of capture for each decoder
+BASELINE = 'bench_baseline.json'
+TOLERANCE = 0.1  # fraction by which a result may be worse than the baseline before it is reported as a regression
+MARKS = (AddressMark, DataMark, DcdPayload, IndexMark, MarkError)
+
+
+def _rate(func, duration):
+  '''Call func repeatedly for about duration seconds and return the number of calls per second.'''
+  calls = 0
+  start = time.perf_counter()
+  deadline = start + duration
+  while True:
+    for _ in range(100): func()
+    calls += 100
+    now = time.perf_counter()
+    if now >= deadline: return calls / (now - start)
+
+
+def bench_gcr_decode(duration=1.0):
+  '''Compare sectors/second of the reference and fast GCR data mark decoders, from disk bytes to demangled data.'''
+  rng = random.Random(0)
+  nibble_to_iwm = {nibble: i | 0x80 for i, nibble in enumerate(analyzer_gcr.IWM_TO_NIBBLE) if nibble is not None}
+  nibbles = [rng.randrange(64) for _ in range(703)]
+  nibbles[696] &= 0x3C  # the last hi-bits nibble of the data only covers two bytes
+  disk_bytes = bytes(nibble_to_iwm[nibble] for nibble in nibbles)
+
+  def reference():
+    nibbles = [analyzer_gcr.IWM_TO_NIBBLE[i & 0x7F] for i in disk_bytes]
+    if None in nibbles: raise ValueError
+    return demangle(nibbles)
+
+  def fast():
+    nibbles = disk_bytes.translate(analyzer_gcr.NIBBLE_TABLE)
+    if analyzer_gcr.INVALID_NIBBLE in nibbles: raise ValueError
+    return analyzer_gcr.fast_demangle(nibbles)
+
+  if reference() != fast(): raise AssertionError('fast GCR decoder disagrees with reference decoder')
+  reference_rate = _rate(reference, duration)
+  fast_rate = _rate(fast, duration)
+  print('GCR data mark decode: reference %.0f sectors/s, fast %.0f sectors/s (%.1fx)' %
+        (reference_rate, fast_rate, fast_rate / reference_rate))
+
+
+def capture_path(directory, decoder, size, error_rate, seed):
+  '''Return the path of a synthetic capture for a decoder, writing it first if it has not been already.'''
+  path = os.path.join(directory, 'synth_%s_%dM_%g_%d_serial.bin' % (decoder, size, error_rate, seed))
+  if not os.path.exists(path):
+    partial = path[:-len('.bin')] + '.part.bin'  # so that an interrupted run is not taken for a finished capture
+    synth.write_capture(partial, decoder, size << 20, error_rate, seed)
+    if decoder == 'dcd': os.replace(timestamp_path(partial), timestamp_path(path))
+    os.replace(partial, path)
+  return path
+
+
+def decode(decoder, path):
+  '''Decode a capture offline with a decoder's analyzer and return its results; peak RSS is that of this process.'''
+  module = importlib.import_module('analyzer_%s' % decoder)
+  size = os.path.getsize(path)
+  marks = 0
+  start = time.perf_counter()
+  for event in module.Analyzer(FileSource(path), None).events():
+    if isinstance(event, MARKS): marks += 1
+  elapsed = time.perf_counter() - start
+  return {'mb_per_s': size / elapsed / (1 << 20), 'marks_per_s': marks / elapsed, 'marks': marks,
+          'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def bench_decoder(decoder, path, repeat=1):
+  '''Decode a capture in a fresh process repeat times and return the best results.'''
+  best = None
+  for _ in range(repeat):
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), '--decode', decoder, path],
+                             stdout=subprocess.PIPE, check=True)
+    result = json.loads(process.stdout)
+    if best is None or result['mb_per_s'] > best['mb_per_s']: best = result
+  return best
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+  '''Return a list of descriptions of the results that are worse than the baseline by more than tolerance.'''
+  found = []
+  for decoder, result in results.items():
+    if decoder not in baseline: continue
+    base = baseline[decoder]
+    for key, higher_is_better in (('mb_per_s', True), ('marks_per_s', True), ('peak_rss_mb', False)):
+      ratio = result[key] / base[key] if base[key] else 1.0
+      if (ratio < 1 - tolerance) if higher_is_better else (ratio > 1 + tolerance):
+        found.append('%s %s %.1f, baseline %.1f (%+.0f%%)' % (decoder, key, result[key], base[key], (ratio - 1) * 100))
+  return found
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the IWM/SWIM analyzer decoders on synthetic captures.')
+  parser.add_argument('decoders', nargs='*', metavar='decoder', help='gcr, mfm, or dcd (default: all three)')
+  parser.add_argument('--size', type=int, default=SIZE, help='MB of capture for each decoder (default: %d)' % SIZE)
+  parser.add_argument('--error-rate', type=float, default=synth.ERROR_RATE, help='fault injection rate')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=1, help='runs of each decoder, of which the best is taken')
+  parser.add_argument('--captures', default=os.path.join(tempfile.gettempdir(), 'iwm_bench'),
+                      help='directory in which to keep the synthetic captures')
+  parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: %s)' % BASELINE)
+  parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+  parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+  parser.add_argument('--micro', action='store_true', help='also run the GCR data mark micro-benchmark')
+  parser.add_argument('--decode', nargs=2, help=argparse.SUPPRESS)  # decoder and path, for the child processes
+  args = parser.parse_args()
+  if args.decode:
+    json.dump(decode(*args.decode), sys.stdout)
+    return 0
+  for decoder in args.decoders:
+    if decoder not in DECODERS: parser.error('unknown decoder %r' % decoder)
+  if args.micro: bench_gcr_decode()
+  os.makedirs(args.captures, exist_ok=True)
+  results = {}
+  for decoder in args.decoders or DECODERS:
+    path = capture_path(args.captures, decoder, args.size, args.error_rate, args.seed)
+    results[decoder] = result = bench_decoder(decoder, path, args.repeat)
+    print('%s: %.2f MB/s, %.0f marks/s, peak RSS %.1f MB' %
+          (decoder, result['mb_per_s'], result['marks_per_s'], result['peak_rss_mb']))
+  if args.save:
+    with open(args.baseline, 'w') as fp: json.dump(results, fp, indent=2, sort_keys=True)
+    print('saved baseline to %s' % args.baseline)
+    return 0
+  if not os.path.exists(args.baseline): return 0
+  with open(args.baseline) as fp: baseline = json.load(fp)
+  found = regressions(results, baseline, args.tolerance)
+  for regression in found: print('REGRESSION: %s' % regression)
+  if not found: print('no regressions against %s' % args.baseline)
+  return 1 if found else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,384 @@
+'''Byte sources for the IWM/SWIM analyzers.
+
+A byte source has a read() method, which returns the next available run of bytes (or an empty bytes object if nothing
+arrived within the serial timeout) and raises EOFError once the source is exhausted, and a close() method.  Any of the
+analyzers can be given a byte source in place of a serial port name, for example to replay a previous session:
+
+  Analyzer(FileSource('test_serial.bin'), 'replay').analyze()
+
+Live captures also write a _serial.ts sidecar recording when each run of bytes arrived and where the serial port timed
+out, which FileSource uses to reproduce the timeouts (and so the DCD analyzer's transaction boundaries) on replay.  A
+capture can be compressed as it is written (see compressed.py), and FileSource replays a compressed capture just the
+same.  With follow=True, FileSource follows a capture that is still being written, like tail -f (see checkpoint.py).
+'''
+
+from bisect import bisect_left
+from collections import deque
+import mmap
+import os
+import struct
+import threading
+import time
+
+from compressed import SUFFIX, BlockReader, BlockWriter, compressed_path, is_compressed
+
+
+SERIAL_TIMEOUT = 0.25  # seconds; the DCD analyzer relies on this to detect the end of a transaction
+RAW_FLUSH_INTERVAL = 5.0  # seconds; the raw log is flushed at the first timeout after this long
+REPLAY_CHUNK_SIZE = 1 << 20  # bytes returned by each read of a FileSource, by default
+
+TIMESTAMP_MAGIC = b'IWMTS\x00\x00\x01'
+TIMESTAMP_HEADER = struct.Struct('<8sqq')
+TIMESTAMP_RECORD = struct.Struct('<qQ')
+TIMEOUT_FLAG = 1 << 63
+
+
+class SerialSource:
+  '''Reads from the analyzer's serial port.  Requires PySerial.'''
+
+  REPLAY = False
+
+  def __init__(self, serial_port):
+    import serial  # imported here so that captures can be replayed without PySerial installed
+    self._s = serial.Serial(port=serial_port, baudrate=1000000, timeout=SERIAL_TIMEOUT)
+
+  def read(self):
+    return self._s.read(self._s.in_waiting or 1)
+
+  @property
+  def backlog(self):
+    '''Number of bytes waiting in the serial port's buffer.'''
+    return self._s.in_waiting
+
+  def close(self):
+    self._s.close()
+
+
+class TimestampWriter:
+  '''Writes the _serial.ts sidecar for a capture.
+
+  The file starts with a header of a magic number and the wall clock and monotonic clock times in nanoseconds when the
+  capture started.  It is followed by fixed-width records of the monotonic time in nanoseconds since the start of the
+  capture and the offset in the capture at which a run of bytes arrived; the most significant bit of the offset is set
+  for a record of the serial port timing out.
+  '''
+
+  def __init__(self, path):
+    self._fp = open(path, 'wb')
+    self._start = time.monotonic_ns()
+    self._fp.write(TIMESTAMP_HEADER.pack(TIMESTAMP_MAGIC, time.time_ns(), self._start))
+
+  def data(self, offset):
+    self._fp.write(TIMESTAMP_RECORD.pack(time.monotonic_ns() - self._start, offset))
+
+  def timeout(self, offset):
+    self._fp.write(TIMESTAMP_RECORD.pack(time.monotonic_ns() - self._start, offset | TIMEOUT_FLAG))
+
+  def close(self):
+    self._fp.close()
+
+
+class TimestampIndex:
+  '''Reads the _serial.ts sidecar of a capture without loading it into memory.'''
+
+  def __init__(self, path):
+    self._fp = open(path, 'rb')
+    size = os.fstat(self._fp.fileno()).st_size
+    self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    if size < TIMESTAMP_HEADER.size: raise ValueError('%s is not a timestamp sidecar' % path)
+    magic, self.start_time_ns, _ = TIMESTAMP_HEADER.unpack_from(self._mm)
+    if magic != TIMESTAMP_MAGIC: raise ValueError('%s is not a timestamp sidecar' % path)
+    self._count = (size - TIMESTAMP_HEADER.size) // TIMESTAMP_RECORD.size
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    '''Return a record as a tuple of (wall clock time in seconds, offset in the capture, whether it is a timeout).'''
+    if not 0 <= index < self._count: raise IndexError(index)
+    time_ns, offset = TIMESTAMP_RECORD.unpack_from(self._mm, TIMESTAMP_HEADER.size + index * TIMESTAMP_RECORD.size)
+    return (self.start_time_ns + time_ns) / 1e9, offset & ~TIMEOUT_FLAG, bool(offset & TIMEOUT_FLAG)
+
+  def offset_at(self, wall_time):
+    '''Return the offset in the capture of the first byte that arrived at or after the given time.time() value.'''
+    index = bisect_left(_RecordKeys(self, 0), wall_time)
+    return self[index][1] if index < self._count else None
+
+  def time_at(self, offset):
+    '''Return the time.time() value at which the byte at the given offset in the capture arrived.'''
+    index = bisect_left(_RecordKeys(self, 1), offset + 1) - 1
+    while index > 0 and self[index][2]: index -= 1
+    return self[index][0] if index >= 0 else None
+
+  def timeouts(self, start=0):
+    '''Yield the offsets in the capture, at or after start, at which the serial port timed out.'''
+    for index in range(bisect_left(_RecordKeys(self, 1), start), self._count):
+      _, offset, timeout = self[index]
+      if timeout: yield offset
+
+  def close(self):
+    if self._mm: self._mm.close()
+    self._fp.close()
+
+
+class _RecordKeys:
+  '''Sequence view of one field of the records in a TimestampIndex, for bisection.'''
+
+  def __init__(self, index, field):
+    self._index = index
+    self._field = field
+
+  def __len__(self):
+    return len(self._index)
+
+  def __getitem__(self, i):
+    return self._index[i][self._field]
+
+
+def timestamp_path(path):
+  '''Return the path of the timestamp sidecar for the given _serial.bin (or _serial.binz) path.'''
+  for suffix in ('.bin', SUFFIX):
+    if path.endswith(suffix): return path[:-len(suffix)] + '.ts'
+  return path + '.ts'
+
+
+def open_capture(path):
+  '''Return the bytes of a raw capture: memory-mapped, or read through a BlockReader if it is compressed.'''
+  if is_compressed(path): return BlockReader(path)
+  with open(path, 'rb') as fp:
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fp.fileno()).st_size else b''
+
+
+class FileSource:
+  '''Replays a _serial.bin (or compressed _serial.binz) file from a previous session as fast as it can be consumed.
+
+  If start and end are given, only that range of the file is replayed; TimestampIndex.offset_at can be used to find the
+  start for a given time.  If the capture has a timestamp sidecar (or one is given), the serial port timeouts it records
+  are reproduced.
+
+  If follow is True (and no end is given), the source does not end with the file but waits for it to grow, as a live
+  source would, until the analyzer is stopped.  The timeouts are those of the sidecar as it grows; without one, each time
+  nothing more has been written within the serial timeout counts as a timeout.
+  '''
+
+  def __init__(self, path, chunk_size=REPLAY_CHUNK_SIZE, start=0, end=None, timestamps=None, follow=False):
+    self.path = path
+    self.start = start
+    self.REPLAY = not follow  # a followed capture is read as it is written, like a live source
+    self._follow = follow and end is None
+    self._mm = open_capture(path)
+    self._size = os.path.getsize(path)
+    self._chunk_size = chunk_size
+    self._pos = start
+    self._limit = end
+    self._end = len(self._mm) if end is None else min(end, len(self._mm))
+    self._eof = False
+    if timestamps is None and os.path.exists(timestamp_path(path)): timestamps = timestamp_path(path)
+    self._timestamps_path = timestamps
+    self._timestamps = TimestampIndex(timestamps) if timestamps else None
+    self._timestamps_size = os.path.getsize(timestamps) if timestamps else 0  # as mapped, to tell when it grows
+    self._timeouts = self._timestamps.timeouts(start) if timestamps else iter(())
+    self._next_timeout = next(self._timeouts, None)
+
+  def seek(self, offset):
+    '''Carry on replaying from the given offset in the capture, as when resuming from a checkpoint.'''
+    if offset > len(self._mm): raise ValueError('%s is shorter than %d bytes' % (self.path, offset))
+    self.start = self._pos = offset
+    self._eof = False
+    if self._timestamps:
+      self._timeouts = self._timestamps.timeouts(offset)
+      self._next_timeout = next(self._timeouts, None)
+
+  @property
+  def received(self):
+    '''Number of bytes of the capture there are to replay, from where replaying started.'''
+    return self._end - self.start
+
+  @property
+  def at_end(self):
+    '''True if everything there is to replay has been read.'''
+    return self._pos >= self._end
+
+  def _refresh(self):
+    '''Map the capture and its sidecar again if they have grown, in follow mode.  Returns True if either has.'''
+    grown = False
+    size = os.path.getsize(self.path)
+    if size != self._size:
+      mm = open_capture(self.path)
+      if not isinstance(self._mm, bytes): self._mm.close()
+      self._mm, self._size, self._end = mm, size, len(mm)
+      grown = True
+    if self._timestamps_path is None and os.path.exists(timestamp_path(self.path)):
+      self._timestamps_path = timestamp_path(self.path)
+    size = os.path.getsize(self._timestamps_path) if self._timestamps_path else 0
+    if size != self._timestamps_size and size >= TIMESTAMP_HEADER.size:
+      if self._timestamps: self._timestamps.close()
+      self._timestamps = TimestampIndex(self._timestamps_path)
+      self._timestamps_size = size
+      self._timeouts = self._timestamps.timeouts(self._pos)
+      self._next_timeout = next(self._timeouts, None)
+      grown = True
+    return grown
+
+  def read(self):
+    while self._follow and self._pos >= self._end and (self._next_timeout is None or self._next_timeout > self._pos):
+      time.sleep(SERIAL_TIMEOUT)
+      if not self._refresh() and not self._timestamps: return b''  # nothing arrived, as if the serial port timed out
+    if self._next_timeout is not None and self._next_timeout <= self._pos:
+      self._next_timeout = next(self._timeouts, None)
+      return b''
+    if self._pos >= self._end:
+      if self._eof: raise EOFError
+      self._eof = True
+      return b''  # behave as if the serial port timed out, so whatever is in progress gets ended
+    end = min(self._pos + self._chunk_size, self._end)
+    if self._next_timeout is not None: end = min(end, self._next_timeout)
+    data = self._mm[self._pos:end]
+    self._pos += len(data)
+    return data
+
+  def close(self):
+    if not isinstance(self._mm, bytes): self._mm.close()
+    if self._timestamps: self._timestamps.close()
+
+
+class CaptureThread:
+  '''Drains a live byte source on a dedicated thread into a preallocated ring buffer, writing the raw log in bulk.
+
+  This is itself a byte source; the analyzer decodes from the ring buffer while the thread keeps the serial port drained.
+  Timeouts of the underlying source are recorded at their position in the stream and replayed to the analyzer in order,
+  and if raw_path is given, to its timestamp sidecar.  If compress is 'zlib' or 'lzma', the raw log is compressed (see
+  compressed.py) and written to a _serial.binz file in place of raw_path.
+  '''
+
+  REPLAY = False
+
+  def __init__(self, source, raw_path=None, size=1 << 24, compress=None):
+    self._source = source
+    self._ring = bytearray(size)
+    self._head = 0  # total bytes captured
+    self._tail = 0  # total bytes handed to the analyzer
+    self._gaps = deque()  # stream offsets at which the source timed out
+    self._last_timeout = None
+    self._eof = False
+    self._stop = False
+    self._error = None
+    self.max_lag = 0
+    self.stalls = 0  # number of times the ring buffer was full and the thread had to wait for the analyzer
+    self._cond = threading.Condition()
+    self.path = compressed_path(raw_path) if raw_path and compress else raw_path  # of the raw log
+    if not raw_path:
+      self._raw_fp = None
+    elif compress:
+      self._raw_fp = BlockWriter(self.path, compress)
+    else:
+      self._raw_fp = open(raw_path, 'wb')
+    self._last_flush = time.monotonic()
+    self._timestamps = TimestampWriter(timestamp_path(raw_path)) if raw_path else None
+    self._thread = threading.Thread(target=self._run, name='capture', daemon=True)
+    self._thread.start()
+
+  def _put(self, data):
+    size = len(self._ring)
+    view = memoryview(data)
+    while view:
+      with self._cond:
+        while self._head - self._tail == size and not self._stop:
+          self.stalls += 1
+          self._cond.wait()
+        if self._stop: return
+        start = self._head % size
+        length = min(len(view), size - (self._head - self._tail), size - start)
+        self._ring[start:start + length] = view[:length]
+        self._head += length
+        self.max_lag = max(self.max_lag, self._head - self._tail)
+        self._cond.notify_all()
+      view = view[length:]
+
+  def _run(self):
+    try:
+      while not self._stop:
+        try:
+          data = self._source.read()
+        except EOFError:
+          break
+        if data:
+          if self._timestamps: self._timestamps.data(self._head)
+          self._put(data)
+          if self._raw_fp: self._raw_fp.write(data)
+        else:
+          if self._last_timeout == self._head: continue  # only the first of consecutive timeouts matters
+          self._last_timeout = self._head
+          with self._cond:
+            self._gaps.append(self._head)
+            self._cond.notify_all()
+          if self._timestamps: self._timestamps.timeout(self._head)
+          if self._raw_fp and time.monotonic() - self._last_flush >= RAW_FLUSH_INTERVAL:
+            self._raw_fp.flush()  # so an idle drive leaves the raw log up to date
+            self._last_flush = time.monotonic()
+    except Exception as e:
+      self._error = e
+    finally:
+      with self._cond:
+        self._eof = True
+        self._cond.notify_all()
+
+  @property
+  def received(self):
+    '''Number of bytes received from the wire.'''
+    return self._head
+
+  @property
+  def backlog(self):
+    '''Number of bytes waiting in the underlying source, if it can tell.'''
+    return getattr(self._source, 'backlog', 0)
+
+  @property
+  def lag(self):
+    '''Number of bytes received from the wire that the analyzer has not yet consumed.'''
+    return self._head - self._tail
+
+  @property
+  def consumed(self):
+    '''Number of bytes the analyzer has consumed.'''
+    return self._tail
+
+  def read(self):
+    with self._cond:
+      while True:
+        if self._gaps and self._gaps[0] == self._tail:
+          self._gaps.popleft()
+          return b''
+        if self._head > self._tail: break
+        if self._eof:
+          if self._error: raise self._error
+          raise EOFError
+        self._cond.wait(SERIAL_TIMEOUT)  # wait in slices so KeyboardInterrupt is not held off
+      limit = min(self._head, self._gaps[0]) if self._gaps else self._head
+      size = len(self._ring)
+      start = self._tail % size
+      length = min(limit - self._tail, size - start)
+      data = bytes(self._ring[start:start + length])
+      self._tail += length
+      self._cond.notify_all()
+      return data
+
+  def close(self):
+    with self._cond:
+      self._stop = True
+      self._cond.notify_all()
+    self._thread.join()
+    self._source.close()
+    if self._raw_fp: self._raw_fp.close()
+    if self._timestamps: self._timestamps.close()
+
+
+def open_source(serial_port, raw_path=None, compress=None):
+  '''Return a byte source for the given serial port name or byte source.
+
+  Live sources are drained by a CaptureThread (unless given one already), which also logs the raw data to raw_path if
+  given, compressed if compress is 'zlib' or 'lzma'.  A FileSource following a capture is read directly.
+  '''
+  source = SerialSource(serial_port) if isinstance(serial_port, str) else serial_port
+  if source.REPLAY or isinstance(source, (CaptureThread, FileSource)): return source
+  return CaptureThread(source, raw_path, compress=compress)
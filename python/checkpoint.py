@@ -0,0 +1,72 @@
+'''Checkpoints of the decoding state of the IWM/SWIM analyzers, so that an analysis can carry on where it left off.
+
+While decoding with a file prefix, each analyzer saves a checkpoint to _checkpoint.json every CHECKPOINT_INTERVAL
+seconds, whenever it catches up with a live or followed source, and when the input ends.  A checkpoint holds the offset
+in the capture up to which the input has been decoded, the state of the decoder at that offset (the unscanned window and
+the last address mark for GCR and MFM, both decoders for DCD), the transaction and data mark counters, and the size of
+each output file.  It is only saved once every mark before that offset has been logged and written out, so the output
+files hold exactly what was decoded from the capture up to the offset.
+
+An analyzer created with resume=True and a FileSource loads the checkpoint (if there is one), cuts its output files back
+to their sizes in it, discarding whatever an interrupted run wrote after it, and decodes the capture from its offset on,
+numbering transactions and data marks on from where it left off.  Given a FileSource that follows a growing capture, it
+goes on to decode new bytes as they are written, and can be stopped and resumed at any time:
+
+  Analyzer(FileSource('test_serial.bin', follow=True), 'test', resume=True).analyze()
+'''
+
+import base64
+import json
+import os
+
+
+CHECKPOINT_INTERVAL = 10.0  # seconds
+
+
+def checkpoint_path(file_prefix):
+  return '%s_checkpoint.json' % file_prefix
+
+
+class _Encoder(json.JSONEncoder):
+
+  def default(self, value):
+    if isinstance(value, (bytes, bytearray)): return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    return super().default(value)
+
+
+def _decode(obj):
+  return bytearray(base64.b64decode(obj['__bytes__'])) if '__bytes__' in obj else obj
+
+
+def save(file_prefix, state):
+  '''Save a checkpoint, replacing the last one only once it has been written in full.'''
+  path = checkpoint_path(file_prefix)
+  with open(path + '.tmp', 'w') as fp: json.dump(state, fp, cls=_Encoder)
+  os.replace(path + '.tmp', path)
+
+
+def load(file_prefix, kind, **options):
+  '''Return the last checkpoint saved by the given kind of analyzer, or None if there is none.
+
+  Raises ValueError if the checkpoint was saved by another kind of analyzer, or with other output options, as the output
+  files could not then be carried on with.
+  '''
+  path = checkpoint_path(file_prefix)
+  if not os.path.exists(path): return None
+  with open(path) as fp: state = json.load(fp, object_hook=_decode)
+  if state['kind'] != kind: raise ValueError('%s is a checkpoint of a %s analyzer' % (path, state['kind'].upper()))
+  for name, value in options.items():
+    if state['options'][name] != value: raise ValueError('%s was saved with %s=%r' % (path, name, state['options'][name]))
+  return state
+
+
+def remove(file_prefix):
+  '''Remove the checkpoint of an earlier analysis, which a new one would not match.'''
+  path = checkpoint_path(file_prefix)
+  if os.path.exists(path): os.unlink(path)
+
+
+def resume_source(source, state):
+  '''Move a FileSource on to the offset of a checkpoint.'''
+  if not hasattr(source, 'seek'): raise ValueError('only the analysis of a capture file (a FileSource) can be resumed')
+  source.seek(state['offset'])
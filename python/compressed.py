@@ -0,0 +1,236 @@
+'''Seekable compressed storage of raw captures.
+
+An idle drive streams little but self-sync and gap bytes, which compress very well, so a live capture can be written to
+a _serial.binz file in place of _serial.bin (pass compress='zlib' or compress='lzma' to an analyzer).  The file starts
+with a header of a magic number, the codec, and the block size, followed by frames of a header of the compressed and
+uncompressed lengths and a block of the capture compressed on its own.  The blocks are compressed on a thread of their
+own, so writing is never held up by compression.  When the file is closed, an index of the blocks is appended as a final
+frame (with an uncompressed length of zero), followed by a trailer of the offset of that frame and another magic number;
+a file that was never closed is indexed by walking its frames instead, so it loses no more than the block in progress.
+
+BlockReader reads a _serial.binz file as if it were the bytes of the capture, decompressing only the blocks that a read
+touches, so FileSource, MarkIndex, and analyze_parallel can all use one directly.  To convert a capture either way:
+
+  python3 compressed.py test_serial.bin [zlib|lzma]
+  python3 compressed.py test_serial.binz
+'''
+
+from bisect import bisect_right
+from collections import OrderedDict
+import lzma
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+
+SUFFIX = '.binz'
+BLOCK_SIZE = 1 << 20  # uncompressed bytes in each block
+CACHED_BLOCKS = 4  # decompressed blocks a reader keeps
+QUEUED_BLOCKS = 16  # blocks waiting to be compressed before writing waits for them
+
+BLOCK_MAGIC = b'IWMBZ\x00\x00\x01'
+BLOCK_HEADER = struct.Struct('<8sII')
+FRAME_HEADER = struct.Struct('<II')
+INDEX_RECORD = struct.Struct('<QQII')  # uncompressed offset, offset of the compressed block, and both lengths
+TRAILER_MAGIC = b'IWMBZEND'
+TRAILER = struct.Struct('<Q8s')
+
+ZLIB = 1
+LZMA = 2
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+_COMPRESS = {ZLIB: lambda data: zlib.compress(data, 6), LZMA: lambda data: lzma.compress(data, preset=1)}
+_DECOMPRESS = {ZLIB: zlib.decompress, LZMA: lzma.decompress}
+
+
+def compressed_path(path):
+  '''Return the path of the compressed capture in place of the given _serial.bin path.'''
+  return (path[:-4] if path.endswith('.bin') else path) + SUFFIX
+
+
+def is_compressed(path):
+  with open(path, 'rb') as fp: return fp.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC
+
+
+class BlockWriter:
+  '''Writes a compressed capture a block at a time, compressing the blocks on a thread of its own.'''
+
+  def __init__(self, path, codec='zlib', block_size=BLOCK_SIZE):
+    self._codec = CODECS[codec]
+    self._block_size = block_size
+    self._fp = open(path, 'wb')
+    self._fp.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self._codec, block_size))
+    self._block = bytearray()
+    self._index = []
+    self._raw_offset = 0
+    self._queue = queue.Queue(QUEUED_BLOCKS)
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='compress', daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    compress = _COMPRESS[self._codec]
+    while True:
+      block = self._queue.get()
+      if block is None: break
+      if self._error: continue
+      try:
+        data = compress(block)
+        self._fp.write(FRAME_HEADER.pack(len(data), len(block)))
+        self._index.append(INDEX_RECORD.pack(self._raw_offset, self._fp.tell(), len(data), len(block)))
+        self._fp.write(data)
+        self._fp.flush()
+        self._raw_offset += len(block)
+      except Exception as e:
+        self._error = e
+
+  def write(self, data):
+    if self._error: raise self._error
+    self._block += data
+    while len(self._block) >= self._block_size:
+      self._queue.put(bytes(self._block[:self._block_size]))
+      del self._block[:self._block_size]
+
+  def flush(self):
+    '''End the block in progress, so that it is written out even if the file is never closed.'''
+    if self._block:
+      self._queue.put(bytes(self._block))
+      self._block.clear()
+
+  def close(self):
+    self.flush()
+    self._queue.put(None)
+    self._thread.join()
+    if not self._error:
+      index = b''.join(self._index)
+      index_offset = self._fp.tell()
+      self._fp.write(FRAME_HEADER.pack(len(index), 0))
+      self._fp.write(index)
+      self._fp.write(TRAILER.pack(index_offset, TRAILER_MAGIC))
+    self._fp.close()
+    if self._error: raise self._error
+
+
+class BlockReader:
+  '''Reads a compressed capture as a sequence of bytes, decompressing only the blocks each read touches.
+
+  Supports len(), indexing and slicing (which return an int and bytes, as for a memory-mapped capture), and find().
+  '''
+
+  def __init__(self, path):
+    self.path = path
+    self._fp = open(path, 'rb')
+    magic, self._codec, self.block_size = BLOCK_HEADER.unpack(self._fp.read(BLOCK_HEADER.size))
+    if magic != BLOCK_MAGIC: raise ValueError('%s is not a compressed capture' % path)
+    self._decompress = _DECOMPRESS[self._codec]
+    records = self._read_index()
+    self._starts = [record[0] for record in records]
+    self._blocks = [record[1:] for record in records]
+    self._length = records[-1][0] + records[-1][3] if records else 0
+    self._cache = OrderedDict()  # block number -> decompressed block, least recently used first
+
+  def _read_index(self):
+    size = os.fstat(self._fp.fileno()).st_size
+    if size >= BLOCK_HEADER.size + FRAME_HEADER.size + TRAILER.size:
+      self._fp.seek(size - TRAILER.size)
+      index_offset, magic = TRAILER.unpack(self._fp.read(TRAILER.size))
+      if magic == TRAILER_MAGIC:
+        self._fp.seek(index_offset)
+        index_length, _ = FRAME_HEADER.unpack(self._fp.read(FRAME_HEADER.size))
+        return list(INDEX_RECORD.iter_unpack(self._fp.read(index_length)))
+    records = []  # the file was not closed, so walk its frames, up to the first incomplete one
+    offset = BLOCK_HEADER.size
+    raw_offset = 0
+    while offset + FRAME_HEADER.size <= size:
+      self._fp.seek(offset)
+      compressed_length, raw_length = FRAME_HEADER.unpack(self._fp.read(FRAME_HEADER.size))
+      offset += FRAME_HEADER.size
+      if not raw_length or offset + compressed_length > size: break
+      records.append((raw_offset, offset, compressed_length, raw_length))
+      offset += compressed_length
+      raw_offset += raw_length
+    return records
+
+  def __len__(self):
+    return self._length
+
+  def _block(self, number):
+    block = self._cache.get(number)
+    if block is None:
+      offset, compressed_length, _ = self._blocks[number]
+      self._fp.seek(offset)
+      block = self._decompress(self._fp.read(compressed_length))
+      self._cache[number] = block
+      if len(self._cache) > CACHED_BLOCKS: self._cache.popitem(last=False)
+    else:
+      self._cache.move_to_end(number)
+    return block
+
+  def read(self, start, end):
+    '''Return the bytes of the capture from start to end.'''
+    start = max(start, 0)
+    end = min(end, self._length)
+    if start >= end: return b''
+    number = bisect_right(self._starts, start) - 1
+    pieces = []
+    while start < end:
+      block_start = self._starts[number]
+      block = self._block(number)
+      pieces.append(block[start - block_start:end - block_start])
+      start = block_start + len(block)
+      number += 1
+    return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, stop, step = key.indices(self._length)
+      data = self.read(start, stop)
+      return data if step == 1 else data[::step]
+    if key < 0: key += self._length
+    if not 0 <= key < self._length: raise IndexError('capture index out of range')
+    return self.read(key, key + 1)[0]
+
+  def find(self, sub, start=0, end=None):
+    '''Return the lowest offset of sub from start to end, or -1, as bytes.find does.'''
+    end = self._length if end is None else min(end, self._length)
+    pos = start
+    while pos < end:
+      chunk_end = min(pos + self.block_size + len(sub) - 1, end)  # so that a match across two blocks is not missed
+      found = self.read(pos, chunk_end).find(sub)
+      if found != -1: return pos + found
+      if chunk_end == end: break
+      pos = chunk_end - len(sub) + 1
+    return -1
+
+  def close(self):
+    self._cache.clear()
+    self._fp.close()
+
+
+def compress(path, codec='zlib'):
+  '''Write a compressed copy of the capture at path, returning its path.'''
+  out_path = compressed_path(path)
+  writer = BlockWriter(out_path, codec)
+  with open(path, 'rb') as fp:
+    for block in iter(lambda: fp.read(BLOCK_SIZE), b''): writer.write(block)
+  writer.close()
+  return out_path
+
+
+def decompress(path):
+  '''Write an uncompressed copy of the compressed capture at path, returning its path.'''
+  out_path = path[:-len(SUFFIX)] + '.bin' if path.endswith(SUFFIX) else path + '.bin'
+  reader = BlockReader(path)
+  with open(out_path, 'wb') as fp:
+    for start in range(0, len(reader), BLOCK_SIZE): fp.write(reader.read(start, start + BLOCK_SIZE))
+  reader.close()
+  return out_path
+
+
+if __name__ == '__main__':
+  if is_compressed(sys.argv[1]):
+    print(decompress(sys.argv[1]))
+  else:
+    print(compress(*sys.argv[1:3]))
@@ -0,0 +1,108 @@
+'''Events yielded by Analyzer.events() in each of the analyzers.
+
+Offsets are within the transaction for GCR and DCD and within the serial data for MFM; transaction numbers and directions
+are None for MFM.  A direction is True for data read from a GCR disk, or sent from a DCD device to the Macintosh.  The
+payload of a data mark or DCD payload is a memoryview; copy it with bytes() to keep it past the next event.
+'''
+
+
+class Event:
+
+  __slots__ = ()
+
+  def __repr__(self):
+    return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+  def __reduce__(self):
+    return type(self), tuple(bytes(value) if isinstance(value, memoryview) else value
+                             for value in (getattr(self, name) for name in self.__slots__))
+
+
+class MarkError(Event):
+  '''A mark that could not be decoded; message is as logged, for example "AM  BAD CHECKSUM, 0x12 != 0x34".
+
+  For DCD, a payload with a bad checksum, which is not logged; its message is "Data  BAD CHECKSUM".
+  '''
+
+  __slots__ = ('trans', 'direction', 'offset', 'message')
+
+  def __init__(self, trans, direction, offset, message):
+    self.trans = trans
+    self.direction = direction
+    self.offset = offset
+    self.message = message
+
+
+class AddressMark(Event):
+  '''A valid address mark.  format is the format byte for GCR and the size code for MFM.'''
+
+  __slots__ = ('trans', 'direction', 'offset', 'track', 'sector', 'side', 'format')
+
+  def __init__(self, trans, direction, offset, track, sector, side, format):
+    self.trans = trans
+    self.direction = direction
+    self.offset = offset
+    self.track = track
+    self.sector = sector
+    self.side = side
+    self.format = format
+
+
+class DataMark(Event):
+  '''A valid data mark, with the track, sector, side, and format of the address mark before it.
+
+  The payload is the 524 bytes of tags and data for GCR and the 512 bytes of data and 2 of CRC for MFM.
+  '''
+
+  __slots__ = ('trans', 'direction', 'offset', 'number', 'track', 'sector', 'side', 'format', 'payload')
+
+  def __init__(self, trans, direction, offset, number, track, sector, side, format, payload):
+    self.trans = trans
+    self.direction = direction
+    self.offset = offset
+    self.number = number
+    self.track = track
+    self.sector = sector
+    self.side = side
+    self.format = format
+    self.payload = payload
+
+
+class IndexMark(Event):
+  '''An MFM index mark.'''
+
+  __slots__ = ('offset',)
+
+  def __init__(self, offset):
+    self.offset = offset
+
+
+class DcdPayload(Event):
+  '''A valid payload sent between the Macintosh and a DCD device.'''
+
+  __slots__ = ('trans', 'direction', 'offset', 'number', 'payload')
+
+  def __init__(self, trans, direction, offset, number, payload):
+    self.trans = trans
+    self.direction = direction
+    self.offset = offset
+    self.number = number
+    self.payload = payload
+
+
+class Desync(Event):
+  '''A DCD transaction that neither side's framing could follow.'''
+
+  __slots__ = ('trans',)
+
+  def __init__(self, trans):
+    self.trans = trans
+
+
+class TransactionEnd(Event):
+  '''The end of a DCD transaction, marked by the serial port timing out.'''
+
+  __slots__ = ('trans',)
+
+  def __init__(self, trans):
+    self.trans = trans
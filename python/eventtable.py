@@ -0,0 +1,177 @@
+'''Columnar tables of the marks found by the IWM/SWIM analyzers, for statistics over millions of them.
+
+An analyzer created with table=True records every mark it finds, good or bad, in analyzer.table as it handles it in
+analyze(), alongside its _marks.db index (or, given None as the file prefix, without writing any files at all).  Rather
+than an object for each mark, the table keeps a column of each field in a typed array, appended to a batch of marks at a
+time: the kind and status (as codes into its kinds and statuses lists), transaction number, direction, offset within the
+transaction (or the serial data, for MFM), position in the capture, and track, side, and sector.  Fields that a mark
+does not have are -1.
+
+With NumPy installed, the columns can be taken as arrays without copying them, saved to a .npz file, and summarized:
+
+  from eventtable import load, track_errors
+  analyzer = Analyzer(FileSource('test_serial.bin'), None, table=True)
+  analyzer.analyze()
+  analyzer.table.save('test_marks.npz')
+  marks, errors = track_errors(load('test_marks.npz'), kind='DM')  # data marks and bad ones, by track
+
+NumPy is only needed to export and summarize a table, not to record one.
+'''
+
+from array import array
+from collections import OrderedDict
+
+from markindex import OK, parse_error
+
+
+BATCH_SIZE = 4096  # marks appended to the columns at a time
+NO_VALUE = -1  # for the fields that a mark does not have
+
+COLUMNS = (('kind', 'b'), ('status', 'h'), ('trans', 'q'), ('direction', 'b'), ('offset', 'q'), ('position', 'q'),
+           ('track', 'h'), ('side', 'h'), ('sector', 'h'))
+
+
+def _numpy():
+  import numpy  # imported here so that a table can be recorded without NumPy installed
+  return numpy
+
+
+class EventTable:
+  '''Records marks and transactions in typed columns as they are found, with the interface of markindex.IndexWriter.
+
+  Positions are worked out from the starts of transactions as the index works them out, with base the offset in the
+  capture at which reading started.
+  '''
+
+  def __init__(self, base=0):
+    self._base = base
+    self._columns = tuple(array(typecode) for _, typecode in COLUMNS)
+    self._rows = []
+    self._starts = OrderedDict()  # transaction number -> start, for the transactions that marks may still be found in
+    self.kinds = []
+    self.statuses = [OK]
+    self._kind_codes = {}
+    self._status_codes = {OK: 0}
+
+  def __len__(self):
+    return len(self._columns[0]) + len(self._rows)
+
+  def transaction(self, number, direction, start):
+    '''Record that a transaction starts at the given offset in the serial data.'''
+    self._starts[number] = self._base + start
+
+  def mark(self, kind, status, trans, direction, offset, length, track=None, side=None, sector=None, format=None,
+           number=None, message=None):
+    kind_code = self._kind_codes.get(kind)
+    if kind_code is None:
+      kind_code = self._kind_codes[kind] = len(self.kinds)
+      self.kinds.append(kind)
+    status_code = self._status_codes.get(status)
+    if status_code is None:
+      status_code = self._status_codes[status] = len(self.statuses)
+      self.statuses.append(status)
+    if trans is None:
+      position = self._base + offset
+      trans = NO_VALUE
+    else:
+      starts = self._starts
+      while starts and next(iter(starts)) < trans: starts.popitem(last=False)  # marks are found in transaction order
+      position = starts[trans] + offset
+    self._rows.append((kind_code, status_code, trans, NO_VALUE if direction is None else direction, offset, position,
+                       NO_VALUE if track is None else track, NO_VALUE if side is None else side,
+                       NO_VALUE if sector is None else sector))
+    if len(self._rows) >= BATCH_SIZE: self._flush()
+
+  def error(self, trans, direction, offset, message, length, track=None, side=None, sector=None):
+    '''Record a mark that could not be decoded, with its kind and status taken from the message.'''
+    kind, status = parse_error(message)
+    self.mark(kind, status, trans, direction, offset, length, track, side, sector, message=message)
+
+  def _flush(self):
+    if not self._rows: return
+    for column, values in zip(self._columns, zip(*self._rows)): column.extend(values)
+    self._rows = []
+
+  def column(self, name):
+    '''Return the array of one of the columns.'''
+    self._flush()
+    return self._columns[[column for column, _ in COLUMNS].index(name)]
+
+  def arrays(self):
+    '''Return a dict of the name of each column -> a NumPy array of it, along with the kinds and statuses.
+
+    The arrays share the memory of the columns rather than copying them, so no more marks can be recorded while any of
+    them is still referenced (appending raises BufferError); copy them to keep them while recording carries on.
+    '''
+    numpy = _numpy()
+    self._flush()
+    arrays = {name: numpy.frombuffer(column, dtype=typecode) if column else numpy.zeros(0, typecode)
+              for (name, typecode), column in zip(COLUMNS, self._columns)}
+    arrays['kinds'] = numpy.array(self.kinds, dtype=str)
+    arrays['statuses'] = numpy.array(self.statuses, dtype=str)
+    return arrays
+
+  def save(self, path):
+    '''Save the table to a .npz file, to be loaded with load().'''
+    _numpy().savez(path, **self.arrays())
+
+
+def load(path):
+  '''Return the arrays of a table saved to a .npz file, as returned by EventTable.arrays().'''
+  with _numpy().load(path) as npz:
+    return {name: npz[name] for name in npz.files}
+
+
+def _arrays(table):
+  return table.arrays() if isinstance(table, EventTable) else table
+
+
+def _select(arrays, kind=None, errors=None):
+  '''Return a boolean array selecting the marks of the given kind, and only the bad or good ones if errors is given.'''
+  numpy = _numpy()
+  selected = numpy.ones(len(arrays['kind']), dtype=bool)
+  if kind is not None:
+    codes = numpy.flatnonzero(arrays['kinds'] == kind)
+    selected &= arrays['kind'] == (codes[0] if len(codes) else NO_VALUE)
+  if errors is not None:
+    selected &= (arrays['status'] != 0) if errors else (arrays['status'] == 0)
+  return selected
+
+
+def track_errors(table, kind=None):
+  '''Return arrays of the number of marks and of bad marks on each track, indexed by track, for marks with a track.
+
+  table is an EventTable or the arrays of one; kind limits the count to marks of that kind (for example 'DM').
+  '''
+  numpy = _numpy()
+  arrays = _arrays(table)
+  selected = _select(arrays, kind) & (arrays['track'] >= 0)
+  tracks = arrays['track'][selected]
+  length = int(tracks.max()) + 1 if len(tracks) else 0
+  return (numpy.bincount(tracks, minlength=length),
+          numpy.bincount(tracks, weights=arrays['status'][selected] != 0, minlength=length).astype(numpy.int64))
+
+
+def direction_counts(table, kind=None):
+  '''Return a dict of direction (0 or 1, or None for MFM marks) -> number of marks.'''
+  numpy = _numpy()
+  arrays = _arrays(table)
+  counts = numpy.bincount(arrays['direction'][_select(arrays, kind)] + 1, minlength=3)
+  return {direction: int(count) for direction, count in zip((None, 0, 1), counts) if count}
+
+
+def status_counts(table, kind=None):
+  '''Return a dict of status -> number of marks with it.'''
+  numpy = _numpy()
+  arrays = _arrays(table)
+  counts = numpy.bincount(arrays['status'][_select(arrays, kind)], minlength=len(arrays['statuses']))
+  return {str(status): int(count) for status, count in zip(arrays['statuses'], counts) if count}
+
+
+def intervals(table, kind=None, errors=None):
+  '''Return an array of the distance in the capture from each mark of kind to the next.
+
+  errors is True to take only bad marks, and False to take only good ones.
+  '''
+  arrays = _arrays(table)
+  return _numpy().diff(arrays['position'][_select(arrays, kind, errors)])
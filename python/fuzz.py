@@ -0,0 +1,472 @@
+'''Differential fuzzing of the fast paths of the IWM/SWIM analyzers against the reference decoders in reference.py.
+
+Each case builds random input from the encoders in synth.py, mutates it the ways a real capture goes wrong (marks
+truncated, bit slip bytes missing or a byte slipped in or out, invalid nibbles, DCD holdoffs, the direction changing in
+the middle of a GCR mark, stray sync patterns, flipped bits), and checks that the fast path gives exactly what the
+reference gives.  The targets are:
+
+  demangle  analyzer_gcr.fast_demangle against reference.demangle, on random nibbles of any length
+  crc       CRC16 and check_marks against a CRC worked out a bit at a time
+  gcr_mark  analyzer_gcr.verify_mark against the reference, on mutated address and data marks
+  mfm_mark  analyzer_mfm.verify_mark against the reference, on mutated index, address, and data marks
+  dcd_feed  the DCD decoders' feed() against feed_byte, on mutated payloads split up at random
+  gcr, mfm, dcd  the events of whole mutated captures, read in random chunks with timeouts between them, and with
+            --files the files written for them
+
+Cases are spread over worker processes, and each one is seeded by the seed, its target, and its number, so a failure can
+be repeated on its own:
+
+  python3 fuzz.py                            # every target for a minute
+  python3 fuzz.py --seconds 600 --workers 8 --files gcr dcd
+  python3 fuzz.py --seed 7 --case 1234 dcd   # repeat case 1234 of dcd
+'''
+
+import argparse
+import concurrent.futures
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import analyzer_dcd
+import analyzer_gcr
+from analyzer_gcr import DenibblizeError, fast_demangle
+import analyzer_mfm
+from analyzer_mfm import CRC16, check_marks
+from pack import DATA, NO_DIRECTION, TRANSACTION, export, item_path
+import reference
+from reference import BAD, DONE, IWM_TO_NIBBLE, demangle
+import synth
+
+
+TARGETS = ('demangle', 'crc', 'gcr_mark', 'mfm_mark', 'dcd_feed', 'gcr', 'mfm', 'dcd')
+SECONDS = 60
+MAX_FAILURES = 10  # failures of each target reported by each worker
+
+NIBBLE_MASK = bytes(byte & 0x3F for byte in range(256))
+VALID_GCR = bytes(byte | 0x80 for byte in range(128) if IWM_TO_NIBBLE[byte] is not None)
+INVALID_GCR = bytes(byte | 0x80 for byte in range(128) if IWM_TO_NIBBLE[byte] is None)
+GCR_JUNK = (b'\xD5\xAA\x96', b'\xD5\xAA\xAD', b'\xD5\xAA', b'\xDE\xAA', b'\xFF')
+MFM_JUNK = (b'\xA1\xA1\xA1', b'\xA1\xA1\xA1\xFE', b'\xA1\xA1\xA1\xFB', b'\xC2\xC2\xC2\xFC', b'\x4E')
+DCD_JUNK = (b'\xAA', b'\x00\x01\xAA', b'\x80\xAA', b'\x00', b'\xFF')
+GCR_LABELS = ('wr', 'rd')
+DCD_LABELS = ('mac', 'dcd')
+
+_pools = {}
+
+
+class Mismatch(Exception):
+  '''The fast path gave something other than what the reference gave.'''
+
+
+class ChunkSource:
+  '''Byte source that returns the given chunks one at a time, b'' standing for the serial port timing out.'''
+
+  REPLAY = True
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+
+  def read(self):
+    for chunk in self._chunks: return chunk
+    raise EOFError
+
+  def close(self):
+    pass
+
+
+def _pool(name, make, size=32):
+  '''Return a list of size payloads made by make, the same in every process, as encoding them afresh is slow.'''
+  if name not in _pools:
+    rng = random.Random(name)
+    _pools[name] = [make(rng) for _ in range(size)]
+  return _pools[name]
+
+
+def _outcome(func, *args):
+  '''Return what calling func returns, with bytearrays and memoryviews as bytes, or the exception it raises.'''
+  try:
+    result = func(*args)
+  except (DenibblizeError, reference.DenibblizeError, IndexError, ValueError) as e:
+    return 'raised', type(e).__name__, str(e)
+  return 'returned', _plain(result)
+
+
+def _plain(value):
+  if isinstance(value, (bytearray, memoryview)): return bytes(value)
+  if isinstance(value, (tuple, list)): return type(value)(_plain(item) for item in value)
+  return value
+
+
+def _compare(what, expected, actual):
+  if expected != actual: raise Mismatch('%s: expected %.300r, got %.300r' % (what, expected, actual))
+
+
+def _compare_events(expected, actual):
+  '''Compare two lists of events, field for field, reporting the first difference.'''
+  expected = [event.__reduce__() for event in expected]
+  for index, (want, got) in enumerate(zip(expected, actual)):
+    _compare('event %d' % index, want, got)
+  _compare('number of events', len(expected), len(actual))
+
+
+def _chunks(rng, data, breaks=(), timeouts=0.1):
+  '''Split data into chunks of random sizes, with a timeout (b'') at each of breaks and now and then elsewhere.'''
+  chunks = []
+  breaks = sorted(set(breaks) | {len(data)})
+  pos = 0
+  for end in breaks:
+    while pos < end:
+      size = min(rng.choice((1, 2, 3, 7, 8, 9, 64, 709, 4096)) if rng.random() < 0.8 else rng.randrange(1, 20000),
+                 end - pos)
+      chunks.append(data[pos:pos + size])
+      pos += size
+      if rng.random() < timeouts: chunks.append(b'')
+    chunks.append(b'')
+  return chunks
+
+
+# mutations of a single mark, given as a bytearray
+
+def _truncate(rng, mark, keep=0):
+  if len(mark) > keep: del mark[rng.randrange(keep, len(mark)):]
+
+
+def _slip(rng, mark):
+  '''Slip a byte into or out of the mark, or garble its last two (for GCR, the bit slip bytes).'''
+  choice = rng.randrange(3)
+  if choice == 0:
+    mark.insert(rng.randrange(len(mark) + 1), rng.randrange(256))
+  elif choice == 1 and mark:
+    del mark[rng.randrange(len(mark))]
+  elif len(mark) >= 2:
+    mark[rng.randrange(len(mark) - 2, len(mark))] ^= 1 << rng.randrange(7)
+
+
+def _flip(rng, mark):
+  if mark: mark[rng.randrange(len(mark))] ^= 1 << rng.randrange(8)
+
+
+def _gcr_nibble(rng, mark, valid):
+  '''Replace a byte after the prologue with another valid nibble, or an invalid one.'''
+  if len(mark) <= 3: return
+  # the hi-bits nibble of the last group of the data is the only one that can fail to denibblize
+  pos = 700 if len(mark) > 700 and rng.random() < 0.2 else rng.randrange(3, len(mark))
+  mark[pos] = rng.choice(VALID_GCR if valid else INVALID_GCR)
+
+
+def _holdoff(rng, mark):
+  '''Hold off a DCD payload after a random byte, clearing its most significant bit and following it with filler and a
+  sync byte, or with neither.'''
+  if not mark: return
+  pos = rng.randrange(len(mark))
+  mark[pos] &= 0x7F
+  if rng.random() < 0.7: mark[pos + 1:pos + 1] = bytes(rng.randrange(128) for _ in range(rng.randrange(3))) + b'\xAA'
+
+
+def _mutate(rng, mark, mutations, rate=0.5):
+  '''Apply random mutations from mutations to a mark, each one with probability rate of there being another.'''
+  while rng.random() < rate: rng.choice(mutations)(rng, mark)
+  return mark
+
+
+GCR_MUTATIONS = (_truncate, _slip, _flip, lambda rng, mark: _gcr_nibble(rng, mark, True),
+                 lambda rng, mark: _gcr_nibble(rng, mark, False))
+MFM_MUTATIONS = (lambda rng, mark: _truncate(rng, mark, 4), _slip, _flip)
+DCD_MUTATIONS = (_truncate, _slip, _flip, _holdoff)
+
+
+# marks
+
+def _gcr_address_mark(rng, sector):
+  return synth.gcr_address_mark(rng.randrange(80), sector, rng.randrange(2), rng.choice((0x22, 0x12, 0x02)))
+
+
+def _gcr_data_mark(rng, sector):
+  return synth.gcr_data_mark(sector, None, rng.choice(_pool('gcr', lambda rng: synth.mangle(rng.randbytes(524)))))
+
+
+def _mfm_data_mark(rng):
+  return rng.choice(_pool('mfm', lambda rng: synth.mfm_data_mark(rng.randbytes(512))))
+
+
+def _dcd_payload(rng):
+  '''Return the bytes of a random DCD command or reply, valid or not, with holdoffs now and then.'''
+  groups = rng.randrange(1, 5)
+  data = rng.randbytes(groups * 7)
+  reply = rng.random() < 0.5
+  if rng.random() < 0.9: data = synth.dcd_checksum(data, reply)
+  holdoff = (rng.randrange(groups - 1),) if groups > 1 and rng.random() < 0.3 else ()
+  if reply: return synth.dcd_reply(data, holdoff)
+  return synth.dcd_command(data, rng.choice((0, 1, 2, rng.randrange(128))), holdoff)
+
+
+# targets, each of which runs one case given a random generator seeded for it
+
+def fuzz_demangle(rng, files):
+  length = rng.choice((703, 703, rng.randrange(4, 720), rng.randrange(0, 16)))
+  nibbles = rng.randbytes(length).translate(NIBBLE_MASK)
+  _compare('demangle of %d nibbles' % length, _outcome(demangle, list(nibbles)), _outcome(fast_demangle, nibbles))
+
+
+def fuzz_crc(rng, files):
+  data = rng.randbytes(rng.choice((0, 1, 2, 10, 518, rng.randrange(1024))))
+  reg = rng.choice((0xFFFF, rng.randrange(0x10000)))
+  _compare('CRC16', reference.crc16(data, reg), CRC16(reg=reg).update(data))
+  poly = rng.randrange(0x10000) | 1
+  _compare('CRC16 with poly 0x%04X' % poly, reference.crc16(data, reg, poly), CRC16(poly, reg).update(data))
+  buf = bytearray()
+  marks = []
+  for _ in range(rng.randrange(6)):
+    buf += rng.randbytes(rng.randrange(8))
+    mark = bytearray(synth.mfm_mark(rng.randbytes(rng.randrange(20))))
+    _mutate(rng, mark, (_flip,), 0.3)
+    marks.append((len(buf), len(mark)))
+    buf += mark
+  _compare('check_marks', [not reference.crc16(buf[offset:offset + length]) for offset, length in marks],
+           check_marks(bytes(buf), marks))
+
+
+def fuzz_gcr_mark(rng, files):
+  if rng.random() < 0.5:
+    mark = bytearray(_gcr_address_mark(rng, rng.randrange(12)))
+  else:
+    mark = bytearray(_gcr_data_mark(rng, rng.randrange(12)))
+  signature = bytes(mark[:3])
+  _mutate(rng, mark, GCR_MUTATIONS, 0.7)
+  mark[:3] = signature  # as framed, by its signature
+  mark = bytes(mark).translate(analyzer_gcr.TransactionReader.SET_MSB_TABLE)
+  _compare('verify_mark(%s)' % mark[:12].hex(), _outcome(reference.gcr_verify_mark, mark),
+           _outcome(analyzer_gcr.verify_mark, mark))
+
+
+def fuzz_mfm_mark(rng, files):
+  kind = rng.randrange(3)
+  if kind == 0:
+    mark = bytearray(b'\xC2\xC2\xC2\xFC')
+  elif kind == 1:
+    fields = rng.randbytes(4)
+    mark = bytearray(synth.mfm_address_mark(fields[0], fields[1], fields[2], fields[3]))
+  else:
+    mark = bytearray(_mfm_data_mark(rng))
+  _mutate(rng, mark, MFM_MUTATIONS, 0.7)
+  mark[:4] = (b'\xC2\xC2\xC2\xFC', b'\xA1\xA1\xA1\xFE', b'\xA1\xA1\xA1\xFB')[kind]  # as framed, by its signature
+  mark = bytes(mark)
+  _compare('verify_mark(%s)' % mark[:12].hex(), _outcome(reference.mfm_verify_mark, mark),
+           _outcome(analyzer_mfm.verify_mark, mark))
+
+
+def fuzz_dcd_feed(rng, files):
+  data = bytearray()
+  for _ in range(rng.randrange(1, 4)):
+    data += rng.randbytes(rng.randrange(4))
+    data += _mutate(rng, bytearray(_dcd_payload(rng)), DCD_MUTATIONS, 0.4)
+  data = bytes(data)
+  for decoder_class, reference_class in ((analyzer_dcd._MacToDcdDecoder, reference.MacToDcdDecoder),
+                                         (analyzer_dcd._DcdToMacDecoder, reference.DcdToMacDecoder)):
+    fast, slow = decoder_class(), reference_class()
+    in_groups = rng.choice((1, 2, 4, rng.randrange(1, 128)))  # a reply of no groups is never accepted
+    if decoder_class is analyzer_dcd._DcdToMacDecoder:
+      fast.reset(in_groups)
+      slow.reset(in_groups)
+    pos = 0
+    tell = rng.randrange(100)
+    while pos < len(data):
+      end = min(len(data), pos + rng.choice((1, 7, 8, 9, 24, len(data))))
+      expected = reference.dcd_feed(slow, data, pos, end, tell)
+      actual = fast.feed(data, pos, end, tell)
+      what = '%s.feed(data, %d, %d) of %s' % (decoder_class.__name__, pos, end, data.hex())
+      _compare(what, expected, actual)
+      _compare('state after ' + what, _plain(vars(slow)), _plain(vars(fast)))
+      state, pos = actual
+      if state in (DONE, BAD): pos += 1
+      if state is not None:  # start again, as the analyzer does after a payload
+        for decoder in (fast, slow):
+          if decoder_class is analyzer_dcd._DcdToMacDecoder:
+            decoder.reset(in_groups)
+          else:
+            decoder.reset()
+
+
+def _gcr_capture(rng):
+  capture = bytearray()
+  read = rng.random() < 0.5
+  for _ in range(rng.randrange(1, 6)):
+    run = bytearray(b'\xFF' * rng.randrange(10))
+    choice = rng.random()
+    sector = rng.randrange(12)
+    if choice < 0.85:
+      run += _mutate(rng, bytearray(_gcr_address_mark(rng, sector)), GCR_MUTATIONS, 0.2)
+      run += b'\xFF' * rng.randrange(8)
+    if 0.4 < choice < 0.85:
+      if rng.random() < 0.1: sector = rng.randrange(12)
+      run += _mutate(rng, bytearray(_gcr_data_mark(rng, sector)), GCR_MUTATIONS, 0.3)
+    if choice >= 0.85: run += b''.join(rng.choice(GCR_JUNK) for _ in range(rng.randrange(1, 8)))
+    if rng.random() < 0.3: read = not read
+    capture += synth.gcr_direction(bytes(run), read)
+  while rng.random() < 0.2:  # the direction changing in the middle of a mark
+    start = rng.randrange(len(capture))
+    for pos in range(start, min(start + rng.randrange(1, 12), len(capture))): capture[pos] ^= 0x80
+  if rng.random() < 0.2: _truncate(rng, capture, 1)
+  return bytes(capture)
+
+
+def _mfm_capture(rng):
+  capture = bytearray()
+  for _ in range(rng.randrange(1, 7)):
+    capture += b'\x4E' * rng.randrange(12)
+    choice = rng.random()
+    if choice < 0.15:
+      mark = bytearray(synth.MFM_INDEX_MARK)
+    elif choice < 0.55:
+      mark = bytearray(synth.mfm_address_mark(rng.randrange(80), rng.randrange(2), rng.randrange(1, 19),
+                                              rng.choice((2, 2, 1, 3))))
+    elif choice < 0.85:
+      mark = bytearray(_mfm_data_mark(rng))
+    else:
+      mark = bytearray(b''.join(rng.choice(MFM_JUNK) for _ in range(rng.randrange(1, 8))))
+    capture += _mutate(rng, mark, MFM_MUTATIONS, 0.3)
+  if rng.random() < 0.2: _truncate(rng, capture, 1)
+  return bytes(capture)
+
+
+def _dcd_capture(rng):
+  capture = bytearray()
+  breaks = []
+  for _ in range(rng.randrange(1, 8)):
+    if rng.random() < 0.1: capture += b''.join(rng.choice(DCD_JUNK) for _ in range(rng.randrange(1, 6)))
+    capture += _mutate(rng, bytearray(_dcd_payload(rng)), DCD_MUTATIONS, 0.25)
+    if rng.random() < 0.4: breaks.append(len(capture))
+  return bytes(capture), breaks
+
+
+def _expected_files(items, labels):
+  '''Return a dict of the name of each legacy file -> its contents, for a dict of (kind, number, direction) -> data.'''
+  return {os.path.basename(item_path('', kind, number, direction, labels)): data
+          for (kind, number, direction), data in items.items()}
+
+
+def _written_files(module, chunks, options, labels):
+  '''Run an analyzer over chunks, writing its files to a temporary directory, and return them like _expected_files.'''
+  directory = tempfile.mkdtemp(prefix='iwm_fuzz_')
+  try:
+    prefix = os.path.join(directory, 'f')
+    module.Analyzer(ChunkSource(chunks), prefix, console=None, index=False, checkpoints=False, **options).analyze()
+    if options['pack']: export(prefix)
+    files = {}
+    for name in os.listdir(directory):
+      if name.startswith('f_trans_') or name.startswith('f_data_'):
+        with open(os.path.join(directory, name), 'rb') as fp: files[name[1:]] = fp.read()
+    return files
+  finally:
+    shutil.rmtree(directory)
+
+
+def _fast_events(module, chunks):
+  return [event.__reduce__() for event in module.Analyzer(ChunkSource(chunks), None).events()]
+
+
+def fuzz_gcr(rng, files):
+  capture = _gcr_capture(rng)
+  chunks = _chunks(rng, capture)
+  expected, transactions = reference.gcr_events(capture)
+  _compare_events(expected, _fast_events(analyzer_gcr, chunks))
+  if not files: return
+  items = {(TRANSACTION, number, int(direction)): data for number, (direction, data) in enumerate(transactions)}
+  items.update(((DATA, event.number, int(event.direction)), event.payload) for event in expected
+               if type(event) is reference.DataMark)
+  _compare('files', _expected_files(items, GCR_LABELS),
+           _written_files(analyzer_gcr, chunks, dict(pack=rng.random() < 0.5, image=False), GCR_LABELS))
+
+
+def fuzz_mfm(rng, files):
+  capture = _mfm_capture(rng)
+  chunks = _chunks(rng, capture)
+  expected = reference.mfm_events(capture)
+  _compare_events(expected, _fast_events(analyzer_mfm, chunks))
+  if not files: return
+  items = {(DATA, event.number, NO_DIRECTION): event.payload for event in expected
+           if type(event) is reference.DataMark}
+  _compare('files', _expected_files(items, None),
+           _written_files(analyzer_mfm, chunks, dict(pack=rng.random() < 0.5, image=False), None))
+
+
+def fuzz_dcd(rng, files):
+  capture, breaks = _dcd_capture(rng)
+  chunks = _chunks(rng, capture, breaks, 0.02)
+  expected, transactions = reference.dcd_events(chunks)
+  _compare_events(expected, _fast_events(analyzer_dcd, chunks))
+  if not files: return
+  items = {(TRANSACTION, number, NO_DIRECTION): data for number, data in enumerate(transactions)}
+  items.update(((DATA, event.number, int(event.direction)), event.payload) for event in expected
+               if type(event) is reference.DcdPayload)
+  _compare('files', _expected_files(items, DCD_LABELS),
+           _written_files(analyzer_dcd, chunks, dict(pack=rng.random() < 0.5), DCD_LABELS))
+
+
+def run_case(target, seed, case, files=False):
+  '''Run one case of a target, raising Mismatch (or whatever the fast path raised) if it fails.'''
+  globals()['fuzz_' + target](random.Random('%d:%s:%d' % (seed, target, case)), files)
+
+
+def fuzz(targets, seconds, seed=0, worker=0, workers=1, files=False):
+  '''Run cases of each target in turn for seconds in all, numbering them worker, worker + workers, and so on.
+
+  Returns a dict of target -> (cases run, list of (case, message) for the first few that failed).
+  '''
+  results = {}
+  for target in targets:
+    func = globals()['fuzz_' + target]
+    deadline = time.perf_counter() + seconds / len(targets)
+    failures = []
+    case = worker
+    cases = 0
+    while True:
+      for _ in range(10):
+        try:
+          func(random.Random('%d:%s:%d' % (seed, target, case)), files)
+        except Exception as e:
+          if len(failures) < MAX_FAILURES: failures.append((case, '%s: %s' % (type(e).__name__, e)))
+        case += workers
+        cases += 1
+      if time.perf_counter() >= deadline: break
+    results[target] = (cases, failures)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Fuzz the fast paths of the IWM/SWIM analyzers against the reference '
+                                               'decoders.')
+  parser.add_argument('targets', nargs='*', metavar='target', help=', '.join(TARGETS) + ' (default: all)')
+  parser.add_argument('--seconds', type=float, default=SECONDS, help='time to spend (default: %d)' % SECONDS)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default: one per CPU)')
+  parser.add_argument('--files', action='store_true', help='also compare the files written for whole captures')
+  parser.add_argument('--case', type=int, help='run only this case of each target, and show how it fails')
+  args = parser.parse_args()
+  for target in args.targets:
+    if target not in TARGETS: parser.error('unknown target %r' % target)
+  targets = args.targets or TARGETS
+  if args.case is not None:
+    for target in targets: run_case(target, args.seed, args.case, args.files)
+    print('case %d passed' % args.case)
+    return 0
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+    futures = [executor.submit(fuzz, targets, args.seconds, args.seed, worker, args.workers, args.files)
+               for worker in range(args.workers)]
+    results = [future.result() for future in futures]
+  failed = 0
+  for target in targets:
+    cases = sum(result[target][0] for result in results)
+    failures = sorted(failure for result in results for failure in result[target][1])
+    failed += len(failures)
+    print('%-9s %10d cases  %8.0f/s  %s' % (target, cases, cases * len(targets) / args.seconds,
+                                             '%d FAILED' % len(failures) if failures else 'ok'))
+    for case, message in failures[:MAX_FAILURES]: print('  case %d: %s' % (case, message))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
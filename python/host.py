@@ -0,0 +1,221 @@
+'''Run analyzers on several serial ports at once, in one process.
+
+Each port is read without blocking by an asyncio event loop and decoded by its own analyzer (GCR, MFM, or DCD, each with
+its own file prefix) on a thread of its own.  Ctrl-C or SIGTERM stops all of them cleanly, and the throughput of each port
+is reported periodically.  A port can also be 'tcp://host:port', which stands in for a serial port; serve() replays a
+capture as one, so the host can be tried out without hardware:
+
+  python3 host.py gcr /dev/ttyUSB0 mac1 dcd /dev/ttyUSB1 mac2
+  python3 host.py serve test_serial.bin 5000
+
+The counters of every analyzer can be served as JSON (see stats.py) with --stats ADDRESS before the ports.
+
+Requires PySerial for serial ports.
+'''
+
+import asyncio
+import concurrent.futures
+import importlib
+import queue
+import signal
+import sys
+import time
+
+from capture import SERIAL_TIMEOUT, CaptureThread, FileSource
+from stats import StatsServer
+
+
+STATS_INTERVAL = 10.0  # seconds
+
+
+class PortFeed:
+  '''Byte source fed by the event loop with the data received from a port.'''
+
+  REPLAY = False
+
+  def __init__(self):
+    self._queue = queue.SimpleQueue()
+
+  def put(self, data):
+    self._queue.put(data)
+
+  def end(self):
+    self._queue.put(None)
+
+  def read(self):
+    try:
+      data = self._queue.get(timeout=SERIAL_TIMEOUT)
+    except queue.Empty:
+      return b''
+    chunks = []
+    while data is not None:
+      chunks.append(data)
+      try:
+        data = self._queue.get_nowait()
+      except queue.Empty:
+        break
+    if data is None:
+      self._queue.put(None)  # so that every later read raises EOFError too
+      if not chunks: raise EOFError
+    return b''.join(chunks)
+
+  def close(self):
+    pass
+
+
+class _PortProtocol(asyncio.Protocol):
+
+  def __init__(self, port):
+    self._port = port
+
+  def data_received(self, data):
+    self._port.received += len(data)
+    self._port.feed.put(data)
+
+  def connection_lost(self, exc):
+    self._port.feed.end()
+
+
+class Port:
+  '''A serial port (or 'tcp://host:port') to be decoded by an analyzer module, writing files with the given prefix.
+
+  Any keyword options are passed to the analyzer; compress also compresses the raw log, as it does for an analyzer
+  reading a port directly.
+  '''
+
+  def __init__(self, port, module, file_prefix, **options):
+    self.port = port
+    self.module = module
+    self.file_prefix = file_prefix
+    self.options = options
+    self.feed = PortFeed()
+    self.received = 0  # bytes
+    self.capture = None
+    self.analyzer = None
+    self._transport = None
+    self._last_stats = (time.monotonic(), 0, 0)
+
+  async def open(self, loop):
+    if self.port.startswith('tcp://'):
+      host, _, tcp_port = self.port[len('tcp://'):].rpartition(':')
+      self._transport, _ = await loop.create_connection(lambda: _PortProtocol(self), host, int(tcp_port))
+    else:
+      import serial  # imported here so that tcp:// ports can be used without PySerial installed
+      s = serial.Serial(port=self.port, baudrate=1000000, timeout=0)
+      self._transport, _ = await loop.connect_read_pipe(lambda: _PortProtocol(self), s)
+    self.capture = CaptureThread(self.feed, '%s_serial.bin' % self.file_prefix, compress=self.options.get('compress'))
+    self.analyzer = self.module.Analyzer(self.capture, self.file_prefix, **self.options)
+
+  def stats(self):
+    '''Return the bytes received and decoded, and the rates of each in bytes per second since stats were last taken.'''
+    now = time.monotonic()
+    decoded = self.capture.consumed if self.capture else 0
+    last_time, last_received, last_decoded = self._last_stats
+    self._last_stats = (now, self.received, decoded)
+    elapsed = max(now - last_time, 1e-9)
+    return self.received, decoded, (self.received - last_received) / elapsed, (decoded - last_decoded) / elapsed
+
+  def close(self):
+    if self._transport: self._transport.close()
+    self.feed.end()
+
+
+def _report(ports):
+  for port in ports:
+    received, decoded, receive_rate, decode_rate = port.stats()
+    sys.stdout.write('%s %s: %d KB received (%.1f KB/s), %d KB decoded (%.1f KB/s), %d KB behind\n' %
+                     (time.strftime('(%H:%M:%S)'), port.file_prefix, received >> 10, receive_rate / 1024, decoded >> 10,
+                      decode_rate / 1024, (received - decoded) >> 10))
+  sys.stdout.flush()
+
+
+async def _report_periodically(ports, interval):
+  while True:
+    await asyncio.sleep(interval)
+    _report(ports)
+
+
+async def run_ports(ports, stats_interval=STATS_INTERVAL, stats_address=None):
+  '''Decode the given Ports until all of them are closed by the other end, or until interrupted.
+
+  If stats_address is given, the counters of each port's analyzer are served there (see stats.StatsServer), keyed by
+  file prefix.
+  '''
+  loop = asyncio.get_running_loop()
+  stop = asyncio.Event()
+  signals = (signal.SIGINT, signal.SIGTERM)
+  for signum in signals: loop.add_signal_handler(signum, stop.set)
+  executor = concurrent.futures.ThreadPoolExecutor(len(ports))
+  futures = []
+  reporter = None
+  server = None
+  try:
+    for port in ports: await port.open(loop)
+    if stats_address is not None:
+      server = StatsServer(stats_address, {port.file_prefix: port.analyzer.stats for port in ports})
+    futures = [loop.run_in_executor(executor, port.analyzer.analyze) for port in ports]
+    reporter = loop.create_task(_report_periodically(ports, stats_interval))
+    stopper = loop.create_task(stop.wait())
+    while not stop.is_set():
+      running = [future for future in futures if not future.done()]
+      if not running: break
+      await asyncio.wait(running + [stopper], return_when=asyncio.FIRST_COMPLETED)
+    stopper.cancel()
+  finally:
+    for signum in signals: loop.remove_signal_handler(signum)
+    for port in ports: port.close()
+    if reporter: reporter.cancel()
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    executor.shutdown()
+    if server: server.close()
+    _report(ports)
+  for port, result in zip(ports, results):
+    if isinstance(result, Exception): sys.stderr.write('%s: analyzer failed: %r\n' % (port.file_prefix, result))
+
+
+def run(ports, stats_interval=STATS_INTERVAL, stats_address=None):
+  '''Decode the given Ports, or (port, analyzer module, file prefix) tuples, until interrupted.'''
+  asyncio.run(run_ports([port if isinstance(port, Port) else Port(*port) for port in ports], stats_interval,
+                        stats_address))
+
+
+async def serve(path, tcp_port, host='localhost', rate=None):
+  '''Serve a capture to each client that connects, as a stand-in for a serial port.
+
+  The serial port timeouts recorded in the capture's timestamp sidecar are reproduced by pausing, and rate, if given,
+  limits the data rate in bytes per second.
+  '''
+
+  async def handle(reader, writer):
+    source = FileSource(path, chunk_size=4096)
+    try:
+      while True:
+        data = source.read()
+        if data:
+          writer.write(data)
+          await writer.drain()
+          if rate: await asyncio.sleep(len(data) / rate)
+        else:
+          await asyncio.sleep(SERIAL_TIMEOUT + 0.05)
+    except (EOFError, ConnectionError):
+      pass
+    finally:
+      source.close()
+      writer.close()
+
+  server = await asyncio.start_server(handle, host, tcp_port)
+  async with server: await server.serve_forever()
+
+
+if __name__ == '__main__':
+  if sys.argv[1:2] == ['serve']:
+    try:
+      asyncio.run(serve(sys.argv[2], int(sys.argv[3])))
+    except KeyboardInterrupt:
+      pass
+  else:
+    args = sys.argv[1:]
+    stats_address = None
+    if args[:1] == ['--stats']: stats_address, args = args[1], args[2:]
+    run([(args[i + 1], importlib.import_module('analyzer_%s' % args[i]), args[i + 2]) for i in range(0, len(args), 3)],
+        stats_address=stats_address)
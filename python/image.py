@@ -0,0 +1,193 @@
+'''Disk images assembled from the sectors decoded by the GCR and MFM analyzers.
+
+The image file is preallocated and memory-mapped when the first sector is decoded, and each verified sector is written in
+place as it arrives, so the image is complete as soon as the capture ends.  A coverage bitmap records which sectors have
+been seen.  GCR disks are assembled into a DiskCopy 4.2 image (which has room for the 12 tag bytes of each sector) and
+MFM disks into a raw image.
+'''
+
+from array import array
+from collections import namedtuple
+import mmap
+import struct
+import sys
+
+
+SECTOR_SIZE = 512
+TAG_SIZE = 12
+
+Geometry = namedtuple('Geometry', 'name sides sectors first_sector disk_format format_byte')
+
+# sectors is a tuple of the number of sectors on each track
+GCR_400K = Geometry('400K', 1, tuple(12 - track // 16 for track in range(80)), 0, 0, 0x12)
+GCR_800K = Geometry('800K', 2, tuple(12 - track // 16 for track in range(80)), 0, 1, 0x22)
+MFM_720K = Geometry('720K', 2, (9,) * 80, 1, 2, 0x22)
+MFM_1440K = Geometry('1440K', 2, (18,) * 80, 1, 3, 0x22)
+GEOMETRIES = {geometry.name: geometry for geometry in (GCR_400K, GCR_800K, MFM_720K, MFM_1440K)}
+
+DC42_HEADER = struct.Struct('>64sIIIIBBH')  # name, data size, tag size, data checksum, tag checksum, disk format,
+                                             # format byte, magic
+
+
+def dc42_checksum(data):
+  '''Return the DiskCopy 4.2 checksum of data: the sum of its big-endian words, rotated right after each addition.'''
+  words = array('H', data)
+  if sys.byteorder == 'little': words.byteswap()
+  checksum = 0
+  for word in words:
+    checksum = (checksum + word) & 0xFFFFFFFF
+    checksum = (checksum >> 1) | ((checksum & 1) << 31)
+  return checksum
+
+
+def image_size(image_class, geometry):
+  '''Return the size of an image of the given class and geometry.'''
+  return image_class.HEADER_SIZE + sum(geometry.sectors) * geometry.sides * (SECTOR_SIZE + image_class.TAG_SIZE)
+
+
+def reshaped_coverage(coverage, old, new):
+  '''Return the coverage bitmap of an image of geometry old as that of the same image reshaped to geometry new.'''
+  new_coverage = bytearray((sum(new.sectors) * new.sides + 7) // 8)
+  old_block = new_start = 0
+  for old_sectors, new_sectors in zip(old.sectors, new.sectors):
+    for side in range(old.sides):
+      for sector in range(old_sectors):
+        if coverage[old_block >> 3] & (1 << (old_block & 7)):
+          new_block = new_start + side * new_sectors + sector
+          new_coverage[new_block >> 3] |= 1 << (new_block & 7)
+        old_block += 1
+    new_start += new_sectors * new.sides
+  return new_coverage
+
+
+class Image:
+  '''An image of the sectors of a disk, in order of track, then side, then sector, after a header of HEADER_SIZE bytes.
+
+  If coverage is given (as returned by checkpoint()), the image already at path is reopened and added to.
+  '''
+
+  HEADER_SIZE = 0
+  TAG_SIZE = 0
+
+  def __init__(self, path, geometry, coverage=None):
+    self._fp = open(path, 'w+b' if coverage is None else 'r+b')
+    self._mm = None
+    self._reshape(geometry)
+    if coverage is not None: self._coverage[:] = coverage
+
+  def _reshape(self, geometry):
+    self.geometry = geometry
+    self._track_starts = []  # index of the first block of each track
+    blocks = 0
+    for sectors in geometry.sectors:
+      self._track_starts.append(blocks)
+      blocks += sectors * geometry.sides
+    self.blocks = blocks
+    self._coverage = bytearray((blocks + 7) // 8)
+    if self._mm: self._mm.close()
+    self._fp.truncate(self.HEADER_SIZE + blocks * (SECTOR_SIZE + self.TAG_SIZE))
+    self._mm = mmap.mmap(self._fp.fileno(), 0)
+
+  def block(self, track, side, sector):
+    '''Return the index of the block holding the given sector, or None if the disk has no such sector.'''
+    geometry = self.geometry
+    sector -= geometry.first_sector
+    if not (0 <= track < len(geometry.sectors) and 0 <= side < geometry.sides and 0 <= sector < geometry.sectors[track]):
+      return None
+    return self._track_starts[track] + side * geometry.sectors[track] + sector
+
+  def _sector_offset(self, block):
+    return self.HEADER_SIZE + block * SECTOR_SIZE
+
+  def write(self, track, side, sector, data, tags=b''):
+    '''Write a sector to the image.  Returns False if the disk has no such sector.'''
+    block = self.block(track, side, sector)
+    if block is None: return False
+    offset = self._sector_offset(block)
+    self._mm[offset:offset + SECTOR_SIZE] = data
+    self._coverage[block >> 3] |= 1 << (block & 7)
+    return True
+
+  def covered(self, block):
+    return bool(self._coverage[block >> 3] & (1 << (block & 7)))
+
+  def checkpoint(self):
+    '''Return the geometry and coverage bitmap of the image, with which to reopen it and carry on.'''
+    return dict(geometry=self.geometry.name, coverage=bytes(self._coverage))
+
+  def coverage(self):
+    '''Return the number of sectors that have been written to the image.'''
+    return sum(bin(byte).count('1') for byte in self._coverage)
+
+  def missing(self):
+    '''Return a list of (track, side, sector) of the sectors that have not been written to the image.'''
+    geometry = self.geometry
+    missing = []
+    for track, sectors in enumerate(geometry.sectors):
+      for side in range(geometry.sides):
+        for sector in range(sectors):
+          if not self.covered(self._track_starts[track] + side * sectors + sector):
+            missing.append((track, side, sector + geometry.first_sector))
+    return missing
+
+  def close(self):
+    self._mm.close()
+    self._fp.close()
+
+
+class RawImage(Image):
+  '''A raw image of the sectors of a disk, which may be reshaped to a geometry with more sectors on each track.'''
+
+  def reshape(self, geometry):
+    '''Change to a geometry with more sectors on each track, moving the sectors already written to their new places.
+
+    The new geometry must have the same number of tracks and sides, as when an MFM disk turns out to be high density.
+    '''
+    old_track_starts, old_sectors = self._track_starts, self.geometry.sectors
+    old_coverage = self._coverage
+    self._reshape(geometry)
+    for track in reversed(range(len(old_sectors))):  # blocks only move towards the end, so move the last ones first
+      for side in reversed(range(geometry.sides)):
+        for sector in reversed(range(old_sectors[track])):
+          old_block = old_track_starts[track] + side * old_sectors[track] + sector
+          if not old_coverage[old_block >> 3] & (1 << (old_block & 7)): continue
+          new_block = self._track_starts[track] + side * geometry.sectors[track] + sector
+          self._mm.move(self._sector_offset(new_block), self._sector_offset(old_block), SECTOR_SIZE)
+          self._coverage[new_block >> 3] |= 1 << (new_block & 7)
+    for block in range(self.blocks):
+      if self.covered(block): continue
+      offset = self._sector_offset(block)
+      self._mm[offset:offset + SECTOR_SIZE] = bytes(SECTOR_SIZE)
+
+
+class DiskCopyImage(Image):
+  '''A DiskCopy 4.2 image of the sectors and tags of a disk.  The checksums in its header are filled in when closed.'''
+
+  HEADER_SIZE = DC42_HEADER.size
+  TAG_SIZE = TAG_SIZE
+
+  def __init__(self, path, geometry, name='', coverage=None):
+    self._name = name.encode('mac_roman', 'replace')[:63]
+    super().__init__(path, geometry, coverage)
+    self._write_header(0, 0)
+
+  def _write_header(self, data_checksum, tag_checksum):
+    self._mm[:self.HEADER_SIZE] = DC42_HEADER.pack(bytes((len(self._name),)) + self._name, self.blocks * SECTOR_SIZE,
+                                                   self.blocks * TAG_SIZE, data_checksum, tag_checksum,
+                                                   self.geometry.disk_format, self.geometry.format_byte, 0x0100)
+
+  def _tag_offset(self, block):
+    return self.HEADER_SIZE + self.blocks * SECTOR_SIZE + block * TAG_SIZE
+
+  def write(self, track, side, sector, data, tags=b''):
+    if not super().write(track, side, sector, data): return False
+    offset = self._tag_offset(self.block(track, side, sector))
+    self._mm[offset:offset + TAG_SIZE] = bytes(tags).ljust(TAG_SIZE, b'\x00')
+    return True
+
+  def close(self):
+    data_start = self.HEADER_SIZE
+    tag_start = data_start + self.blocks * SECTOR_SIZE
+    # the tag checksum leaves out the tags of the first sector, for compatibility with DiskCopy 4.2
+    self._write_header(dc42_checksum(self._mm[data_start:tag_start]), dc42_checksum(self._mm[tag_start + TAG_SIZE:]))
+    super().close()
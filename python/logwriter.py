@@ -0,0 +1,225 @@
+'''Background writer for the log of the IWM/SWIM analyzers.
+
+Log lines are timestamped when they are logged and handed to a thread that writes them to the .log file in batches, so
+that a slow file system or terminal does not hold up decoding.  The console gets a copy of each line from a thread of
+its own; if the console cannot keep up, lines are left out of it (and the number left out is reported) but never out of
+the .log file.
+
+The console can show every line ('all'), a summary ('summary') in which runs of lines of the same kind (such as
+"AM  BAD CHECKSUM") are collapsed and at most SUMMARY_RATE lines a second are shown, or nothing (None).
+'''
+
+from collections import Counter
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+
+QUEUE_SIZE = 1 << 16  # lines; the analyzer waits if the writer falls this far behind
+BATCH_SIZE = 4096  # lines
+CONSOLE_BACKLOG = 1 << 14  # lines
+SUMMARY_RATE = 20  # lines per second
+
+_POSITION = re.compile(r'\d+(?: \w+ \d+)?:? ')  # transaction number, direction, and offset at the start of a line
+_KIND = re.compile(r'[^\d,:(]*')
+
+
+def _kind(msg):
+  '''Return the kind of a log line, for example "AM  BAD CHECKSUM" or "DM".'''
+  position = _POSITION.match(msg)
+  return _KIND.match(msg, position.end() if position else 0).group().rstrip()
+
+
+class _Timestamps:
+  '''Formats timestamps, calling time.strftime at most once a second.'''
+
+  def __init__(self, subsecond):
+    self._subsecond = subsecond
+    self._second = None
+    self._text = None
+
+  def format(self, timestamp):
+    second = int(timestamp)
+    if second != self._second:
+      self._second = second
+      self._text = time.strftime('%H:%M:%S', time.localtime(second))
+    if self._subsecond: return '(%s.%03d)' % (self._text, int((timestamp - second) * 1000))
+    return '(%s)' % self._text
+
+
+class _Console:
+  '''Writes log lines to the console on a thread of its own, dropping lines if the console cannot keep up.'''
+
+  def __init__(self, mode, timestamps, stream=None):
+    self._mode = mode
+    self._timestamps = timestamps
+    self._stream = stream or sys.stdout
+    self._pending = []
+    self._dropped = 0  # lines dropped because the console could not keep up
+    self._closed = False
+    self._cond = threading.Condition()
+    self._last_kind = None
+    self._repeats = 0  # lines of the same kind as the last one shown, not shown
+    self._second = None
+    self._shown = 0  # lines shown in the current second
+    self._suppressed = Counter()  # kinds of lines not shown because of the rate limit in the current second
+    self._thread = threading.Thread(target=self._run, name='console', daemon=True)
+    self._thread.start()
+
+  def write(self, lines):
+    '''Queue a batch of (timestamp, message, line) to be written.'''
+    with self._cond:
+      room = CONSOLE_BACKLOG - len(self._pending)
+      if room < len(lines):
+        self._dropped += len(lines) - max(room, 0)
+        lines = lines[:max(room, 0)]
+      self._pending.extend(lines)
+      self._cond.notify()
+
+  def _note(self, timestamp, msg):
+    return '%s %s\n' % (self._timestamps.format(timestamp), msg)
+
+  def _end_second(self, timestamp, out):
+    '''Report what was left out over the last second in summary mode.'''
+    if self._repeats:
+      out.append(self._note(timestamp, '... %d more %s' % (self._repeats, self._last_kind or 'lines')))
+      self._repeats = 0
+    if self._suppressed:
+      kinds = ', '.join('%d %s' % (count, kind or 'other') for kind, count in self._suppressed.most_common())
+      out.append(self._note(timestamp, '... not shown: %s' % kinds))
+      self._suppressed.clear()
+    self._last_kind = None
+    self._shown = 0
+
+  def _summarize(self, lines, now):
+    out = []
+    for timestamp, msg, line in lines:
+      second = int(timestamp)
+      if second != self._second:
+        self._end_second(timestamp, out)
+        self._second = second
+      kind = _kind(msg)
+      if kind == self._last_kind:
+        self._repeats += 1
+      elif self._shown >= SUMMARY_RATE:
+        self._suppressed[kind] += 1
+        if self._repeats: self._suppressed[self._last_kind] += self._repeats
+        self._last_kind = None
+        self._repeats = 0
+      else:
+        if self._repeats: out.append(self._note(timestamp, '... %d more %s' % (self._repeats, self._last_kind)))
+        self._repeats = 0
+        self._last_kind = kind
+        self._shown += 1
+        out.append(line)
+    if not lines and self._second is not None and int(now) != self._second:
+      self._end_second(now, out)
+      self._second = None
+    return out
+
+  def _run(self):
+    while True:
+      with self._cond:
+        if not self._pending and not self._closed: self._cond.wait(1.0)
+        lines, self._pending = self._pending, []
+        dropped, self._dropped = self._dropped, 0
+        closed = self._closed and not lines
+      now = time.time()
+      out = self._summarize(lines, now) if self._mode == 'summary' else [line for _, _, line in lines]
+      if closed and self._mode == 'summary': self._end_second(now, out)
+      if dropped: out.append(self._note(now, '... %d lines not shown, the console is too slow' % dropped))
+      if out:
+        self._stream.write(''.join(out))
+        self._stream.flush()
+      if closed: return
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._thread.join()
+
+
+class _Sync(threading.Event):
+  '''Queued by LogWriter.checkpoint, and set by the writer thread once the lines before it are written out.'''
+  size = None
+
+
+class LogWriter:
+  '''Writes log lines to a file, and a copy to the console, on a background thread.
+
+  Lines are written to the file in batches and the file is flushed every flush_interval seconds.  If resume is given, the
+  log is cut back to that size (as returned by checkpoint()) and continued, rather than started afresh.  The file is
+  written in binary, with lines encoded as UTF-8, so that its size is a count of bytes that it can be cut back to.
+  '''
+
+  def __init__(self, path, console='all', subsecond=False, flush_interval=1.0, resume=None):
+    if resume is not None: os.truncate(path, resume)
+    self._fp = open(path, 'wb' if resume is None else 'ab')
+    self._flush_interval = flush_interval
+    self._queue = queue.Queue(QUEUE_SIZE)
+    self._timestamps = _Timestamps(subsecond)
+    self._console = _Console(console, _Timestamps(subsecond)) if console else None
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='log', daemon=True)
+    self._thread.start()
+
+  def log(self, msg):
+    if self._error: raise self._error
+    self._queue.put((time.time(), msg))
+
+  def checkpoint(self):
+    '''Wait for the lines logged so far to be written out, and return the size of the log file in bytes.'''
+    sync = _Sync()
+    self._queue.put(sync)
+    sync.wait()
+    if self._error: raise self._error
+    return sync.size
+
+  def _run(self):
+    try:
+      last_flush = time.monotonic()
+      done = False
+      syncs = []
+      while not done:
+        try:
+          batch = [self._queue.get(timeout=self._flush_interval)]
+        except queue.Empty:
+          batch = []
+        while batch and len(batch) < BATCH_SIZE:
+          try:
+            batch.append(self._queue.get_nowait())
+          except queue.Empty:
+            break
+        if None in batch:
+          done = True
+          batch = batch[:batch.index(None)]
+        syncs = [item for item in batch if type(item) is _Sync]  # the analyzer logs nothing until they are set
+        if syncs: batch = [item for item in batch if type(item) is not _Sync]
+        lines = [(timestamp, msg, '%s %s\n' % (self._timestamps.format(timestamp), msg)) for timestamp, msg in batch]
+        if lines:
+          self._fp.write(''.join(line for _, _, line in lines).encode('utf-8', 'backslashreplace'))
+          if self._console: self._console.write(lines)
+        if syncs or time.monotonic() - last_flush >= self._flush_interval:
+          self._fp.flush()
+          last_flush = time.monotonic()
+        for sync in syncs:
+          sync.size = self._fp.tell()
+          sync.set()
+    except Exception as e:
+      self._error = e
+      for sync in syncs: sync.set()
+      while True:  # keep the analyzer from blocking until it closes the log
+        item = self._queue.get()
+        if item is None: break
+        if type(item) is _Sync: item.set()
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+    if self._console: self._console.close()
+    self._fp.close()
+    if self._error: raise self._error
@@ -0,0 +1,214 @@
+'''Queryable index of every mark found by the IWM/SWIM analyzers.
+
+While decoding, each analyzer records every mark it finds, good or bad, in a _marks.db SQLite database alongside its
+other output, with its track, side, and sector, direction, transaction number, offset, and status.  Each mark's
+position in the raw capture (_serial.bin) is recorded too, so a query can go straight to its bytes without decoding
+anything again:
+
+  from markindex import MarkIndex
+  index = MarkIndex('test')
+  for mark in index.query(kind='DM', direction=0, track=37, sector=5):  # every write to track 37, sector 5
+    print(mark.trans, mark.offset, index.raw(mark).hex())
+  index.query(kind='Data', status='BAD CHECKSUM')  # every DCD payload with a bad checksum
+
+The kinds of marks are 'AM', 'DM', and 'IM' (MFM index marks), and 'Data' for DCD payloads.  The status of a good mark
+is 'OK'; that of a bad one is what the log says is wrong with it, for example 'BAD CRC', 'TRUNCATED', or 'WRONG SECTOR'.
+'''
+
+from collections import OrderedDict, namedtuple
+import os
+import re
+import sqlite3
+
+from capture import open_capture
+
+
+BATCH_SIZE = 4096  # marks inserted at a time
+OK = 'OK'
+
+Mark = namedtuple('Mark', 'kind status trans direction offset position length track side sector format number message')
+
+_SCHEMA = (
+  'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+  'CREATE TABLE transactions (number INTEGER PRIMARY KEY, direction INTEGER, start INTEGER)',
+  'CREATE TABLE marks (kind TEXT, status TEXT, trans INTEGER, direction INTEGER, offset INTEGER, position INTEGER, '
+  'length INTEGER, track INTEGER, side INTEGER, sector INTEGER, format INTEGER, number INTEGER, message TEXT)',
+)
+_INDICES = (  # created when the index is closed, as building them at the end is quicker than keeping them up to date
+  ('marks_sector', 'marks (track, side, sector)'),
+  ('marks_status', 'marks (kind, status)'),
+  ('marks_trans', 'marks (trans)'),
+  ('marks_position', 'marks (position)'),
+)
+_ERROR = re.compile(r'(\S+)\s+([A-Z][A-Z ]*[A-Z])')  # kind and status of a mark error message, e.g. "DM  BAD CHECKSUM"
+
+
+def index_path(file_prefix):
+  return '%s_marks.db' % file_prefix
+
+
+def parse_error(message):
+  '''Return the kind and status of a mark from the message of a MarkError, for example ('DM', 'BAD CHECKSUM').'''
+  match = _ERROR.match(message)
+  return match.groups() if match else ('', message)
+
+
+def capture_of(source, file_prefix):
+  '''Return the path of the raw capture that a byte source reads from, and the offset in it at which reading started.'''
+  source = getattr(source, 'source', source)  # unwrap a stats.Stats watch
+  path = getattr(source, 'path', None)
+  if path is not None: return path, getattr(source, 'start', 0)
+  return '%s_serial.bin' % file_prefix, 0
+
+
+class IndexWriter:
+  '''Records marks and transactions in a _marks.db index as they are found.
+
+  Marks are given their offset within their transaction (or within the capture, for marks outside transactions), and
+  their position in the raw capture is worked out from the start of the transaction, which must have been recorded
+  first.  If resume is given (as returned by checkpoint()), the marks and transactions recorded after that point are
+  deleted and the index is continued, rather than started afresh.
+  '''
+
+  def __init__(self, file_prefix, capture, base=0, resume=None):
+    path = index_path(file_prefix)
+    if resume is None and os.path.exists(path): os.unlink(path)
+    self._db = sqlite3.connect(path, check_same_thread=False)  # created on one thread and used on another by host.py
+    self._db.execute('PRAGMA journal_mode = OFF')
+    self._db.execute('PRAGMA synchronous = OFF')
+    self._marks = []
+    self._transactions = []
+    self._starts = OrderedDict()  # transaction number -> start, for the transactions that marks may still be found in
+    if resume is None:
+      for statement in _SCHEMA: self._db.execute(statement)
+      self._db.executemany('INSERT INTO meta VALUES (?, ?)', (('capture', os.path.abspath(capture)), ('base', str(base))))
+      self._count = 0  # marks recorded
+    else:
+      base = int(dict(self._db.execute('SELECT key, value FROM meta'))['base'])
+      for name, _ in _INDICES: self._db.execute('DROP INDEX IF EXISTS %s' % name)
+      self._db.execute('DELETE FROM marks WHERE rowid > ?', (resume['marks'],))
+      self._db.execute('DELETE FROM transactions WHERE number > ?', (resume['transaction'],))
+      self._db.commit()
+      self._count = resume['marks']
+      if resume['start'] is not None: self._starts[resume['transaction']] = resume['start']
+    self._base = base
+
+  def transaction(self, number, direction, start):
+    '''Record that a transaction starts at the given offset in the capture.'''
+    self._transactions.append((number, direction, self._base + start))
+    self._starts[number] = self._base + start
+
+  def mark(self, kind, status, trans, direction, offset, length, track=None, side=None, sector=None, format=None,
+           number=None, message=None):
+    if trans is None:
+      position = self._base + offset
+    else:
+      starts = self._starts
+      while starts and next(iter(starts)) < trans: starts.popitem(last=False)  # marks are found in transaction order
+      position = starts[trans] + offset
+    self._marks.append((kind, status, trans, direction, offset, position, length, track, side, sector, format, number,
+                        message))
+    self._count += 1
+    if len(self._marks) >= BATCH_SIZE: self._flush()
+
+  def error(self, trans, direction, offset, message, length, track=None, side=None, sector=None):
+    '''Record a mark that could not be decoded, with its kind and status taken from the message.'''
+    kind, status = parse_error(message)
+    self.mark(kind, status, trans, direction, offset, length, track, side, sector, message=message)
+
+  def _flush(self):
+    if self._transactions:
+      self._db.executemany('INSERT INTO transactions VALUES (?, ?, ?)', self._transactions)
+      self._transactions = []
+    if self._marks:
+      self._db.executemany('INSERT INTO marks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._marks)
+      self._marks = []
+    self._db.commit()
+
+  def checkpoint(self):
+    '''Commit the marks recorded so far, and return what is needed to carry on recording from here.'''
+    self._flush()
+    transaction, start = next(reversed(self._starts.items()), (-1, None))  # the last, in which marks may still be found
+    return dict(marks=self._count, transaction=transaction, start=start)
+
+  def close(self):
+    self._flush()
+    for name, columns in _INDICES: self._db.execute('CREATE INDEX %s ON %s' % (name, columns))
+    self._db.commit()
+    self._db.close()
+
+
+class MarkIndex:
+  '''Queries a _marks.db index, and slices the bytes of marks out of the raw capture it indexes.
+
+  The capture is memory-mapped (or only the blocks needed are decompressed, for a compressed capture), so slicing even a
+  multi-gigabyte one is immediate.  capture overrides the path of the
+  capture recorded in the index, for example if it has been moved.
+  '''
+
+  def __init__(self, file_prefix, capture=None):
+    self._db = sqlite3.connect('file:%s?mode=ro' % index_path(file_prefix), uri=True)
+    meta = dict(self._db.execute('SELECT key, value FROM meta'))
+    self.capture = capture or meta['capture']
+    self._data = open_capture(self.capture)
+
+  def _select(self, columns, kind=None, status=None, track=None, side=None, sector=None, direction=None, trans=None,
+              start=None, end=None, errors=None, where=None, params=()):
+    conditions = []
+    values = []
+    for column, value in (('kind', kind), ('status', status), ('track', track), ('side', side), ('sector', sector),
+                          ('direction', None if direction is None else int(direction)), ('trans', trans)):
+      if value is not None:
+        conditions.append('%s = ?' % column)
+        values.append(value)
+    if start is not None:
+      conditions.append('position >= ?')
+      values.append(start)
+    if end is not None:
+      conditions.append('position < ?')
+      values.append(end)
+    if errors is not None:
+      conditions.append('status %s ?' % ('!=' if errors else '='))
+      values.append(OK)
+    if where:
+      conditions.append('(%s)' % where)
+      values.extend(params)
+    sql = 'SELECT %s FROM marks' % columns
+    if conditions: sql += ' WHERE ' + ' AND '.join(conditions)
+    return sql, values
+
+  def query(self, **criteria):
+    '''Return a list of the marks matching all of the given criteria, in the order they were found.
+
+    The criteria are kind, status, track, side, sector, direction, and trans; start and end, which limit the position
+    of the marks in the capture; errors, True for only bad marks and False for only good ones; and where, any further
+    SQL condition on the fields of Mark, with params for its placeholders.
+    '''
+    sql, values = self._select(', '.join(Mark._fields), **criteria)
+    return [Mark(*row) for row in self._db.execute(sql + ' ORDER BY rowid', values)]
+
+  def count(self, by=('kind', 'status'), **criteria):
+    '''Return a dict of (values of the fields in by) -> number of marks, for the marks matching the criteria of query().'''
+    for field in by:
+      if field not in Mark._fields: raise ValueError('no such field %r' % field)
+    sql, values = self._select('%s, COUNT(*)' % ', '.join(by), **criteria)
+    return {row[:-1]: row[-1] for row in self._db.execute('%s GROUP BY %s' % (sql, ', '.join(by)), values)}
+
+  def raw(self, mark, before=0, after=0):
+    '''Return the bytes of a mark as captured, with before and after bytes of context.
+
+    A mark that was cut short at the end of its transaction is cut short here too (less any context after it).
+    '''
+    end = mark.position + mark.length
+    if mark.trans is not None:
+      row = self._db.execute('SELECT MIN(start) FROM transactions WHERE number > ?', (mark.trans,)).fetchone()
+      if row[0] is not None: end = min(end, row[0])
+    return self._data[max(mark.position - before, 0):end + after]
+
+  def transactions(self):
+    '''Return a list of (number, direction, start) of each transaction.'''
+    return self._db.execute('SELECT number, direction, start FROM transactions ORDER BY number').fetchall()
+
+  def close(self):
+    self._db.close()
+    if not isinstance(self._data, bytes): self._data.close()
@@ -0,0 +1,256 @@
+'''Packed output of the transactions and data marks found by the IWM/SWIM analyzers.
+
+Rather than writing each transaction and data mark to a file of its own, the analyzers append them to a single
+_pack.bin file and record where each one is in a _pack.idx offset table.  The table starts with a header of a magic
+number and the labels of the two directions (for example 'wr' and 'rd'), followed by fixed-width records of the item
+number, kind, direction, track, side, sector, offset in _pack.bin, and length of each item.  A transaction that is
+interrupted by a data mark being appended continues in a further record with the same item number.
+
+The same sectors are read over and over (retries, verifying after writing, the directory and boot blocks), so a pack
+writer keeps the hashes of the last RECENT_ITEMS data items it stored, in memory only, and a data item identical to one
+of those is not written again, its record pointing at the copy already in _pack.bin instead.  This is only a window: an
+item last stored further back than that is written again, and a resumed pack starts from the hashes of its last
+RECENT_ITEMS data items, taken again from _pack.bin.  Separate files (FileWriter) are never deduplicated.
+
+The legacy layout of one file per item can be recreated from a pack:
+
+  python3 pack.py test [output_prefix]
+'''
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+
+TRANSACTION = 0
+DATA = 1
+KIND_NAMES = ('trans', 'data')
+NO_DIRECTION = 0xFF  # for items whose file name does not include a direction
+NO_VALUE = 0xFFFF  # for the track, side, and sector of a transaction, each of which is otherwise at most 0x7FF
+RECENT_ITEMS = 1 << 14  # data items whose hashes a pack writer remembers, to store each of them only once
+
+PACK_MAGIC = b'IWMPK\x00\x00\x02'
+PACK_HEADER = struct.Struct('<8s4s4s')
+PACK_RECORD = struct.Struct('<IBBHHHQI')
+
+Record = namedtuple('Record', 'number kind direction track side sector offset length')
+
+
+def item_path(file_prefix, kind, number, direction, labels):
+  '''Return the path of the legacy file for an item.'''
+  suffix = '' if direction == NO_DIRECTION else '_%s' % labels[direction]
+  return '%s_%s_%08d%s.bin' % (file_prefix, KIND_NAMES[kind], number, suffix)
+
+
+class FileWriter:
+  '''Writes each transaction and data mark to a file of its own.
+
+  If resume is given (as returned by checkpoint()), the item that was being appended to is cut back and continued.
+  '''
+
+  def __init__(self, file_prefix, labels=None, resume=None):
+    self._file_prefix = file_prefix
+    self._labels = labels
+    self._fp = None
+    self._key = None
+    if resume and resume['item']:
+      self._key = tuple(resume['item'])
+      self._fp = open(item_path(file_prefix, *self._key, labels), 'r+b')
+      self._fp.truncate(resume['size'])
+      self._fp.seek(resume['size'])
+
+  def append(self, kind, number, direction, data):
+    '''Append data to an item that is written piece by piece.'''
+    if self._key != (kind, number, direction):
+      if self._fp: self._fp.close()
+      self._key = (kind, number, direction)
+      self._fp = open(item_path(self._file_prefix, kind, number, direction, self._labels), 'wb')
+    self._fp.write(data)
+
+  def add(self, kind, number, direction, data, track=None, side=None, sector=None):
+    '''Write a complete item.'''
+    with open(item_path(self._file_prefix, kind, number, direction, self._labels), 'wb') as fp: fp.write(data)
+
+  def checkpoint(self):
+    '''Flush the item being appended to, and return what is needed to carry on writing from here.'''
+    if self._fp: self._fp.flush()
+    return dict(item=self._key, size=self._fp.tell() if self._fp else 0)
+
+  def close(self):
+    if self._fp: self._fp.close()
+
+
+class PackWriter:
+  '''Appends each transaction and data mark to a pack file and records it in the pack's offset table.
+
+  Unless dedup is False, a data item identical to one of the last RECENT_ITEMS stored is recorded at the offset of that
+  one rather than written again.  If resume is given (as returned by checkpoint()), the pack is cut back to that point
+  and continued, rather than started afresh.
+  '''
+
+  def __init__(self, file_prefix, labels=None, dedup=True, resume=None):
+    data_path, index_path = '%s_pack.bin' % file_prefix, '%s_pack.idx' % file_prefix
+    self._offset = 0  # size of the pack file
+    self._extent = None  # [number, kind, direction, offset, length] of the item being appended to
+    self._recent = OrderedDict() if dedup else None  # digest -> offset of recent data items, least recent first
+    if resume is None:
+      self._data_fp = open(data_path, 'wb')
+      self._index_fp = open(index_path, 'wb')
+      self._index_fp.write(PACK_HEADER.pack(PACK_MAGIC, *(label.encode('ascii') for label in labels or ('', ''))))
+    else:
+      os.truncate(data_path, resume['size'])
+      os.truncate(index_path, resume['records'])
+      if dedup: self._recall(file_prefix)
+      self._data_fp = open(data_path, 'ab')
+      self._index_fp = open(index_path, 'ab')
+      self._offset = resume['size']
+      self._extent = resume['extent']
+    self.duplicates = 0  # data items not written again
+    self.duplicate_bytes = 0
+
+  def _recall(self, file_prefix):
+    '''Remember the most recently stored data items of the pack being continued, as if they had just been stored.'''
+    reader = PackReader(file_prefix)
+    try:
+      recent = OrderedDict()  # most recent first, to begin with
+      seen = set()  # offsets of the data items already hashed
+      for index in reversed(range(len(reader))):
+        record = reader[index]
+        if record.kind != DATA or record.offset in seen: continue
+        seen.add(record.offset)
+        view = reader.view(record)
+        recent.setdefault(hashlib.blake2b(view, digest_size=16).digest(), record.offset)
+        view.release()
+        if len(recent) == RECENT_ITEMS: break
+      for digest in reversed(recent): self._recent[digest] = recent[digest]
+    finally:
+      reader.close()
+
+  def _write_record(self, number, kind, direction, track, side, sector, offset, length):
+    self._index_fp.write(PACK_RECORD.pack(number, kind, direction, NO_VALUE if track is None else track,
+                                          NO_VALUE if side is None else side, NO_VALUE if sector is None else sector,
+                                          offset, length))
+
+  def _end_extent(self):
+    if not self._extent: return
+    number, kind, direction, offset, length = self._extent
+    self._write_record(number, kind, direction, None, None, None, offset, length)
+    self._extent = None
+
+  def append(self, kind, number, direction, data):
+    '''Append data to an item that is written piece by piece.'''
+    extent = self._extent
+    if extent and extent[:3] == [number, kind, direction] and extent[3] + extent[4] == self._offset:
+      extent[4] += len(data)
+    else:
+      self._end_extent()
+      self._extent = [number, kind, direction, self._offset, len(data)]
+    self._data_fp.write(data)
+    self._offset += len(data)
+
+  def add(self, kind, number, direction, data, track=None, side=None, sector=None):
+    '''Append a complete item, or if it is identical to a recent one, record it at the offset of that one.'''
+    recent = self._recent
+    if recent is not None:
+      digest = hashlib.blake2b(data, digest_size=16).digest()
+      offset = recent.get(digest)
+      if offset is not None:
+        recent.move_to_end(digest)
+        self._write_record(number, kind, direction, track, side, sector, offset, len(data))
+        self.duplicates += 1
+        self.duplicate_bytes += len(data)
+        return
+      recent[digest] = self._offset
+      if len(recent) > RECENT_ITEMS: recent.popitem(last=False)
+    self._data_fp.write(data)
+    self._write_record(number, kind, direction, track, side, sector, self._offset, len(data))
+    self._offset += len(data)
+
+  def checkpoint(self):
+    '''Flush the pack, and return what is needed to carry on writing it from here.'''
+    self._data_fp.flush()
+    self._index_fp.flush()
+    return dict(size=self._offset, records=self._index_fp.tell(), extent=self._extent and list(self._extent))
+
+  def close(self):
+    self._end_extent()
+    self._data_fp.close()
+    self._index_fp.close()
+
+
+class PackReader:
+  '''Reads a pack without loading it into memory; item data is returned as memoryviews into the mapped pack file.
+
+  The memoryviews must be released before the reader is closed.  Identical data items may share the same offset.
+  '''
+
+  def __init__(self, file_prefix):
+    self._data_fp = open('%s_pack.bin' % file_prefix, 'rb')
+    self._index_fp = open('%s_pack.idx' % file_prefix, 'rb')
+    self._data = self._map(self._data_fp)
+    self._index = self._map(self._index_fp)
+    if len(self._index) < PACK_HEADER.size: raise ValueError('%s_pack.idx is not a pack index' % file_prefix)
+    magic, *labels = PACK_HEADER.unpack_from(self._index)
+    if magic != PACK_MAGIC: raise ValueError('%s_pack.idx is not a pack index' % file_prefix)
+    self.labels = tuple(label.rstrip(b'\x00').decode('ascii') for label in labels)
+    self._count = (len(self._index) - PACK_HEADER.size) // PACK_RECORD.size
+    self._view = memoryview(self._data)
+    self._items = None  # (kind, number) -> indices of its records
+
+  @staticmethod
+  def _map(fp):
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fp.fileno()).st_size else b''
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if not 0 <= index < self._count: raise IndexError(index)
+    record = PACK_RECORD.unpack_from(self._index, PACK_HEADER.size + index * PACK_RECORD.size)
+    return Record(*record[:3], *(None if value == NO_VALUE else value for value in record[3:6]), *record[6:])
+
+  def __iter__(self):
+    return (self[index] for index in range(self._count))
+
+  def view(self, record):
+    '''Return the data of a record as a memoryview.'''
+    return self._view[record.offset:record.offset + record.length]
+
+  def item(self, kind, number):
+    '''Return the data of an item as a list of memoryviews, one for each of its records, or None if there is no such item.'''
+    if self._items is None:
+      self._items = {}
+      for index, record in enumerate(self): self._items.setdefault((record.kind, record.number), []).append(index)
+    indices = self._items.get((kind, number))
+    return None if indices is None else [self.view(self[index]) for index in indices]
+
+  def close(self):
+    self._view.release()
+    if self._data: self._data.close()
+    if self._index: self._index.close()
+    self._data_fp.close()
+    self._index_fp.close()
+
+
+def export(pack_prefix, file_prefix=None):
+  '''Write each item in a pack to a file of its own, as the analyzers did before packs.'''
+  reader = PackReader(pack_prefix)
+  written = set()
+  try:
+    for record in reader:
+      path = item_path(pack_prefix if file_prefix is None else file_prefix, record.kind, record.number, record.direction,
+                       reader.labels)
+      with open(path, 'ab' if path in written else 'wb') as fp:
+        view = reader.view(record)
+        fp.write(view)
+        view.release()
+      written.add(path)
+  finally:
+    reader.close()
+
+
+if __name__ == '__main__':
+  export(*sys.argv[1:3])
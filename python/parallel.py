@@ -0,0 +1,225 @@
+'''Decode one large GCR or MFM capture across several processes.
+
+The capture is split into chunks at points where decoding cannot carry over from one chunk to the next: direction changes
+for GCR (marks never span a transaction) and, for MFM, index marks (or any other point) that no valid mark spans.  Each
+chunk is decoded in a worker process and the results are merged in order, producing the same .log and the same
+transactions and data marks, with the same numbering, as a single-process replay of the capture.  For GCR, the pieces of
+each transaction are written out between its data marks just as a single-process replay reads them, so even a pack is
+the same, record for record.
+
+  import analyzer_gcr
+  from parallel import analyze_parallel
+  analyze_parallel(analyzer_gcr, 'test_serial.bin', 'replay')
+'''
+
+from collections import deque
+import concurrent.futures
+import importlib
+import os
+
+from capture import REPLAY_CHUNK_SIZE, FileSource, TimestampIndex, open_capture, timestamp_path
+import analyzer_gcr
+import analyzer_mfm
+from events import DataMark, MarkError
+from pack import TRANSACTION
+
+
+# names of the attributes holding the state carried from the last address mark
+_STATE = {'analyzer_gcr': ('_track', '_sector', '_side', '_fmt'),
+          'analyzer_mfm': ('_track', '_sector', '_side', '_size')}
+
+_SCAN_LENGTH = 1 << 24
+
+
+def _decode_chunk(module_name, path, start, end, lookahead, first_trans, state):
+  '''Decode the chunk of the capture from start to end.  Runs in a worker process.
+
+  Returns the events, each with the state after it, and whether a data mark was decoded without knowing the last address
+  mark.
+  '''
+  module = importlib.import_module(module_name)
+  state_names = _STATE[module_name]
+  analyzer = module.Analyzer(FileSource(path, start=start, end=end + lookahead), None)
+  for name, value in zip(state_names, state): setattr(analyzer, name, value)
+  if module is analyzer_gcr:
+    analyzer._cur_trans_num = first_trans - 1
+  else:
+    analyzer._reader._tell = start
+  records = []
+  needs_state = False
+  for event in analyzer.events():
+    if module is analyzer_mfm and event.offset >= end: continue  # lookahead, belongs to the next chunk
+    # a data mark, good or bad, is recorded with the track, side, and sector of the last address mark
+    if analyzer._sector is None and (type(event) is DataMark or
+                                     type(event) is MarkError and event.message.startswith('DM')):
+      needs_state = True
+    records.append((event, tuple(getattr(analyzer, name) for name in state_names)))
+  return records, needs_state
+
+
+def _count_dir_changes(data, start, end):
+  '''Count the direction changes between consecutive bytes from start to end of GCR serial data.'''
+  count = 0
+  for pos in range(start, end, _SCAN_LENGTH):
+    dirs = data[pos:min(pos + _SCAN_LENGTH + 1, end)].translate(analyzer_gcr.TransactionReader.DIR_TABLE)
+    count += dirs.count(b'\x00\x01') + dirs.count(b'\x01\x00')
+  return count
+
+
+def _gcr_split(data, pos):
+  '''Return the first position at or after pos where the direction changes, or the end of the data.'''
+  if pos >= len(data): return len(data)
+  while pos < len(data):
+    dirs = data[pos:pos + _SCAN_LENGTH].translate(analyzer_gcr.TransactionReader.DIR_TABLE)
+    change = dirs.find(b'\x00' if dirs[0] else b'\x01')
+    if change != -1: return pos + change
+    pos += len(dirs)
+  return len(data)
+
+
+def _mfm_split_ok(data, pos):
+  '''Return True if no index mark or valid address or data mark starting before pos extends past it.'''
+  index_pos = data.find(b'\xC2\xC2\xC2\xFC', max(pos - 3, 0), pos + 3)
+  if index_pos != -1 and index_pos < pos: return False
+  mark_pos = max(pos - analyzer_mfm.Analyzer.DATA_MARK_LENGTH + 1, 0)
+  while True:
+    mark_pos = data.find(b'\xA1\xA1\xA1', mark_pos, pos + 2)
+    if mark_pos == -1 or mark_pos >= pos: return True
+    length = analyzer_mfm.Analyzer.MARK_LENGTHS.get(data[mark_pos + 3]) if mark_pos + 3 < len(data) else None
+    if length and mark_pos + length > pos and analyzer_mfm.check_marks(data[mark_pos:mark_pos + length], ((0, length),))[0]:
+      return False
+    mark_pos += 1
+
+
+def _mfm_split(data, pos):
+  '''Return the first index mark at or after pos that makes a safe split point, or failing that, any safe position.'''
+  index_pos = data.find(b'\xC2\xC2\xC2\xFC', pos, pos + _SCAN_LENGTH)
+  while index_pos != -1:
+    if _mfm_split_ok(data, index_pos): return index_pos
+    index_pos = data.find(b'\xC2\xC2\xC2\xFC', index_pos + 1, pos + _SCAN_LENGTH)
+  while pos < len(data) and not _mfm_split_ok(data, pos): pos += 1
+  return min(pos, len(data))
+
+
+def _transactions(data, start, end, first_trans):
+  '''Yield (number, direction, start, end) for each GCR transaction from start to end of the serial data, the first of
+  which is numbered first_trans.'''
+  trans_num = first_trans
+  while start < end:
+    trans_end = min(_gcr_split(data, start), end)
+    yield trans_num, 1 if data[start] & 0x80 else 0, start, trans_end
+    trans_num += 1
+    start = trans_end
+
+
+def _read_ends(path, size):
+  '''Yield the offset at which each read of a FileSource replaying the capture ends, in order.'''
+  timestamps = TimestampIndex(timestamp_path(path)) if os.path.exists(timestamp_path(path)) else None
+  try:
+    timeouts = timestamps.timeouts() if timestamps else iter(())
+    next_timeout = next(timeouts, None)
+    pos = 0
+    while pos < size:
+      while next_timeout is not None and next_timeout <= pos: next_timeout = next(timeouts, None)
+      pos = min(pos + REPLAY_CHUNK_SIZE, size, size if next_timeout is None else next_timeout)
+      yield pos
+  finally:
+    if timestamps: timestamps.close()
+
+
+def _pieces(transactions, read_ends, read_end):
+  '''Yield (number, direction, start, end) for each piece of the given GCR transactions that a single-process replay
+  reads at a time, given an iterator of the ends of the reads of the capture and the end of the current one.'''
+  for trans_num, this_dir, trans_start, trans_end in transactions:
+    pos = trans_start
+    while pos < trans_end:
+      while read_end[0] <= pos: read_end[0] = next(read_ends)
+      end = min(pos + analyzer_gcr.Analyzer.READ_LENGTH, read_end[0], trans_end)
+      yield trans_num, this_dir, pos, end
+      pos = end
+
+
+def _handle_gcr(analyzer, records, state_names, data, pieces, starts):
+  '''Write out the pieces of a chunk's GCR transactions, handling each data mark once the piece it ends in is written,
+  as a single-process replay does, so that the pack is written in the same order.'''
+  records = deque(records)
+  for trans_num, this_dir, start, end in pieces:
+    if analyzer._output:
+      analyzer._output.append(TRANSACTION, trans_num, this_dir,
+                              data[start:end].translate(analyzer_gcr.TransactionReader.SET_MSB_TABLE))
+    while records:
+      event = records[0][0]
+      mark_end = starts[event.trans] + event.offset + (analyzer.DATA_MARK_LENGTH if type(event) is DataMark else 1)
+      if mark_end > end: break
+      _handle(analyzer, *records.popleft(), state_names)
+  for record in records: _handle(analyzer, *record, state_names)
+
+
+def _handle(analyzer, event, event_state, state_names):
+  for name, value in zip(state_names, event_state): setattr(analyzer, name, value)  # for indexing mark errors
+  analyzer._handle(event)
+
+
+def _chunks(module, data, chunk_size):
+  '''Yield (start, end, first transaction number) for each chunk of the capture.'''
+  start = 0
+  trans_num = 0
+  while start < len(data):
+    if module is analyzer_gcr:
+      end = _gcr_split(data, start + chunk_size)
+    else:
+      end = _mfm_split(data, start + chunk_size)
+    yield start, end, trans_num
+    if module is analyzer_gcr and end < len(data): trans_num += _count_dir_changes(data, start, end + 1)
+    start = end
+
+
+def analyze_parallel(module, path, file_prefix, workers=None, chunk_size=1 << 24, **options):
+  '''Decode the capture at path with the given analyzer module (analyzer_gcr or analyzer_mfm) using worker processes.
+
+  Any keyword options (pack, image, console, subsecond, index) are passed to the analyzer.
+  '''
+  lookahead = 0 if module is analyzer_gcr else analyzer_mfm.Analyzer.DATA_MARK_LENGTH
+  state_names = _STATE[module.__name__]
+  analyzer = module.Analyzer(FileSource(path), file_prefix, **options)
+  unknown_state = state = (None,) * len(state_names)
+  workers = workers or os.cpu_count()
+  with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+    data = open_capture(path)
+    read_ends = _read_ends(path, len(data))
+    read_end = [0]  # end of the read that the last piece of a transaction came from
+    pending = deque()
+    data_mark = -1
+    chunks = _chunks(module, data, chunk_size)
+    try:
+      while True:
+        while len(pending) < 2 * workers:
+          chunk = next(chunks, None)
+          if chunk is None: break
+          start, end, first_trans = chunk
+          future = executor.submit(_decode_chunk, module.__name__, path, start, end, lookahead, first_trans, unknown_state)
+          pending.append((chunk, future))
+        if not pending: break
+        (start, end, first_trans), future = pending.popleft()
+        records, needs_state = future.result()
+        if needs_state and state != unknown_state:
+          # the chunk decoded data marks before its first address mark, so decode it again knowing the last one
+          records, _ = _decode_chunk(module.__name__, path, start, end, lookahead, first_trans, state)
+        for event, _ in records:
+          if type(event) is DataMark:
+            data_mark += 1
+            event.number = data_mark
+        if module is analyzer_gcr:
+          transactions = list(_transactions(data, start, end, first_trans))
+          for trans_num, this_dir, trans_start, _ in transactions:
+            for recorder in analyzer._recorders: recorder.transaction(trans_num, this_dir, trans_start)
+          starts = {trans_num: trans_start for trans_num, _, trans_start, _ in transactions}
+          _handle_gcr(analyzer, records, state_names, data, _pieces(transactions, read_ends, read_end), starts)
+        else:
+          for event, event_state in records: _handle(analyzer, event, event_state, state_names)
+        if records: state = records[-1][1]
+    except KeyboardInterrupt:
+      for _, future in pending: future.cancel()
+    finally:
+      if not isinstance(data, bytes): data.close()
+      analyzer._close()
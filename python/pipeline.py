@@ -0,0 +1,63 @@
+'''Verification of the marks framed by the GCR and MFM analyzers, optionally on a pool of worker processes.
+
+An analyzer frames candidate marks by their signatures and lengths alone, which is cheap enough to keep up with any burst
+of input, and leaves checking them (nibbles, checksums, CRCs) to a verify function that needs nothing but the bytes of the
+mark.  verified() batches the candidates, verifies each batch in turn or on worker processes, and hands back each
+candidate with its result in the order they were framed, so the analyzer can go on to apply what depends on the marks
+before it (the sector of the last address mark, the numbering of data marks) exactly as if it had verified them itself.
+
+With workers, at most depth batches are verified at a time; a framer that gets that far ahead waits for the oldest one.
+Since it is the capture thread, not the analyzer, that drains the serial port, a burst of marks only ever adds to the lag
+(see stats.py), never to the backlog in the port.
+'''
+
+from collections import deque
+import concurrent.futures
+from itertools import chain
+
+
+FLUSH = None  # yielded by a framer before it reads more input, which may mean waiting for it
+DRAIN = object()  # yielded in place of FLUSH when every candidate framed so far must be handled first (for a checkpoint)
+BATCH_SIZE = 256  # candidates verified at a time
+
+
+def _verify_batch(verify, batch):
+  return [verify(data) for data in batch]
+
+
+def verified(candidates, verify, stats, workers=None, depth=None):
+  '''Yield (candidate, verify(candidate[-1])) for each of the candidates except FLUSH and DRAIN, in order.
+
+  Without workers, the candidates are verified a batch at a time on this thread.  Either way, when a framer reading a
+  live source has read everything received so far, the candidates framed so far are all verified before it waits for
+  more input, so no mark waits on the next one to be logged.  So are they when the framer yields DRAIN.
+  '''
+  executor = concurrent.futures.ProcessPoolExecutor(workers) if workers else None
+  depth = depth or 2 * (workers or 1)
+  pending = deque()  # (batch, future) of each batch being verified, oldest first
+  batch = []
+  end = object()
+  try:
+    for candidate in chain(candidates, (end,)):
+      if candidate is not FLUSH and candidate is not DRAIN and candidate is not end:
+        batch.append(candidate)
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        if len(batch) < BATCH_SIZE: continue
+      if batch:
+        data = [item[-1] for item in batch]
+        if executor:
+          pending.append((batch, executor.submit(_verify_batch, verify, data)))
+        else:
+          stats.queued -= len(batch)
+          yield from zip(batch, _verify_batch(verify, data))
+        batch = []
+      drain = candidate is end or candidate is DRAIN or candidate is FLUSH and stats.idle()
+      while pending and (drain or len(pending) > depth or pending[0][1].done()):
+        if not (drain or pending[0][1].done()): stats.queue_waits += 1
+        done_batch, future = pending.popleft()
+        results = future.result()
+        stats.queued -= len(done_batch)
+        yield from zip(done_batch, results)
+  finally:
+    if executor: executor.shutdown(cancel_futures=True)
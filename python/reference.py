@@ -0,0 +1,391 @@
+'''Reference implementations of the decoders of the IWM/SWIM analyzers, kept as oracles for fuzz.py.
+
+Each one decodes the plainest way it can, a byte at a time, as the analyzers first did: the GCR and MFM scanners step
+through the serial data looking for the signature of a mark at each byte in turn, GCR data marks are denibblized and
+demangled a byte at a time, CRCs are worked out bit by bit, and the DCD decoders are fed one byte at a time.  The
+nibble table, denibblize, demangle, and the DCD decoders are frozen copies of the originals in the analyzers, so that
+a change to those cannot change the oracle along with what it checks.  They are far too slow for a capture of any
+size, but what they produce is the definition of what the analyzers' fast paths must produce, event for event and byte
+for byte.
+'''
+
+from events import AddressMark, DataMark, DcdPayload, Desync, IndexMark, MarkError, TransactionEnd
+
+
+DONE = 1  # as returned by the feed() method of the analyzer's DCD decoders
+DEAD = 2
+BAD = 3
+
+GCR_ADDRESS_MARK_LENGTH = 10
+GCR_DATA_MARK_LENGTH = 709
+MFM_INDEX_MARK_LENGTH = 4
+MFM_ADDRESS_MARK_LENGTH = 10
+MFM_DATA_MARK_LENGTH = 518
+
+
+def crc16(data, reg=0xFFFF, poly=0x1021):
+  '''Return the CRC of data, a bit at a time.'''
+  for byte in data:
+    reg ^= byte << 8
+    for _ in range(8): reg = (reg << 1 ^ poly if reg & 0x8000 else reg << 1) & 0xFFFF
+  return reg
+
+
+# GCR
+
+IWM_TO_NIBBLE = [None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None,
+                 None, None, None, None, None, None, 0x00, 0x01, None, None, 0x02, 0x03, None, 0x04, 0x05, 0x06,
+                 None, None, None, None, None, None, 0x07, 0x08, None, None, None, 0x09, 0x0A, 0x0B, 0x0C, 0x0D,
+                 None, None, 0x0E, 0x0F, 0x10, 0x11, 0x12, 0x13, None, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1A,
+                 None, None, None, None, None, None, None, None, None, None, None, 0x1B, None, 0x1C, 0x1D, 0x1E,
+                 None, None, None, 0x1F, None, None, 0x20, 0x21, None, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28,
+                 None, None, None, None, None, 0x29, 0x2A, 0x2B, None, 0x2C, 0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x32,
+                 None, None, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, None, 0x39, 0x3A, 0x3B, 0x3C, 0x3D, 0x3E, 0x3F]
+
+
+class DenibblizeError(Exception): pass
+
+
+def denibblize(data):
+  '''Generator to denibblize data.'''
+  data = iter(data)
+  while True:
+    try:
+      hi_bits = next(data)
+    except StopIteration:
+      return
+    try:
+      yield next(data) | ((hi_bits << 2) & 0xC0)
+    except StopIteration:
+      raise DenibblizeError('denibblization ended on unused hi-bits nibble (0x%02X)' % hi_bits)
+    try:
+      yield next(data) | ((hi_bits << 4) & 0xC0)
+    except StopIteration:
+      if hi_bits & 0x0F:
+        raise DenibblizeError('denibblization ended on partially-unused hi-bits nibble (0x%02X)' % hi_bits)
+    try:
+      yield next(data) | ((hi_bits << 6) & 0xC0)
+    except StopIteration:
+      if hi_bits & 0x03:
+        raise DenibblizeError('denibblization ended on partially-unused hi-bits nibble (0x%02X)' % hi_bits)
+      return
+
+
+def demangle(data):
+  '''Decoder for mangled GCR data.  Returns a 3-tuple of (demangled data, target checksum, actual checksum).'''
+  target_checksum = tuple(denibblize(data[-4:]))
+  data = bytearray(denibblize(data[:-4]))
+  view = memoryview(data)
+  checksum_a = checksum_b = checksum_c = 0
+  for i in range((len(data) + 2) // 3):
+    trio = view[i * 3:(i + 1) * 3]
+    carry = 1 if (checksum_c & 0x80) else 0
+    checksum_c = ((checksum_c << 1) & 0xFF) | carry
+    trio[0] ^= checksum_c
+    carry, checksum_a = divmod(checksum_a + trio[0] + carry, 256)
+    if len(trio) < 2: break
+    trio[1] ^= checksum_a
+    carry, checksum_b = divmod(checksum_b + trio[1] + carry, 256)
+    if len(trio) < 3: break
+    trio[2] ^= checksum_b
+    carry, checksum_c = divmod(checksum_c + trio[2] + carry, 256)
+  actual_checksum = (checksum_a, checksum_b, checksum_c)
+  return data, target_checksum, actual_checksum
+
+
+def gcr_transactions(data):
+  '''Split GCR serial data into transactions at each change of direction.
+
+  Returns a list of (direction, data) for each transaction, with the most significant bit of each byte of data set.
+  '''
+  transactions = []
+  last_dir = None
+  for byte in data:
+    this_dir = bool(byte & 0x80)
+    if this_dir != last_dir:
+      transactions.append((this_dir, bytearray()))
+      last_dir = this_dir
+    transactions[-1][1].append(byte | 0x80)
+  return transactions
+
+
+def gcr_verify_mark(data):
+  '''Check a candidate GCR mark as analyzer_gcr.verify_mark does, returning the same (message, consumed, value).'''
+  if data[2] == 0x96:
+    if len(data) != GCR_ADDRESS_MARK_LENGTH:
+      return 'AM  TRUNCATED (length %d, should be %d)' % (len(data), GCR_ADDRESS_MARK_LENGTH), False, None
+    if not data.endswith(b'\xDE\xAA'): return 'AM  MISSING BIT SLIP BYTES', False, None
+    address_mark = tuple(IWM_TO_NIBBLE[byte & 0x7F] for byte in data[3:8])
+    if None in address_mark:
+      invalid_nibbles = tuple(('0x%02X' % (byte | 0x80)) for byte in data[3:8] if IWM_TO_NIBBLE[byte & 0x7F] is None)
+      return 'AM  INVALID NIBBLE(S) %s' % ', '.join(invalid_nibbles), False, None
+    track, sector, side, fmt, stored_checksum = address_mark
+    calc_checksum = track ^ sector ^ side ^ fmt
+    if stored_checksum != calc_checksum:
+      return 'AM  BAD CHECKSUM, 0x%02X != 0x%02X' % (stored_checksum, calc_checksum), False, address_mark
+    return None, True, address_mark
+  if len(data) != GCR_DATA_MARK_LENGTH:
+    return 'DM  TRUNCATED (length %d, should be %d)' % (len(data), GCR_DATA_MARK_LENGTH), False, None
+  if not data.endswith(b'\xDE\xAA'): return 'DM  MISSING BIT SLIP BYTES', False, None
+  data_mark_sector = IWM_TO_NIBBLE[data[3] & 0x7F]
+  if data_mark_sector is None: return 'DM  INVALID SECTOR NIBBLE 0x%02X' % (data[3] | 0x80), False, None
+  nibbles = [IWM_TO_NIBBLE[byte & 0x7F] for byte in data[4:707]]
+  if None in nibbles:
+    invalid_nibbles = tuple(('0x%02X' % (byte | 0x80)) for byte in data[4:707] if IWM_TO_NIBBLE[byte & 0x7F] is None)
+    return 'DM  INVALID NIBBLE(S) %s' % ', '.join(invalid_nibbles), False, None
+  try:
+    data, target_checksum, actual_checksum = demangle(nibbles)
+  except DenibblizeError as e:
+    return 'DM  DENIBBLIZE ERROR: %s' % e.args[0], True, None
+  if target_checksum != actual_checksum:
+    return 'DM  BAD CHECKSUM: %s, should be %s' % (actual_checksum, target_checksum), True, (data_mark_sector, data)
+  return None, True, (data_mark_sector, data)
+
+
+def gcr_events(data):
+  '''Return the events that analyzer_gcr.Analyzer.events() yields for GCR serial data, and its transactions.'''
+  events = []
+  transactions = gcr_transactions(data)
+  track = sector = side = fmt = None
+  number = -1
+  for trans, (direction, data) in enumerate(transactions):
+    pos = 0
+    while pos < len(data):
+      signature = data[pos:pos + 3]
+      if signature == b'\xD5\xAA\x96':
+        mark = bytes(data[pos:pos + GCR_ADDRESS_MARK_LENGTH])
+        message, consumed, value = gcr_verify_mark(mark)
+        if value: track, sector, side, fmt, _ = value
+        if message:
+          events.append(MarkError(trans, direction, pos, message))
+        else:
+          track = ((side << 6) | track) & 0x7FF
+          side >>= 5
+          events.append(AddressMark(trans, direction, pos, track, sector, side, fmt))
+      elif signature == b'\xD5\xAA\xAD':
+        mark = bytes(data[pos:pos + GCR_DATA_MARK_LENGTH])
+        message, consumed, value = gcr_verify_mark(mark)
+        if value is None:
+          events.append(MarkError(trans, direction, pos, message))
+        elif value[0] != sector:
+          events.append(MarkError(trans, direction, pos, 'DM  WRONG SECTOR: %d, should be %s' % (value[0], sector)))
+        elif message:
+          events.append(MarkError(trans, direction, pos, message))
+        else:
+          number += 1
+          events.append(DataMark(trans, direction, pos, number, track, sector, side, fmt, bytes(value[1])))
+      else:
+        consumed = False
+      pos += len(mark) if consumed else 1
+  return events, [(direction, bytes(data)) for direction, data in transactions]
+
+
+# MFM
+
+def mfm_verify_mark(data):
+  '''Check a candidate MFM mark as analyzer_mfm.verify_mark does, returning the error to log or None.'''
+  if data[3] == 0xFC: return None
+  kind, length = ('AM', MFM_ADDRESS_MARK_LENGTH) if data[3] == 0xFE else ('DM', MFM_DATA_MARK_LENGTH)
+  if len(data) != length: return '%s  TRUNCATED (length %d, should be %d)' % (kind, len(data), length)
+  if crc16(data): return '%s  BAD CRC' % kind
+  return None
+
+
+def mfm_events(data):
+  '''Return the events that analyzer_mfm.Analyzer.events() yields for MFM serial data.'''
+  events = []
+  track = sector = side = size = None
+  number = -1
+  pos = 0
+  while pos < len(data):
+    signature = data[pos:pos + 4]
+    if signature == b'\xC2\xC2\xC2\xFC':
+      length = MFM_INDEX_MARK_LENGTH
+    elif signature == b'\xA1\xA1\xA1\xFE':
+      length = MFM_ADDRESS_MARK_LENGTH
+    elif signature == b'\xA1\xA1\xA1\xFB':
+      length = MFM_DATA_MARK_LENGTH
+    else:
+      pos += 1
+      continue
+    mark = bytes(data[pos:pos + length])
+    message = mfm_verify_mark(mark)
+    if message:
+      events.append(MarkError(None, None, pos, message))
+      pos += 1
+      continue
+    if length == MFM_INDEX_MARK_LENGTH:
+      events.append(IndexMark(pos))
+    elif length == MFM_ADDRESS_MARK_LENGTH:
+      track, side, sector, size = mark[4:8]
+      events.append(AddressMark(None, None, pos, track, sector, side, size))
+    else:
+      number += 1
+      events.append(DataMark(None, None, pos, number, track, sector, side, size, mark[4:]))
+    pos += length
+  return events
+
+
+# DCD
+
+class MacToDcdDecoder:
+  '''The state machine of the analyzer's decoder of commands from the Macintosh, a byte at a time.'''
+
+  def __init__(self):
+    self.sync_tell = None  # offset of the first byte fed after a reset, kept here as the analyzer keeps it
+    self.reset()
+
+  def reset(self):
+    self._accept_data = True
+    self._sync = False
+    self._first_sync = True
+    self._out_groups = None
+    self._in_groups = None
+    self._data = None
+    self._lsb_byte = None
+    self._data_idx = None
+
+  def feed_byte(self, byte):
+    if not self._accept_data: return False, False, False
+    if not self._sync:
+      if byte == 0xAA: self._sync = True
+      if self._first_sync:
+        self._first_sync = False
+        return True, False, True
+      else:
+        return False, False, True
+    elif not self._out_groups:
+      self._out_groups = byte & 0x7F
+      self._data = bytearray(self._out_groups * 7)
+      self._data_idx = 0
+    elif not self._in_groups:
+      self._in_groups = byte & 0x7F
+    elif self._lsb_byte is None:
+      self._lsb_byte = byte | 0x80
+    else:
+      lsb = self._lsb_byte & 0x01
+      self._lsb_byte >>= 1
+      if self._lsb_byte == 0x01:
+        self._lsb_byte = None
+        if byte & 0x80 == 0x00: self._sync = False  # in a holdoff, wait for another sync byte
+      self._data[self._data_idx] = ((byte & 0x7F) << 1) | lsb
+      self._data_idx += 1
+      if self._data_idx == len(self._data):
+        self._accept_data = False
+        if sum(self._data) & 0xFF == 0x00 and self._data[0] & 0x80 == 0x00: return False, True, False
+    return False, False, self._accept_data
+
+  def result(self):
+    return self._in_groups, self._data
+
+
+class DcdToMacDecoder:
+  '''The state machine of the analyzer's decoder of replies from a DCD device, a byte at a time.'''
+
+  def __init__(self):
+    self.sync_tell = None
+    self.reset()
+
+  def reset(self, in_groups=0):
+    self._accept_data = True if in_groups else False
+    self._sync = False
+    self._first_sync = True
+    self._in_groups = in_groups
+    self._data = bytearray(in_groups * 7)
+    self._expect_lsb_byte = False
+    self._data_idx = 0
+
+  def feed_byte(self, byte):
+    if not self._accept_data: return False, False, False
+    if not self._sync:
+      if byte == 0xAA: self._sync = True
+      if self._first_sync:
+        self._first_sync = False
+        return True, False, True
+      else:
+        return False, False, True
+    elif self._expect_lsb_byte:
+      self._data[self._data_idx - 7] = (self._data[self._data_idx - 7] << 1) | (1 if byte & 0x01 else 0)
+      self._data[self._data_idx - 6] = (self._data[self._data_idx - 6] << 1) | (1 if byte & 0x02 else 0)
+      self._data[self._data_idx - 5] = (self._data[self._data_idx - 5] << 1) | (1 if byte & 0x04 else 0)
+      self._data[self._data_idx - 4] = (self._data[self._data_idx - 4] << 1) | (1 if byte & 0x08 else 0)
+      self._data[self._data_idx - 3] = (self._data[self._data_idx - 3] << 1) | (1 if byte & 0x10 else 0)
+      self._data[self._data_idx - 2] = (self._data[self._data_idx - 2] << 1) | (1 if byte & 0x20 else 0)
+      self._data[self._data_idx - 1] = (self._data[self._data_idx - 1] << 1) | (1 if byte & 0x40 else 0)
+      if byte & 0x80 == 0x00: self._sync = False
+      self._expect_lsb_byte = False
+      if self._data_idx == len(self._data):
+        self._accept_data = False
+        if sum(self._data) & 0xFF == 0x00 and self._data[0] & 0x80: return False, True, False
+    else:
+      self._data[self._data_idx] = byte & 0x7F
+      self._data_idx += 1
+      if self._data_idx % 7 == 0: self._expect_lsb_byte = True
+    return False, False, self._accept_data
+
+  def result(self):
+    return self._in_groups, self._data
+
+
+def dcd_feed(decoder, data, start, end, tell):
+  '''Feed data[start:end] to a DCD decoder a byte at a time, returning what its feed() method returns.'''
+  for pos in range(start, end):
+    if not decoder._accept_data: return DEAD, pos
+    first, done, _ = decoder.feed_byte(data[pos])
+    if first: decoder.sync_tell = tell + pos
+    if done: return DONE, pos
+    if not decoder._accept_data: return BAD, pos
+  return None, end
+
+
+def dcd_events(chunks):
+  '''Return the events that analyzer_dcd.Analyzer.events() yields for DCD serial data, and its transactions.
+
+  chunks are the data as read from the serial port, with b'' for each time the port timed out.
+  '''
+  events = []
+  transactions = []
+  mac_to_dcd = MacToDcdDecoder()
+  dcd_to_mac = DcdToMacDecoder()
+  mid_transaction = False
+  reply_expected = False  # whether the last payload was a command from the Macintosh
+  number = -1
+  for chunk in chunks:
+    if not chunk:
+      if mid_transaction:
+        mid_transaction = reply_expected = False
+        mac_to_dcd.reset()
+        dcd_to_mac.reset()
+        events.append(TransactionEnd(len(transactions) - 1))
+      continue
+    for byte in chunk:
+      if not mid_transaction:
+        mid_transaction = True
+        transactions.append(bytearray())
+      trans = len(transactions) - 1
+      tell = len(transactions[trans])
+      transactions[trans].append(byte)
+      expected = dcd_to_mac if reply_expected else mac_to_dcd
+      expected_accepting = expected._accept_data
+      mac_to_dcd_first, mac_to_dcd_done, mac_to_dcd_hopeful = mac_to_dcd.feed_byte(byte)
+      dcd_to_mac_first, dcd_to_mac_done, dcd_to_mac_hopeful = dcd_to_mac.feed_byte(byte)
+      if mac_to_dcd_first: mac_to_dcd.sync_tell = tell
+      if dcd_to_mac_first: dcd_to_mac.sync_tell = tell
+      # a payload that was completed but is not valid is only worth reporting if it was the one expected next
+      expected_done = dcd_to_mac_done if reply_expected else mac_to_dcd_done
+      if expected_accepting and not expected._accept_data and not expected_done:
+        events.append(MarkError(trans, reply_expected, expected.sync_tell, 'Data  BAD CHECKSUM'))
+      if mac_to_dcd_done or dcd_to_mac_done:
+        decoder = mac_to_dcd if mac_to_dcd_done else dcd_to_mac
+        in_groups, data = decoder.result()
+        number += 1
+        events.append(DcdPayload(trans, decoder is dcd_to_mac, decoder.sync_tell, number, bytes(data)))
+        mac_to_dcd.reset()
+        dcd_to_mac.reset(in_groups)
+        reply_expected = bool(in_groups)
+      elif not mac_to_dcd_hopeful and not dcd_to_mac_hopeful:
+        mid_transaction = reply_expected = False
+        mac_to_dcd.reset()
+        dcd_to_mac.reset()
+        events.append(Desync(trans))
+  return events, [bytes(data) for data in transactions]
@@ -0,0 +1,235 @@
+'''Live counters for the IWM/SWIM analyzers, and a local endpoint that serves them as JSON.
+
+Each analyzer keeps a Stats (as analyzer.stats) counting the bytes received and decoded, the backlog of the serial port
+and of the capture thread, the marks found, the kinds of bad marks, DCD desyncs, and the time spent decoding, waiting
+for input, and logging and writing output.  A snapshot of the counters can be taken at any time from any thread.  Pass
+stats_interval to an analyzer to print a summary line that often, and stats_address to serve snapshots while it runs,
+either over HTTP ('localhost:8000', or just a port number) or on a Unix socket (a path), which sends the JSON and
+closes the connection:
+
+  curl http://localhost:8000/
+  nc -U /tmp/gcr.sock
+'''
+
+from collections import Counter
+from contextlib import contextmanager
+import http.server
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+from events import AddressMark, DataMark, DcdPayload, Desync, IndexMark, MarkError, TransactionEnd
+
+
+_EVENT_COUNTERS = {AddressMark: 'address_marks', DataMark: 'data_marks', IndexMark: 'index_marks',
+                   DcdPayload: 'payloads', Desync: 'desyncs', TransactionEnd: 'transactions'}
+_ERROR_COUNTERS = (('CHECKSUM', 'bad_checksum'), ('CRC', 'bad_crc'), ('TRUNCATED', 'truncated'),
+                   ('INVALID NIBBLE', 'invalid_nibbles'))  # by what the message of a MarkError contains
+COUNTERS = tuple(_EVENT_COUNTERS.values()) + tuple(name for _, name in _ERROR_COUNTERS) + ('other_errors',)
+
+
+class _WatchedSource:
+  '''Byte source wrapper that counts the bytes read from a source and the time spent waiting for them.'''
+
+  def __init__(self, source, stats):
+    self.source = source
+    self.REPLAY = source.REPLAY
+    self._stats = stats
+
+  def read(self):
+    stats = self._stats
+    stats.reading_since = start = time.perf_counter()
+    try:
+      data = self.source.read()
+    finally:
+      stats.reading_since = None
+      stats.io_time += time.perf_counter() - start
+    stats.decoded += len(data)
+    return data
+
+  def close(self):
+    self.source.close()
+
+
+class Stats:
+  '''Counters of what an analyzer has received and decoded, updated as it runs.'''
+
+  def __init__(self):
+    self.counts = Counter(dict.fromkeys(COUNTERS, 0))
+    self.decoded = 0  # bytes read by the analyzer
+    self.io_time = 0.0  # seconds spent waiting for input
+    self.output_time = 0.0  # seconds spent logging and writing output
+    self._busy_time = 0.0  # seconds spent decoding and waiting for input
+    self.reading_since = None  # time.perf_counter() when the read in progress started
+    self._busy_since = None  # likewise for the decoding in progress
+    self.queued = 0  # marks framed but not yet verified (see pipeline.py)
+    self.max_queued = 0
+    self.queue_waits = 0  # times the framing waited for the verification to catch up
+    self._start = time.monotonic()
+    self._source = None
+
+  def watch(self, source):
+    '''Return a wrapper of a byte source that counts what is read from it.'''
+    self._source = source
+    return _WatchedSource(source, self)
+
+  def idle(self):
+    '''Return True if the analyzer has read everything received so far from a live source, so will wait for more.'''
+    source = self._source
+    return source is not None and not source.REPLAY and getattr(source, 'received', self.decoded) <= self.decoded
+
+  def event(self, event):
+    '''Count an event.'''
+    counter = _EVENT_COUNTERS.get(type(event))
+    if counter:
+      self.counts[counter] += 1
+    elif type(event) is MarkError:
+      self.counts[next((name for text, name in _ERROR_COUNTERS if text in event.message), 'other_errors')] += 1
+
+  def consume(self, events, handle):
+    '''Call handle with each of the events, counting them and timing the decoding and the handling of them.'''
+    clock = time.perf_counter
+    self._busy_since = clock()
+    try:
+      for event in events:
+        now = clock()
+        self._busy_time += now - self._busy_since
+        self._busy_since = None
+        self.event(event)
+        handle(event)
+        self._busy_since = clock()
+        self.output_time += self._busy_since - now
+    finally:
+      self._busy_since = None
+
+  def snapshot(self):
+    '''Return the counters as a dict.'''
+    now = time.monotonic()
+    clock = time.perf_counter()
+    busy_since, reading_since = self._busy_since, self.reading_since  # count what is in progress, too
+    busy_time = self._busy_time + (clock - busy_since if busy_since is not None else 0.0)
+    io_time = self.io_time + (clock - reading_since if reading_since is not None else 0.0)
+    source = self._source
+    received = getattr(source, 'received', self.decoded)  # only a capture thread receives more than is decoded
+    counts = self.counts
+    errors = sum(counts[name] for _, name in _ERROR_COUNTERS) + counts['other_errors']
+    return dict(counts, elapsed=now - self._start, received=received, decoded=self.decoded, lag=received - self.decoded,
+                max_lag=getattr(source, 'max_lag', 0), stalls=getattr(source, 'stalls', 0),
+                backlog=getattr(source, 'backlog', 0),
+                marks=sum(counts[name] for name in ('address_marks', 'data_marks', 'index_marks', 'payloads')),
+                errors=errors, decode_time=max(busy_time - io_time, 0.0), io_time=io_time,
+                output_time=self.output_time, queued=self.queued, max_queued=self.max_queued,
+                queue_waits=self.queue_waits)
+
+
+def summary(name, snapshot, last=None):
+  '''Return a summary line of a snapshot, with the decoding rate since the last snapshot if given.'''
+  elapsed = snapshot['elapsed'] - (last['elapsed'] if last else 0)
+  decode_rate = (snapshot['decoded'] - (last['decoded'] if last else 0)) / max(elapsed, 1e-9)
+  busy = (snapshot['decode_time'] + snapshot['io_time'] + snapshot['output_time']) or 1.0
+  return ('%s %s: %d KB received, %d KB decoded (%.1f KB/s), %d KB behind, %d KB in port, %d marks queued; %d marks, '
+          '%d bad (%d checksum, %d CRC, %d truncated, %d invalid nibbles), %d desyncs; %.0f%% decode, %.0f%% I/O, '
+          '%.0f%% output' %
+          (time.strftime('(%H:%M:%S)'), name, snapshot['received'] >> 10, snapshot['decoded'] >> 10,
+           decode_rate / 1024, snapshot['lag'] >> 10, snapshot['backlog'] >> 10, snapshot['queued'], snapshot['marks'],
+           snapshot['errors'], snapshot['bad_checksum'], snapshot['bad_crc'], snapshot['truncated'],
+           snapshot['invalid_nibbles'], snapshot['desyncs'], snapshot['decode_time'] * 100 / busy,
+           snapshot['io_time'] * 100 / busy, snapshot['output_time'] * 100 / busy))
+
+
+class SummaryThread:
+  '''Prints a summary line of each of a dict of name -> Stats every interval seconds.'''
+
+  def __init__(self, stats, interval, stream=None):
+    self._stats = stats
+    self._interval = interval
+    self._stream = stream or sys.stdout
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, name='stats', daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    last = {}
+    while not self._stop.wait(self._interval):
+      lines = []
+      for name, stats in self._stats.items():
+        snapshot = stats.snapshot()
+        lines.append('%s\n' % summary(name, snapshot, last.get(name)))
+        last[name] = snapshot
+      self._stream.write(''.join(lines))
+      self._stream.flush()
+
+  def close(self):
+    self._stop.set()
+    self._thread.join()
+
+
+class _HttpHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    body = json.dumps(self.server.snapshots()).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass  # keep requests out of the analyzer's console
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    self.wfile.write(json.dumps(self.server.snapshots()).encode('utf-8') + b'\n')
+
+
+class _HttpServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+
+class StatsServer:
+  '''Serves snapshots of each of a dict of name -> Stats as a JSON object, on a thread of its own.
+
+  address is 'host:port' or a port number for HTTP on that port, or the path of a Unix socket.
+  '''
+
+  def __init__(self, address, stats):
+    self._path = None
+    address = str(address)
+    if '/' in address:
+      self._path = address
+      if os.path.exists(address): os.unlink(address)  # left behind by an earlier run
+      self._server = _UnixServer(address, _UnixHandler)
+    else:
+      host, _, port = address.rpartition(':')
+      self._server = _HttpServer((host or 'localhost', int(port)), _HttpHandler)
+    self._server.snapshots = lambda: {name: stats.snapshot() for name, stats in stats.items()}
+    self.address = self._path or '%s:%d' % self._server.server_address[:2]
+    self._thread = threading.Thread(target=self._server.serve_forever, name='stats server', daemon=True)
+    self._thread.start()
+
+  def close(self):
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+    if self._path and os.path.exists(self._path): os.unlink(self._path)
+
+
+@contextmanager
+def reporting(name, stats, interval=None, address=None):
+  '''Context manager printing a summary of stats every interval seconds and serving it at address, if given.'''
+  summary_thread = SummaryThread({name: stats}, interval) if interval else None
+  server = StatsServer(address, {name: stats}) if address is not None else None
+  try:
+    yield
+  finally:
+    if server: server.close()
+    if summary_thread: summary_thread.close()
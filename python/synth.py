@@ -0,0 +1,282 @@
+'''Synthetic captures for testing and benchmarking the IWM/SWIM analyzers.
+
+This is the encoding side of each of the analyzers: GCR address and data marks (nibblized and mangled, with the direction
+in the most significant bit of each byte), MFM address, data, and index marks with their CRCs, and DCD commands and
+replies framed in groups of seven bytes, with holdoffs.  write_capture() strings random marks together into a _serial.bin
+capture of any size, injecting faults (corrupted and truncated marks, mismatched sectors, bad checksums, and junk between
+marks) at the given rate.  DCD captures get a _serial.ts sidecar marking the ends of transactions, so they replay as if
+the serial port had timed out there:
+
+  python3 synth.py gcr 300 synth_gcr_serial.bin [error_rate [seed]]
+'''
+
+import binascii
+import random
+import struct
+import sys
+
+from analyzer_gcr import IWM_TO_NIBBLE
+from capture import SERIAL_TIMEOUT, TIMESTAMP_HEADER, TIMESTAMP_MAGIC, TIMESTAMP_RECORD, TIMEOUT_FLAG, timestamp_path
+
+
+ERROR_RATE = 0.01  # chance of each kind of fault in each mark
+POOL_SIZE = 256  # distinct payloads encoded for each capture; encoding every mark afresh would be far too slow
+BYTE_TIME = 10000  # nanoseconds taken by each byte at 1 Mbaud, for the timestamps of DCD captures
+
+NIBBLE_TO_IWM = bytes(IWM_TO_NIBBLE.index(byte & 0x3F) | 0x80 for byte in range(256))  # translation table for nibbles
+GCR_SECTORS = tuple(12 - track // 16 for track in range(80))
+READ_TABLE = bytes(byte | 0x80 for byte in range(256))
+WRITE_TABLE = bytes(byte & 0x7F for byte in range(256))
+
+
+# GCR
+
+def nibblize(data):
+  '''Inverse of reference.denibblize: split each three bytes of data into a nibble of their high bits and three of
+  their low six bits.'''
+  nibbles = bytearray()
+  for i in range(0, len(data), 3):
+    trio = data[i:i + 3]
+    hi_bits = 0
+    for shift, byte in zip((4, 2, 0), trio): hi_bits |= (byte >> 6) << shift
+    nibbles.append(hi_bits)
+    nibbles.extend(byte & 0x3F for byte in trio)
+  return bytes(nibbles)
+
+
+def mangle(data):
+  '''Inverse of reference.demangle: return the nibbles of mangled data followed by those of its checksum.'''
+  checksum_a = checksum_b = checksum_c = 0
+  mangled = bytearray(len(data))
+  for i in range(0, len(data), 3):
+    checksum_c = (checksum_c << 1 | checksum_c >> 7) & 0xFF  # bit 0 of checksum_c is now the carry
+    mangled[i] = data[i] ^ checksum_c
+    checksum_a += data[i] + (checksum_c & 1)
+    if i + 1 < len(data):
+      mangled[i + 1] = data[i + 1] ^ (checksum_a & 0xFF)
+      checksum_b += data[i + 1] + (checksum_a >> 8)
+    checksum_a &= 0xFF
+    if i + 2 < len(data):
+      mangled[i + 2] = data[i + 2] ^ checksum_b & 0xFF
+      checksum_c = (checksum_c + data[i + 2] + (checksum_b >> 8)) & 0xFF
+    checksum_b &= 0xFF
+  return nibblize(mangled) + nibblize(bytes((checksum_a, checksum_b, checksum_c)))
+
+
+def gcr_address_mark(track, sector, side, format=0x22):
+  '''Return the disk bytes of a GCR address mark, including its prologue and epilogue.'''
+  track_byte = track & 0x3F
+  side_byte = (side << 5) | (track >> 6)
+  fields = bytes((track_byte, sector, side_byte, format, track_byte ^ sector ^ side_byte ^ format))
+  return b'\xD5\xAA\x96' + fields.translate(NIBBLE_TO_IWM) + b'\xDE\xAA'
+
+
+def gcr_data_mark(sector, data, nibbles=None):
+  '''Return the disk bytes of a GCR data mark holding 524 bytes of tags and data.
+
+  nibbles, if given, are the mangled data (as from mangle()), so that a payload can be reused for other sectors.
+  '''
+  if nibbles is None: nibbles = mangle(data)
+  return b'\xD5\xAA\xAD' + bytes((NIBBLE_TO_IWM[sector],)) + nibbles.translate(NIBBLE_TO_IWM) + b'\xDE\xAA'
+
+
+def gcr_direction(data, read):
+  '''Return disk bytes as captured: with the most significant bit set if read from the disk, clear if written.'''
+  return data.translate(READ_TABLE if read else WRITE_TABLE)
+
+
+def _gcr_marks(rng, error_rate):
+  '''Yield runs of random GCR sectors (an address mark followed by a data mark), changing direction now and then.'''
+  pool = [mangle(rng.randbytes(524)) for _ in range(POOL_SIZE)]
+  junk = b'\xD5\xAA\x96\xAD\xDE\x80\xFF'
+  read = True
+  while True:
+    track = rng.randrange(80)
+    side = rng.randrange(2)
+    sector = rng.randrange(GCR_SECTORS[track])
+    run = bytearray(b'\xFF' * rng.randrange(20))
+    run += gcr_address_mark(track, sector, side)
+    run += b'\xFF' * rng.randrange(8)
+    if rng.random() < error_rate: sector = (sector + 1) % 12  # data mark for a different sector
+    data_mark = bytearray(gcr_data_mark(sector, None, rng.choice(pool)))
+    if rng.random() < error_rate: data_mark[rng.randrange(len(data_mark))] = rng.choice(junk)
+    if rng.random() < error_rate: del data_mark[rng.randrange(len(data_mark)):]
+    run += data_mark
+    if rng.random() < error_rate: run += bytes(rng.choice(junk) for _ in range(rng.randrange(30)))
+    if rng.random() < 0.3: read = not read
+    yield gcr_direction(run, read)
+
+
+# MFM
+
+MFM_INDEX_MARK = b'\x4E' * 10 + b'\x00' * 12 + b'\xC2\xC2\xC2\xFC'
+
+
+def mfm_mark(body):
+  '''Return an MFM mark (starting with its sync bytes) followed by its CRC.'''
+  return body + struct.pack('>H', binascii.crc_hqx(body, 0xFFFF))
+
+
+def mfm_address_mark(track, side, sector, size=2):
+  return mfm_mark(b'\xA1\xA1\xA1\xFE' + bytes((track, side, sector, size)))
+
+
+def mfm_data_mark(data):
+  return mfm_mark(b'\xA1\xA1\xA1\xFB' + data)
+
+
+def _mfm_marks(rng, error_rate):
+  '''Yield runs of random MFM sectors (an address mark followed by a data mark), with an index mark every track.'''
+  pool = [mfm_data_mark(rng.randbytes(512)) for _ in range(POOL_SIZE)]
+  junk = b'\xA1\xC2\xFE\xFB\xFC'
+  count = 0
+  while True:
+    run = bytearray(MFM_INDEX_MARK if count % 18 == 0 else b'')
+    count += 1
+    run += b'\x4E' * rng.randrange(30)
+    address_mark = bytearray(mfm_address_mark(rng.randrange(80), rng.randrange(2), rng.randrange(1, 19)))
+    if rng.random() < error_rate: address_mark[rng.randrange(len(address_mark))] ^= 0x01
+    run += address_mark
+    run += b'\x4E' * rng.randrange(22)
+    data_mark = bytearray(rng.choice(pool))
+    if rng.random() < error_rate: data_mark[rng.randrange(len(data_mark))] ^= 0x10
+    if rng.random() < error_rate: del data_mark[rng.randrange(len(data_mark)):]
+    run += data_mark
+    if rng.random() < error_rate: run += bytes(rng.choice(junk) for _ in range(rng.randrange(30)))
+    yield bytes(run)
+
+
+# DCD
+
+def dcd_checksum(data, direction):
+  '''Return data with its first byte's most significant bit set for the direction (True for DCD to Macintosh) and its
+  last byte adjusted so that the sum of its bytes is zero, as the DCD analyzer expects of a valid payload.'''
+  data = bytearray(data)
+  data[0] = (data[0] & 0x7F) | (0x80 if direction else 0)
+  data[-1] = (data[-1] - sum(data)) & 0xFF
+  return bytes(data)
+
+
+def _dcd_group(group):
+  '''Return the byte of the least significant bits of a group and the group's bytes shifted right, all with MSB set.'''
+  lsbs = 0
+  for bit, byte in enumerate(group): lsbs |= (byte & 1) << bit
+  return lsbs | 0x80, [(byte >> 1) | 0x80 for byte in group]
+
+
+def dcd_command(data, in_groups, holdoff=()):
+  '''Return the bytes sent by the Macintosh to send data (a multiple of 7 bytes long) and ask for in_groups groups.
+
+  A holdoff is inserted after each group whose index is in holdoff.
+  '''
+  encoded = bytearray(b'\x00\x01\xAA')
+  encoded += bytes((len(data) // 7 | 0x80, in_groups | 0x80))
+  for index in range(len(data) // 7):
+    lsbs, group = _dcd_group(data[index * 7:index * 7 + 7])
+    group.insert(0, lsbs)
+    if index in holdoff:
+      group[-1] &= 0x7F
+      group += [0x11, 0xAA]
+    encoded += bytes(group)
+  return bytes(encoded)
+
+
+def dcd_reply(data, holdoff=()):
+  '''Return the bytes sent by a DCD device in reply, data being a multiple of 7 bytes long.
+
+  A holdoff is inserted after each group whose index is in holdoff.
+  '''
+  encoded = bytearray(b'\x80\xAA')
+  for index in range(len(data) // 7):
+    lsbs, group = _dcd_group(data[index * 7:index * 7 + 7])
+    group.append(lsbs)
+    if index in holdoff:
+      group[-1] &= 0x7F
+      group += [0x22, 0x33, 0xAA]
+    encoded += bytes(group)
+  return bytes(encoded)
+
+
+def _dcd_transactions(rng, error_rate):
+  '''Yield (run, whether a transaction ends after it) for runs of a random DCD command and its reply.'''
+
+  def holdoff(groups):  # never after the last group, which ends the payload anyway
+    return (rng.randrange(groups - 1),) if groups > 1 and rng.random() < 0.2 else ()
+
+  commands = []
+  replies = []
+  for _ in range(POOL_SIZE):
+    out_groups = rng.randrange(1, 4)
+    commands.append(dcd_command(dcd_checksum(rng.randbytes(out_groups * 7), False), rng.randrange(1, 80),
+                                holdoff(out_groups)))
+  for in_groups in range(80):
+    replies.append([dcd_reply(dcd_checksum(rng.randbytes(in_groups * 7), True), holdoff(in_groups)) if in_groups else b''
+                    for _ in range(POOL_SIZE // 32)])
+  while True:
+    command = bytearray(rng.choice(commands))
+    if rng.random() < error_rate: command[6] ^= 0x01  # bad checksum
+    reply = bytearray(rng.choice(replies[command[4] & 0x7F]))
+    if rng.random() < error_rate: reply[3] ^= 0x02  # bad checksum
+    junk = rng.randbytes(rng.randrange(10)) if rng.random() < error_rate else b''
+    yield bytes(command + junk + reply), rng.random() < 0.5
+
+
+# Captures
+
+def _write_timestamps(path, size, timeouts):
+  '''Write a _serial.ts sidecar for a capture of size bytes that arrived at 1 Mbaud, timing out at the given offsets.'''
+  with open(path, 'wb') as fp:
+    fp.write(TIMESTAMP_HEADER.pack(TIMESTAMP_MAGIC, 0, 0))
+    pause = 0
+    start = 0
+    for offset in timeouts + [size]:
+      if offset > start: fp.write(TIMESTAMP_RECORD.pack(start * BYTE_TIME + pause, start))
+      if offset == size: break
+      fp.write(TIMESTAMP_RECORD.pack(offset * BYTE_TIME + pause, offset | TIMEOUT_FLAG))
+      pause += int(SERIAL_TIMEOUT * 1e9)
+      start = offset
+
+
+def write_capture(path, kind, size, error_rate=ERROR_RATE, seed=0, chunk_size=1 << 22):
+  '''Write a random capture of about size bytes of the given kind ('gcr', 'mfm', or 'dcd') to path.
+
+  The capture is written in chunks of about chunk_size bytes, so it can be much larger than memory.  Returns its size.
+  '''
+  rng = random.Random(seed)
+  written = 0
+  timeouts = []
+  with open(path, 'wb') as fp:
+    if kind == 'dcd':
+      chunk = bytearray()
+      for run, timeout in _dcd_transactions(rng, error_rate):
+        chunk += run
+        if timeout: timeouts.append(written + len(chunk))
+        if len(chunk) >= chunk_size or written + len(chunk) >= size:
+          fp.write(chunk)
+          written += len(chunk)
+          chunk = bytearray()
+          if written >= size: break
+      _write_timestamps(timestamp_path(path), written, timeouts)
+    else:
+      runs = _gcr_marks(rng, error_rate) if kind == 'gcr' else _mfm_marks(rng, error_rate)
+      chunk = []
+      length = 0
+      for run in runs:
+        chunk.append(run)
+        length += len(run)
+        if length >= chunk_size or written + length >= size:
+          fp.write(b''.join(chunk))
+          written += length
+          chunk = []
+          length = 0
+          if written >= size: break
+      if kind == 'gcr':  # the last byte of a transaction is held back until the direction changes
+        fp.write(gcr_direction(b'\xFF\xFF\xFF', not run[-1] & 0x80))
+        written += 3
+  return written
+
+
+if __name__ == '__main__':
+  kind, megabytes, path = sys.argv[1], float(sys.argv[2]), sys.argv[3]
+  write_capture(path, kind, int(megabytes * (1 << 20)), *(float(arg) for arg in sys.argv[4:5]),
+                *(int(arg) for arg in sys.argv[5:6]))
@@ -0,0 +1,56 @@
+'''Tests of packed output, run with python3 -m unittest (or pytest) from this directory.'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import analyzer_mfm
+from capture import FileSource
+from pack import DATA, NO_DIRECTION, TRANSACTION, PackReader, PackWriter, export, item_path
+import synth
+
+
+class PackTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='iwm_test_')
+    self.prefix = os.path.join(self.directory, 't')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def records(self):
+    reader = PackReader(self.prefix)
+    try:
+      return [(record, bytes(reader.item(record.kind, record.number)[0])) for record in reader]
+    finally:
+      reader.close()
+
+  def test_fields_of_any_byte(self):
+    writer = PackWriter(self.prefix, ('wr', 'rd'))
+    writer.append(TRANSACTION, 0, 1, b'\xD5\xAA\xAD')
+    writer.add(DATA, 0, 1, b'data', 0x7FF, 0xFF, 0x80)
+    writer.add(DATA, 1, NO_DIRECTION, b'more', 0, 0x81, 0xFF)
+    writer.close()
+    records = [(record.kind, record.number, record.direction, record.track, record.side, record.sector, data)
+               for record, data in self.records()]
+    self.assertEqual(records, [(DATA, 0, 1, 0x7FF, 0xFF, 0x80, b'data'),
+                               (DATA, 1, NO_DIRECTION, 0, 0x81, 0xFF, b'more'),
+                               (TRANSACTION, 0, 1, None, None, None, b'\xD5\xAA\xAD')])
+
+  def test_mfm_high_side_and_sector(self):
+    '''An MFM address mark may hold any byte as its side and sector, and the data mark after it is still packed.'''
+    data_mark = synth.mfm_data_mark(bytes(range(256)) * 2)
+    capture = b'\x4E' * 16 + synth.mfm_address_mark(3, 0x81, 0xF0) + b'\x4E' * 22 + data_mark + b'\x4E' * 16
+    data = data_mark[4:]  # the data mark's payload, as packed, is all of it after its signature
+    with open(self.prefix + '_in.bin', 'wb') as fp: fp.write(capture)
+    analyzer_mfm.Analyzer(FileSource(self.prefix + '_in.bin'), self.prefix, image=False, console=None).analyze()
+    ((record, payload),) = [item for item in self.records() if item[0].kind == DATA]
+    self.assertEqual((record.track, record.side, record.sector, payload), (3, 0x81, 0xF0, data))
+    export(self.prefix)
+    with open(item_path(self.prefix, DATA, 0, NO_DIRECTION, None), 'rb') as fp: self.assertEqual(fp.read(), data)
+
+
+if __name__ == '__main__':
+  unittest.main()
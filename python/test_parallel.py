@@ -0,0 +1,68 @@
+'''Tests of decoding a capture across processes, run with python3 -m unittest (or pytest) from this directory.'''
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import analyzer_gcr
+import analyzer_mfm
+from capture import FileSource
+from parallel import analyze_parallel
+import synth
+
+
+OPTIONS = dict(image=False, console=None, checkpoints=False)
+
+
+class ParallelTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='iwm_test_')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def decode_both_ways(self, module, kind):
+    '''Decode a synthetic capture with many bad marks in one process and in many chunks, returning both prefixes.'''
+    path = os.path.join(self.directory, 'capture_serial.bin')
+    synth.write_capture(path, kind, 1 << 21, error_rate=0.2, seed=1)
+    single, parallel = os.path.join(self.directory, 'single'), os.path.join(self.directory, 'parallel')
+    module.Analyzer(FileSource(path), single, **OPTIONS).analyze()
+    analyze_parallel(module, path, parallel, workers=2, chunk_size=1 << 16, **OPTIONS)
+    return single, parallel
+
+  def index(self, prefix):
+    db = sqlite3.connect(prefix + '_marks.db')
+    try:
+      return (db.execute('SELECT * FROM marks ORDER BY rowid').fetchall(),
+              db.execute('SELECT * FROM transactions ORDER BY number').fetchall())
+    finally:
+      db.close()
+
+  def check_index(self, module, kind):
+    single, parallel = self.decode_both_ways(module, kind)
+    self.assertEqual(self.index(parallel), self.index(single))
+
+  def check_pack(self, module, kind):
+    single, parallel = self.decode_both_ways(module, kind)
+    for suffix in ('_pack.bin', '_pack.idx'):
+      with open(single + suffix, 'rb') as single_fp, open(parallel + suffix, 'rb') as parallel_fp:
+        self.assertEqual(parallel_fp.read(), single_fp.read(), suffix)
+
+  def test_gcr_index(self):
+    self.check_index(analyzer_gcr, 'gcr')
+
+  def test_mfm_index(self):
+    self.check_index(analyzer_mfm, 'mfm')
+
+  def test_gcr_pack(self):
+    self.check_pack(analyzer_gcr, 'gcr')
+
+  def test_mfm_pack(self):
+    self.check_pack(analyzer_mfm, 'mfm')
+
+
+if __name__ == '__main__':
+  unittest.main()